@@ -1,180 +1,135 @@
-import os
-import math
-import time
+import sys
+import signal
+import asyncio
 import logging
-import tomllib
 import routines
-
-# Load config file
-with open("config.toml", mode="rb") as fp:
-    config = tomllib.load(fp)
-
-logging.basicConfig(
-    filename=config["LOG_FILE"],
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-)
-if config["LOG_LEVEL"] == "INFO":
-    logging.getLogger().setLevel(logging.INFO)
-elif config["LOG_LEVEL"] == "DEBUG":
-    logging.getLogger().setLevel(logging.DEBUG)
-else:
-    logging.warning("Unknown logging level")
-
-
-# Initialize classes
-Energy = routines.PowerUsage()
-Messages = routines.MqttCallbacks()
-if "ENABLE_TESLA_PROXY" in config:
-    if config["ENABLE_TESLA_PROXY"] == "True":
-        logging.debug("Using TeslaProxy")
-        Car = routines.TeslaProxy()
-    else:
-        logging.debug("Using TeslaCommands")
-        Car = routines.TeslaCommands()
+import controller
+import allocator
+import metrics
+import tsstore
+import logs
+import checkpoint
+import health
+
+# Config file, loaded and checked once by routines (see settings.py), reloaded on SIGHUP or TOPIC_RELOAD
+config = routines.config
+
+# Queued, lazily formatted logging, written in blocks (see logs.py)
+logs.setup_logging(config)
+
+
+# Optional charge planning toward charge_limit_soc, from a surplus forecast (requires numpy)
+Forecast = None
+if config.get("PLAN_CHARGING"):
+    try:
+        import forecast
+    except ImportError as e:
+        logging.critical("PLAN_CHARGING needs numpy (%s), install it with:", e)
+        logging.critical("pip install -r requirements-plan.txt")
+        sys.exit(1)
+    Forecast = forecast.SurplusForecast(config.get("FORECAST_SLOT", 900), config.get("FORECAST_DAYS", 14))
+    if config.get("DATA_DIR"):
+        Forecast.load(config["DATA_DIR"])
+
+
+def create_planner(vehicle_config):
+    return forecast.ChargePlanner(vehicle_config, Forecast) if Forecast else None
+
+
+def create_checkpoint(filename):
+    if not config.get("CHECKPOINT_FILE"):
+        return None
+    return checkpoint.Checkpoint(filename, config.get("CHECKPOINT_INTERVAL", 300), config.get("CHECKPOINT_MAX_AGE", 900))
+
+
+def load_state(saved):
+    return saved.load() if saved else None
+
+
+def recover(loop):
+    """A loop is hung, new eGauge and car connections before the systemd watchdog restarts PVCharge"""
+    Energy.reset_connection()
+    for Controller in Controllers:
+        Controller.car.reset_session()
+
+
+# systemd readiness and watchdog pings (PVCharge.service), sent while every loop keeps to LOOP_DEADLINE
+Watchdog = health.Watchdog(config, health.SystemdNotifier(), recover)
+
+
+# Initialize classes, warm restart from recent checkpoints (without the eGauge handshake)
+if config.get("VEHICLES"):
+    # One controller per car, sharing the eGauge, the MQTT connection and the solar surplus
+    vehicles = [config.vehicle(index) for index in range(len(config["VEHICLES"]))]
+    Checkpoints = [create_checkpoint(f"{vehicle['TESLA_VIN']}_{config.get('CHECKPOINT_FILE')}") for vehicle in vehicles]
+    States = [load_state(saved) for saved in Checkpoints]
+    Energy = routines.PowerUsage([(vehicle["EGAUGE_CHARGER"], vehicle["EGAUGE_CHARGER_SENSOR"]) for vehicle in vehicles],
+                                 check_connection=not all(States))
+    Allocator = allocator.SurplusAllocator(Energy)
+    Sampler = controller.EnergySampler(config, Energy, forecast=Forecast, watchdog=Watchdog)
+    Controllers = []
+    client = None
+    for vehicle, saved, state in zip(vehicles, Checkpoints, States):
+        Messages = routines.MqttCallbacks(vehicle, client, state=state and state["mqtt"])
+        client = Messages.client
+        Controllers.append(controller.ChargeController(vehicle, Allocator.add_vehicle(vehicle, Messages), Messages,
+                                                       Messages.car_cmd, sampler=Sampler,
+                                                       planner=create_planner(vehicle), checkpoint=saved,
+                                                       watchdog=Watchdog))
+        if state:
+            Controllers[-1].restore_state(state)
+        logging.info("Controlling %s", vehicle.get("NAME", vehicle["TESLA_VIN"]))
 else:
-    logging.debug("Using TeslaCommands")
-    Car = routines.TeslaCommands()
-
-# Control loop variables
-car_is_charging = False
-stop_charging_time = 0
-start_charging_time = 0
-report_time = time.time() - config["REPORT_DELAY"]
-while True:
-    # Record loop start time
-    loop_time = time.time()
-    # Check if we are allowed to charge
-    charge_tesla = Messages.calculate_charge_tesla()
-    sun_up = Energy.check_sun_up()
-    charge_delay = Messages.calculate_charge_delay(loop_time)
-    logging.debug(f"Current calculated charge enable: {charge_tesla}")
-    logging.debug(f"                      Is Sun Up?: {sun_up}")
-    prevent_non_solar_charge = Messages.var_topic_prevent_non_solar_charge
-    logging.debug(f"Current prevent non_solar charge: {prevent_non_solar_charge}")
-
-    if ((charge_tesla and sun_up) and not charge_delay):    # If we are allowed to charge
-        if car_is_charging:    # Is the car currently charging?
-            if Energy.sufficient_generation(config["MIN_CHARGE"]):
-                # Reset stop time
-                stop_charging_time = 0
-                # Calculate new charge rate
-                # Use math.floor() on calculate_charge_rate to ensure we are always just "under" the available PV generation capacity
-                # Use round() on charge_rate_sensor to prevent constant requests when on the edge of a value
-                new_charge_rate = math.floor(Energy.calculate_charge_rate(new_sample=False))
-                logging.debug(f"Car charging, new rate calculated: {new_charge_rate}, current rate: {round(Energy.charge_rate_sensor)}")
-                if (new_charge_rate != round(Energy.charge_rate_sensor)) and (round(Energy.charge_rate_sensor) != 0):
-                    # Set new charge rate
-                    if Car.set_charge_rate(new_charge_rate) == True:
-                        if Energy.verify_new_charge_rate(new_charge_rate):
-                            logging.info(f"Car charging, new rate: {new_charge_rate} successfully set")
-                            Messages.client.publish(topic=config["TOPIC_CHARGE_RATE"], payload=new_charge_rate, qos=1)
-                    else:
-                        logging.warning("Car charging, new rate was NOT successfully set")
-
-            else:    # We don't have enough sun
-                if round(Energy.charge_rate_sensor) > config["MIN_CHARGE"]:    # If we are charging at anything greater than min charge
-                    # Set charge rate to min charge
-                    if Car.set_charge_rate(config["MIN_CHARGE"]) == True:
-                        logging.info(f"Car charging, Available Energy Reduced, new rate: {config['MIN_CHARGE']} successfully set")
-                        Messages.client.publish(topic=config["TOPIC_CHARGE_RATE"], payload=config["MIN_CHARGE"], qos=1)
-                    else:
-                        logging.warning("Car charging, Available Energy Reduced, new rate was NOT successfully set")
-
-                else:    # We are already at min charge
-                    # Wait configured time before stopping
-                    waited_long_enough, stop_charging_time = routines.check_elapsed_time(loop_time, stop_charging_time, config["DELAYED_STOP_TIME"])
-                    if waited_long_enough:
-                        if Car.stop_charging() == True:
-                            logging.info("Car charging, Available Energy Reduced, charging was successfully stopped")
-                            car_is_charging = False
-                            stop_charging_time = 0
-                        else:
-                            if round(Energy.charge_rate_sensor) < config["MIN_CHARGE"]:    # Catch case where stop charging is failing due to charging already being stopped
-                                logging.info("Car charging was already stopped, resetting flags")
-                                car_is_charging = False
-                                stop_charging_time = 0
-                            else:
-                                logging.warning("Car charging, Available Energy Reduced, charging was NOT successfully stopped")
-                    else:
-                        logging.info(f"Car charging, Available Energy Reduced, charging at min rate, stopping in: {round(config['DELAYED_STOP_TIME'] - (loop_time - stop_charging_time))} seconds")
-
-        else:    # Car isn't charging, should it be?
-            if Energy.sufficient_generation(config["MIN_CHARGE"]):    # If we have enough sun to charge
-                if round(Energy.charge_rate_sensor) < config["MIN_CHARGE"]:	   # Make sure car isn’t already charging
-                    if ((Messages.var_topic_teslamate_charge_limit_soc - Messages.var_topic_teslamate_battery_level) > 1):    # If we are charging at least 1%
-                        # Wait configured time before starting
-                        waited_long_enough, start_charging_time = routines.check_elapsed_time(loop_time, start_charging_time, config["DELAYED_START_TIME"])
-                        if waited_long_enough:
-                            wake_states = ["asleep", "suspended", "offline"]
-                            if Messages.var_topic_teslamate_state in wake_states:    # Only wake car if it's asleep
-                                if Car.wake():
-                                    logging.info("Car is NOT charging, Energy is Available, car woken successfully")
-                                    time.sleep(5)    # Wait until car is awake
-                                else:
-                                    logging.warning("Car was NOT woken successfully")
-                            if Car.start_charging() == True:
-                                logging.info("Car Started Charging Successfully")
-                                time.sleep(10)    # Wait until charging is fully started
-                                if Energy.verify_new_charge_rate(config["MIN_CHARGE"]):
-                                    logging.info("Charge Rate is greater than min charge")
-                                    car_is_charging = True
-                                    start_charging_time = 0
-                                    # Optionally we could set a new charge rate here
-                            else:
-                                logging.warning("Car Charging NOT Started Successfully")
-                        else:
-                            logging.info(f"Car is NOT charging, Energy is Available, starting in: {round(config['DELAYED_START_TIME'] - (loop_time - start_charging_time))} seconds")
-                    else:
-                        logging.info("Car will not charge with only 1% remaining, skipping")
-
-                else:    # Car is already charging, set the flag
-                    car_is_charging = True
-                    start_charging_time = 0
-
-            else:    # Sun isn't generating enough power to charge
-                if prevent_non_solar_charge:    # If true, prevent after-hours charging
-                    if round(Energy.charge_rate_sensor) >= config["MIN_CHARGE"]:
-                        if Car.stop_charging() == True:  # Stop if it is charging
-                            logging.info("Fast poll, Car discovered charging and was stopped successfully")
-                        else:
-                            logging.warning("Fast poll, Car discovered charging and was NOT stopped successfully")
-
-                if start_charging_time != 0:    # If starting time has already been set
-                    # Reset start charging time as sun has dropped below the threshold
-                    start_charging_time = 0
-
-    elif charge_delay or prevent_non_solar_charge:
-            if car_is_charging:
-                if Messages.var_topic_teslamate_battery_level == Messages.var_topic_teslamate_charge_limit_soc:
-                    logging.info(f"Completed charge to: {Messages.var_topic_teslamate_charge_limit_soc}% limit, stopping charge")
-                Car.set_charge_rate(config["MIN_CHARGE"])    # Set charge rate to min charge, to reset for next time
-                car_is_charging = False    # Always reset flag if set, actual charge rate is used to stop
-
-            logging.debug("Slow poll wait, ensure car isn't charging")
-            if round(Energy.charge_rate_sensor) >= config["MIN_CHARGE"]:
-                if Car.stop_charging() == True:     # Stop if it is charging
-                    logging.info("Slow poll, Car discovered charging and was stopped successfully")
-                    time.sleep(2)    # Delay to allow stop command to complete
-                else:
-                    logging.warning("Slow poll, Car discovered charging and was NOT stopped successfully")
-                Energy.sample_sensor(timeout=10)    # Force sensor refresh to increase accuracy of subsequent loop
-            else:
-                # Prevent non_solar_charge or delay, wait condition
-                time.sleep(config["SLOW_POLLING"])
-
-    else:    # We are allowing car to charge after sundown
-        logging.debug("Slow poll wait, ignoring car charge")
-        time.sleep(config["SLOW_POLLING"])
-
-    # Wait configured time before reporting status
-    report_is_due, report_time = routines.check_elapsed_time(loop_time, report_time, config["REPORT_DELAY"])
-    if report_is_due:
-        status = Energy.status_report(charge_tesla, charge_delay, sun_up, car_is_charging, new_sample=True)
-        logging.info(f"{status}")
-        Messages.client.publish(topic=config["TOPIC_STATUS"], payload=status, qos=1)
-        report_time = loop_time    # Reset counter for next loop
-
-    # Control loop delay
-    time.sleep(config["FAST_POLLING"])
+    Checkpoint = create_checkpoint(config.get("CHECKPOINT_FILE"))
+    State = load_state(Checkpoint)
+    Energy = routines.PowerUsage(check_connection=not State)
+    Car = routines.create_car()
+    Messages = routines.MqttCallbacks(car_cmd=Car, state=State and State["mqtt"])
+    Sampler = controller.EnergySampler(config, Energy, forecast=Forecast, watchdog=Watchdog)
+    Controllers = [controller.ChargeController(config, Energy, Messages, Car, sampler=Sampler,
+                                               planner=create_planner(config), checkpoint=Checkpoint,
+                                               watchdog=Watchdog)]
+    if State:
+        Controllers[0].restore_state(State)
+
+# Optional time-series record of samples, decisions and car commands
+if config.get("DATA_DIR"):
+    tsstore.open_store(config["DATA_DIR"], config.get("STORE_FLUSH_BYTES", 4096), config.get("STORE_FLUSH_INTERVAL", 300))
+
+# Optional Prometheus endpoint for latency histograms and error counters
+if config.get("METRICS_PORT", 0):
+    metrics.start_http_server(config["METRICS_PORT"], config.get("METRICS_ADDRESS", "127.0.0.1"))
+
+
+def reload_config():
+    logging.info("SIGHUP, reloading config")
+    config.reload()
+
+
+def stop(task):
+    logging.info("SIGTERM, stopping")
+    Watchdog.notifier.notify("STOPPING=1")
+    task.cancel()
+
+
+async def main():
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, reload_config)
+    task = asyncio.ensure_future(controller.run_all(Controllers, Watchdog))    # READY=1 once the loops run
+    # systemd stops PVCharge with SIGTERM, cancel the loops so the flushes below (and at exit) still run
+    loop.add_signal_handler(signal.SIGTERM, stop, task)
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    finally:    # Nothing buffered is lost on a stop or restart
+        for Controller in Controllers:
+            if Controller.checkpoint is not None:
+                Controller.checkpoint.save(Controller.get_state())
+        if tsstore.STORE is not None:
+            tsstore.STORE.flush()
+        logs.shutdown()
+
+
+# Run the control loop, eGauge sampling, car commands and status reporting run as concurrent tasks
+asyncio.run(main())
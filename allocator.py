@@ -0,0 +1,79 @@
+import math
+import logging
+import routines
+
+
+class SurplusAllocator:
+    """Class to split the power available to the cars across vehicles, by PRIORITY and then lowest battery level
+
+    Vehicles are served in order, each up to its MAX_CHARGE, a vehicle whose share is below its MIN_CHARGE
+    leaves the power to the next one.  Cars that may not charge (away, unplugged, full) keep nothing,
+    and anything they draw is not available to the others.
+    """
+    def __init__(self, power):
+        self.power = power
+        self.vehicles = []    # (vehicle config, MqttCallbacks)
+
+    def add_vehicle(self, vehicle_config, messages):
+        """Return the energy interface for the controller of the vehicle on the next charger of power"""
+        self.vehicles.append((vehicle_config, messages))
+        return VehicleEnergy(self, len(self.vehicles) - 1)
+
+    def allocate(self):
+        """Charge rate (A) for every vehicle, from the latest sample"""
+        power = self.power
+        available = power.calculate_charge_rate(new_sample=False)
+        voltage = power.snapshot.charger_voltage
+        eligible = []
+        for index, (vehicle_config, messages) in enumerate(self.vehicles):
+            if messages.calculate_charge_tesla():
+                eligible.append(index)
+            elif voltage and index < len(power.snapshot.chargers):
+                available -= power.snapshot.chargers[index] / voltage
+        eligible.sort(key=lambda index: (self.vehicles[index][0].get("PRIORITY", 1),
+                                         self.vehicles[index][1].var_topic_teslamate_battery_level))
+        rates = [0.0] * len(self.vehicles)
+        for index in eligible:
+            vehicle_config = self.vehicles[index][0]
+            rates[index] = max(min(available, vehicle_config.get("MAX_CHARGE", 32)), 0.0)
+            if math.floor(rates[index]) >= vehicle_config["MIN_CHARGE"]:
+                available -= rates[index]
+        logging.debug("Allocated charge rates: %s", rates)
+        return rates
+
+
+class VehicleEnergy:
+    """PowerUsage as seen by the controller of one vehicle, its charge rate is the vehicle's share of the surplus"""
+    def __init__(self, allocator, index):
+        self.allocator = allocator
+        self.power = allocator.power
+        self.index = index
+        self.new_charge_rate = 0
+
+    @property
+    def charge_rate_sensor(self):
+        return self.power.charge_rate_sensors[self.index]
+
+    def calculate_charge_rate(self, new_sample, smoothing=None):
+        if new_sample:
+            self.power.calculate_charge_rate(new_sample, smoothing)
+        self.new_charge_rate = self.allocator.allocate()[self.index]
+        return self.new_charge_rate
+
+    def sufficient_generation(self, min_charge, new_sample=True):
+        return math.floor(self.calculate_charge_rate(new_sample)) >= min_charge
+
+    def check_sun_up(self, new_sample=False):
+        return self.power.check_sun_up(new_sample)
+
+    def verify_new_charge_rate(self, new_charge_rate, timeout=10, kind="rate"):
+        return self.power.verify_new_charge_rate(new_charge_rate, timeout=timeout, charger=self.index, kind=kind)
+
+    def sample_sensor(self, timeout=30):
+        return self.power.sample_sensor(timeout=timeout)
+
+    def status_report(self, charge_tesla, charge_delay, sun_up, car_is_charging, new_sample):
+        if new_sample:
+            self.calculate_charge_rate(new_sample)
+        return routines.format_status(charge_tesla, charge_delay, sun_up, car_is_charging, self.charge_rate_sensor,
+                                      self.new_charge_rate)
@@ -0,0 +1,134 @@
+"""Backfill the time-series store with the register history the eGauge already holds
+
+Run from the PVCharge directory (uses .env and config.toml like PVCharge.py):
+    python backfill.py --start 2024-01-01
+    python backfill.py --start 2024-01-01 --end 2024-06-30 --step 300 --workers 4
+    python backfill.py --start 2024-06-01 --end 2024-06-07 --export june.csv    # Trace for simulator.py
+
+Each local day becomes one DATA_DIR/YYYY-MM-DD.registers file (see tsstore.py) of average generation, usage and
+charger power per step.  Days are fetched in a few large register queries each, several days at a time, and a
+day already fetched is skipped, so an interrupted backfill resumes where it stopped.
+"""
+import os
+import sys
+import csv
+import time
+import logging
+import argparse
+import datetime
+import threading
+import concurrent.futures
+from egauge import webapi
+from egauge.webapi.device import Register
+import routines
+import tsstore
+
+
+class Backfill:
+    """Class to fetch register history from the eGauge, day by day, into the store"""
+    def __init__(self, energy, directory, step=60, page=21600, timeout=60):
+        self.energy = energy
+        self.directory = directory
+        self.step = step    # Seconds between rows
+        self.page = page    # Seconds of history per request
+        self.timeout = timeout
+        self.registers = [energy.eGauge_gen, energy.eGauge_use] + [register for register, sensor in energy.chargers]
+        self.local = threading.local()
+
+    def device(self):
+        """One eGauge connection per worker thread"""
+        if not hasattr(self.local, "device"):
+            self.local.device = webapi.device.Device(self.energy.meter_dev,
+                                                     webapi.JWTAuth(self.energy.meter_user, self.energy.meter_password))
+        return self.local.device
+
+    def run(self, first, last, workers=4):
+        """Fetch every day from first to last (dates), returns the number of rows written"""
+        days = [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+        rows = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(self.fetch_day, day): day for day in days}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    written = future.result()
+                except (webapi.Error, OSError) as e:
+                    logging.warning("%s failed, run again to retry: %s", futures[future], e)
+                    continue
+                rows += written
+                logging.info("%s: %s rows", futures[future], written)
+        return rows
+
+    def fetch_day(self, day):
+        """Fetch the part of day not in the store yet, returns the number of rows written"""
+        midnight = int(time.mktime(day.timetuple()))
+        end = min(int(time.mktime((day + datetime.timedelta(days=1)).timetuple())), int(time.time()))
+        end -= end % self.step
+        last = tsstore.last_time(tsstore.day_file(self.directory, day, "registers"), "registers")
+        start = int(last) if last is not None else midnight
+        if start + self.step > end:
+            return 0    # Already complete
+        records = []
+        for page_start in range(start, end, self.page):
+            records += self.fetch_range(page_start, min(page_start + self.page, end))
+        records = [record for record in records if last is None or record[0] > last]
+        if records:
+            tsstore.append_records(self.directory, day, "registers", records)
+        return len(records)
+
+    def fetch_range(self, start, end):
+        """Average power (W) over each step from start to end, oldest first"""
+        history = Register(self.device(), {"time": f"{start}:{self.step}:{end}"}, regs=self.registers,
+                           timeout=self.timeout)
+        rows = sorted(history, key=lambda row: row.ts)    # The eGauge returns the newest row first
+        records = []
+        for older, newer in zip(rows, rows[1:]):
+            difference = newer - older
+            if difference.ts <= 0:
+                continue
+            values = [difference.pq_avg(register).value * 1000 for register in self.registers]    # kW to W
+            records.append((float(newer.ts), values[0], values[1], sum(values[2:])))
+        return records
+
+
+def export_csv(directory, first, last, filename):
+    """Write the stored register history as a simulator.py trace, usage without the car"""
+    reader = tsstore.StoreReader(directory)
+    start = time.mktime(first.timetuple())
+    end = time.mktime((last + datetime.timedelta(days=1)).timetuple())
+    rows = 0
+    with open(filename, "w", newline="") as fp:
+        writer = csv.writer(fp)
+        writer.writerow(["time", "generation", "usage"])
+        for record in reader.scan("registers", start, end):
+            writer.writerow([f"{record.time:.0f}", f"{record.generation:.1f}", f"{record.usage - record.tesla_charger:.1f}"])
+            rows += 1
+    return rows
+
+
+def parse_date(value):
+    return datetime.date.fromisoformat(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill the time-series store from the eGauge register history")
+    parser.add_argument("--start", type=parse_date, required=True, help="First day (YYYY-MM-DD)")
+    parser.add_argument("--end", type=parse_date, default=datetime.date.today(), help="Last day (default today)")
+    parser.add_argument("--step", type=int, default=60, help="Seconds between rows (default 60)")
+    parser.add_argument("--page", type=int, default=21600, help="Seconds of history per request (default 21600)")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent requests (default 4)")
+    parser.add_argument("--export", metavar="CSV", help="Then write the days as a simulator.py trace")
+    parser.add_argument("--data-dir", default=routines.config.get("DATA_DIR") or "data", help="Store directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    backfill = Backfill(routines.PowerUsage(), args.data_dir, args.step, args.page)
+    started = time.monotonic()
+    rows = backfill.run(args.start, args.end, args.workers)
+    logging.info("%s rows in %.1f seconds", rows, time.monotonic() - started)
+    if args.export:
+        logging.info("%s rows exported to %s", export_csv(args.data_dir, args.start, args.end, args.export), args.export)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+"""Benchmark the decision loop against local fakes for the eGauge, the MQTT broker and the car
+
+Run from the PVCharge directory (routines.py reads config.toml on import):
+    python bench/bench_loop.py                               # All scenarios, saved to bench/results/<revision>.json
+    python bench/bench_loop.py --scenario clouds --iterations 500
+    python bench/bench_loop.py --car ble --car-latency 0.05 --car-failures 0.1
+    python bench/bench_loop.py --compare bench/results/<older revision>.json
+
+Every iteration is one pass as PVCharge.py runs it: a fresh eGauge sample over HTTP from stub_egauge.py, the
+decision in ChargeController.step, and any pending charge rate command, sent to stub_tesla_proxy.py (or the
+fake tesla-control binary), which drives the car current the stub eGauge reports.  TeslaMate values reach
+MqttCallbacks through stub_mqtt_broker.py.  Time between iterations is virtual (FAST_POLLING or SLOW_POLLING),
+so start and stop delays play out without waiting, while the work of each pass runs for real.
+
+Per scenario, wall time, CPU time (without the stubs) and peak allocations per iteration are recorded, along
+with eGauge requests, car commands and MQTT messages.  Allocations are measured in a second run with tracemalloc,
+so tracing does not slow the timed run.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import paho.mqtt.client as mqtt
+import routines
+import controller
+from simulator import VirtualClock
+import stub_egauge
+import stub_mqtt_broker
+import stub_tesla_proxy
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PEAK_GENERATION = 6500    # W
+HOUSE_USAGE = 800    # W
+
+
+# Scenarios: generation (W) at t seconds into a run of duration seconds
+def steady(t, duration, seed):
+    return PEAK_GENERATION
+
+
+def clouds(t, duration, seed):
+    """Cloud shadows every few minutes, cutting generation to a third for a minute or two"""
+    cycle, offset = divmod(t, 240)
+    return PEAK_GENERATION * (0.3 if offset < random.Random(int(cycle) * 7919 + seed).uniform(45, 150) else 1.0)
+
+
+def dusk(t, duration, seed):
+    """Generation falling to nothing over the run"""
+    return PEAK_GENERATION * max(1 - t / duration, 0)
+
+
+def start_stop(t, duration, seed):
+    """Three minutes of sun, then three of shade, the car starts and stops every cycle"""
+    return PEAK_GENERATION if (t // 180) % 2 == 0 else 1500
+
+
+SCENARIOS = {"steady": steady, "clouds": clouds, "dusk": dusk, "start_stop": start_stop}
+
+
+class BenchPlant:
+    """House and car for the stubs, the car follows its commands at once"""
+    def __init__(self, scenario, clock, duration, seed, state_file=None):
+        self.scenario = scenario
+        self.clock = clock
+        self.start = clock.now
+        self.duration = duration
+        self.seed = seed
+        self.state_file = state_file    # Commands from the fake tesla-control
+        self.state_read = 0
+        self.voltage = 240.0
+        self.charging = False
+        self.target_amps = routines.config["MIN_CHARGE"]    # Where PVCharge leaves it after stopping
+
+    @property
+    def car_amps(self):
+        self.sync()
+        return float(self.target_amps) if self.charging else 0.0
+
+    def generation(self):
+        return self.scenario(self.clock.now - self.start, self.duration, self.seed)
+
+    def usage(self):
+        return HOUSE_USAGE
+
+    def apply(self, command, data):
+        if command in ("charging-set-amps", "set_charging_amps"):
+            self.target_amps = int(data)
+        elif command in ("charging-start", "charge_start"):
+            self.charging = True
+        elif command in ("charging-stop", "charge_stop"):
+            self.charging = False
+
+    def on_proxy_command(self, command, data):
+        self.apply(command, data.get("charging_amps") if isinstance(data, dict) else None)
+
+    def sync(self):
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return
+        with open(self.state_file) as fp:
+            fp.seek(self.state_read)
+            lines = fp.readlines()
+            self.state_read = fp.tell()
+        for line in lines:
+            command, *args = line.split()
+            self.apply(command, args[0] if args else None)
+
+
+class Fakes:
+    """The stub servers and the environment pointing PVCharge at them, shared by all scenarios"""
+    def __init__(self, args, workdir):
+        self.plant = None
+        self.egauge, egauge_url = stub_egauge.start_egauge(self, latency=args.egauge_latency)
+        self.broker, broker_port = stub_mqtt_broker.start_broker()
+        self.proxy, proxy_url = stub_tesla_proxy.start_proxy(latency=args.car_latency, failure_rate=args.car_failures,
+                                                             on_command=self.on_proxy_command)
+        self.state_file = os.path.join(workdir, "car_state")
+        os.environ.update({
+            "EGDEV": egauge_url, "EGUSR": "bench", "EGPWD": "bench",
+            "EGAUGE_GEN": stub_egauge.REGISTERS[0], "EGAUGE_USE": stub_egauge.REGISTERS[1],
+            "EGAUGE_CHARGER": stub_egauge.REGISTERS[2], "EGAUGE_CHARGER_SENSOR": "S1",
+            "BROKER": "127.0.0.1", "PORT": str(broker_port), "CLIENT_ID": "pvcharge-bench",
+            "PROXY_HOST": proxy_url, "TESLA_VIN": "BENCH",
+            "TESLA_CONTROL_BIN": os.path.join(BENCH_DIR, "fake_tesla_control.py"), "TESLA_KEY_FILE": "bench.pem",
+            "FAKE_TESLA_CONNECT": "0", "FAKE_TESLA_HANDSHAKE": str(args.car_latency * 4),
+            "FAKE_TESLA_COMMAND": str(args.car_latency), "FAKE_TESLA_STATE": self.state_file,
+        })
+        if args.car_failures:
+            os.environ.update({"FAKE_TESLA_ERROR": "vehicle busy", "FAKE_TESLA_FAIL_RATE": str(args.car_failures)})
+        self.teslamate = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id="teslamate-bench",
+                                     protocol=mqtt.MQTTv311)
+        self.teslamate.connect("127.0.0.1", broker_port)
+        self.teslamate.loop_start()
+        config = routines.config
+        for key, value in (("TOPIC_TESLAMATE_GEOFENCE", "Home"), ("TOPIC_TESLAMATE_PLUGGED_IN", "true"),
+                           ("TOPIC_TESLAMATE_BATTERY_LEVEL", "50"), ("TOPIC_TESLAMATE_CHARGE_LIMIT_SOC", "80"),
+                           ("TOPIC_TESLAMATE_STATE", "online"), ("TOPIC_PREVENT_NON_SOLAR_CHARGE", "False")):
+            self.teslamate.publish(config[key], value, qos=1, retain=True).wait_for_publish()
+
+    # The stub eGauge reads the plant of the scenario running
+    @property
+    def car_amps(self):
+        return self.plant.car_amps
+
+    @property
+    def voltage(self):
+        return self.plant.voltage
+
+    def generation(self):
+        return self.plant.generation()
+
+    def usage(self):
+        return self.plant.usage()
+
+    def on_proxy_command(self, command, data):
+        self.plant.on_proxy_command(command, data)
+
+    def counters(self):
+        return {"egauge": sum(self.egauge.requests.values()), "egauge_cpu": self.egauge.cpu,
+                "mqtt": self.broker.messages, "mqtt_cpu": self.broker.cpu, "proxy": len(self.proxy.commands)}
+
+
+def create_car(kind, workdir):
+    if kind == "proxy":
+        return routines.TeslaProxy("BENCH")
+    return routines.TeslaCommands(session_cache=os.path.join(workdir, "session.json"))
+
+
+async def run_scenario(fakes, name, args, workdir, trace_allocations=False):
+    """Run one scenario, returns per-iteration measurements and the command counts"""
+    clock = VirtualClock(time.time())
+    if os.path.exists(fakes.state_file):
+        os.remove(fakes.state_file)
+    fakes.plant = BenchPlant(SCENARIOS[name], clock, args.iterations * routines.config["FAST_POLLING"], args.seed,
+                             fakes.state_file if args.car == "ble" else None)
+    energy = routines.PowerUsage(check_connection=False)
+    energy.sample_ttl = 0    # A new sample every pass, as with FAST_POLLING in real time
+    car = create_car(args.car, workdir)
+    messages = routines.MqttCallbacks(car_cmd=car)
+    charge_controller = controller.ChargeController(routines.config, energy, messages, car, clock=clock)
+    waited = time.monotonic()
+    while not messages.calculate_charge_tesla() and time.monotonic() - waited < 5:    # Retained TeslaMate values
+        await asyncio.sleep(0.01)
+    before = fakes.counters()
+    wall, cpu, allocations = [], [], []
+    if trace_allocations:
+        tracemalloc.start()
+    for iteration in range(args.iterations):
+        stubs = fakes.egauge.cpu + fakes.broker.cpu
+        if trace_allocations:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        started, started_cpu = time.perf_counter(), time.process_time()
+        energy.calculate_charge_rate(True)
+        fast_polling = await charge_controller.step(clock.now)
+        await charge_controller.scheduler.dispatch_pending()
+        wall.append(time.perf_counter() - started)
+        cpu.append(time.process_time() - started_cpu - (fakes.egauge.cpu + fakes.broker.cpu - stubs))
+        if trace_allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1] - baseline)
+        charge_controller.fast_polling = fast_polling
+        clock.advance(routines.config["FAST_POLLING"] if fast_polling else routines.config["SLOW_POLLING"])
+    if trace_allocations:
+        tracemalloc.stop()
+    after = fakes.counters()
+    messages.client.disconnect()
+    messages.client.loop_stop()
+    return {"wall": wall, "cpu": cpu, "allocations": allocations,
+            "car_commands": {command: stats[0] for command, stats in charge_controller.scheduler.stats.items()},
+            "egauge_requests": after["egauge"] - before["egauge"], "mqtt_messages": after["mqtt"] - before["mqtt"]}
+
+
+def summarize(timed, traced):
+    wall = sorted(timed["wall"])
+    return {
+        "iterations": len(wall),
+        "wall_ms": {"mean": statistics.mean(wall) * 1000, "p50": wall[len(wall) // 2] * 1000,
+                    "p95": wall[int(len(wall) * 0.95)] * 1000, "max": wall[-1] * 1000},
+        "cpu_ms": {"mean": statistics.mean(timed["cpu"]) * 1000, "total": sum(timed["cpu"]) * 1000},
+        "alloc_kb": {"mean_peak": statistics.mean(traced["allocations"]) / 1024 if traced else None,
+                     "max_peak": max(traced["allocations"]) / 1024 if traced else None},
+        "car_commands": timed["car_commands"],
+        "egauge_requests": timed["egauge_requests"],
+        "mqtt_messages": timed["mqtt_messages"],
+    }
+
+
+def revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=BENCH_DIR, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, cwd=BENCH_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+# (label, path into a scenario summary), lower is better for all of them
+COMPARED = (("wall mean ms", ("wall_ms", "mean")), ("wall p95 ms", ("wall_ms", "p95")),
+            ("cpu mean ms", ("cpu_ms", "mean")), ("alloc peak kB", ("alloc_kb", "mean_peak")),
+            ("eGauge requests", ("egauge_requests",)), ("MQTT messages", ("mqtt_messages",)))
+
+
+def lookup(summary, path):
+    for key in path:
+        summary = summary.get(key) if isinstance(summary, dict) else None
+    return summary
+
+
+def compare(old, new):
+    print(f"Compared with {old['revision']} ({old['date']}):")
+    for name, summary in new["scenarios"].items():
+        previous = old["scenarios"].get(name)
+        if previous is None:
+            continue
+        print(f"  {name}")
+        for label, path in COMPARED:
+            before, after = lookup(previous, path), lookup(summary, path)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before * 100:+.1f} %" if before else ""
+            print(f"    {label:>16}: {before:10.2f} -> {after:10.2f}  {change}")
+
+
+def print_summary(name, summary):
+    wall, cpu, alloc = summary["wall_ms"], summary["cpu_ms"], summary["alloc_kb"]
+    print(f"{name}: {summary['iterations']} iterations")
+    print(f"       Wall time: mean {wall['mean']:.2f} ms, p50 {wall['p50']:.2f} ms, p95 {wall['p95']:.2f} ms, "
+          f"max {wall['max']:.2f} ms")
+    print(f"        CPU time: mean {cpu['mean']:.2f} ms")
+    if alloc["mean_peak"] is not None:
+        print(f"     Allocations: mean peak {alloc['mean_peak']:.1f} kB, max {alloc['max_peak']:.1f} kB")
+    print(f"    Car commands: {summary['car_commands']}")
+    print(f" eGauge requests: {summary['egauge_requests']}, MQTT messages: {summary['mqtt_messages']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the decision loop against local fakes")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append", help="Default all")
+    parser.add_argument("--iterations", type=int, default=300, help="Passes per scenario (default 300)")
+    parser.add_argument("--car", choices=("proxy", "ble"), default="proxy", help="Car interface (default proxy)")
+    parser.add_argument("--car-latency", type=float, default=0.0, help="Seconds per car command (default 0)")
+    parser.add_argument("--car-failures", type=float, default=0.0, help="Share of car commands failing (default 0)")
+    parser.add_argument("--egauge-latency", type=float, default=0.0, help="Seconds per eGauge request (default 0)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-allocations", action="store_true", help="Skip the tracemalloc run")
+    parser.add_argument("--output", help="Results file (default bench/results/<revision>.json)")
+    parser.add_argument("--compare", metavar="JSON", help="Earlier results to compare with")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = {"revision": revision(), "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "python": platform.python_version(), "machine": platform.machine(),
+               "settings": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+               "scenarios": {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        fakes = Fakes(args, workdir)
+        for name in args.scenario or SCENARIOS:
+            timed = asyncio.run(run_scenario(fakes, name, args, workdir))
+            traced = None if args.no_allocations else asyncio.run(run_scenario(fakes, name, args, workdir, True))
+            results["scenarios"][name] = summarize(timed, traced)
+            print_summary(name, results["scenarios"][name])
+
+    output = args.output or os.path.join(BENCH_DIR, "results", f"{results['revision']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as fp:
+        json.dump(results, fp, indent=2)
+    print(f"Results written to {output}")
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Compare TeslaBleHttpProxy round-trip latency with a new connection per command and with the pooled session
+
+Run from the PVCharge directory (routines.py reads config.toml on import):
+    python bench/bench_tesla_proxy.py [commands] [proxy url]
+Without a proxy url, the local stub in stub_tesla_proxy.py is started.
+"""
+import os
+import sys
+import time
+import statistics
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import requests
+import routines
+import stub_tesla_proxy
+
+
+def time_commands(url, count, session):
+    latencies = []
+    for amps in range(count):
+        start = time.perf_counter()
+        routines.call_http_post(url, {"charging_amps": 7 + amps % 5}, session=session)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    if len(sys.argv) > 2:
+        base_url = sys.argv[2]
+    else:
+        server, base_url = stub_tesla_proxy.start_proxy()
+    url = base_url + "/api/1/vehicles/BENCH/command/set_charging_amps"
+    results = {
+        "new connection": time_commands(url, count, requests),
+        "pooled session": time_commands(url, count, routines.create_http_session()),
+    }
+    for name, latencies in results.items():
+        latencies.sort()
+        print(f"{name:>15}: {count} commands, mean {statistics.mean(latencies) * 1000:.2f} ms, "
+              f"p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+"""Compare tesla-control command latency with and without the cached session worker
+
+Run from the PVCharge directory (routines.py reads config.toml on import):
+    python bench/bench_tesla_session.py [commands] [tesla-control binary]
+The fake binary in this directory is used by default, see fake_tesla_control.py for its latency settings.
+"""
+import os
+import sys
+import tempfile
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import routines
+
+
+def run_commands(session, count):
+    for amps in range(count):
+        session.run(['charging-set-amps', str(7 + amps % 5)])
+    return session.latency_report()["charging-set-amps"]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    binary = sys.argv[2] if len(sys.argv) > 2 else os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 "fake_tesla_control.py")
+    base_command = [binary, '-ble', '-key-file', 'bench.pem']
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {
+            "one process per command": run_commands(routines.TeslaSession(base_command), count),
+            "cached session worker": run_commands(routines.TeslaSession(base_command, os.path.join(tmp, "session.json")),
+                                                  count),
+        }
+    for name, (commands, mean, longest) in results.items():
+        print(f"{name:>24}: {commands} commands, mean {mean:.2f} s, max {longest:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Stand-in for tesla-control, simulating BLE connect, session handshake and command latency
+
+Behaviour is controlled through environment variables (seconds):
+    FAKE_TESLA_CONNECT    BLE scan and connect, paid by every invocation (default 0.5)
+    FAKE_TESLA_HANDSHAKE  Key handshake, skipped when -session-cache points to an existing file (default 2.0)
+    FAKE_TESLA_COMMAND    Command round trip (default 0.2)
+    FAKE_TESLA_ERROR      If set, fail with this text on stderr, i.e. "read/write on closed pipe"
+    FAKE_TESLA_FAIL_RATE  Probability of failing with FAKE_TESLA_ERROR (default 1.0 when the error is set)
+    FAKE_TESLA_STATE      If set, a file every successful command is appended to, i.e. "charging-set-amps 12",
+                          for a car model to follow
+"""
+import os
+import sys
+import time
+import random
+
+args = sys.argv[1:]
+cache_file = None
+if "-session-cache" in args:
+    cache_file = args[args.index("-session-cache") + 1]
+
+time.sleep(float(os.getenv("FAKE_TESLA_CONNECT", "0.5")))
+if cache_file is None or not os.path.exists(cache_file):
+    time.sleep(float(os.getenv("FAKE_TESLA_HANDSHAKE", "2.0")))
+    if cache_file is not None:
+        with open(cache_file, "w") as fp:
+            fp.write('{"session": "fake"}\n')
+time.sleep(float(os.getenv("FAKE_TESLA_COMMAND", "0.2")))
+
+error = os.getenv("FAKE_TESLA_ERROR", "")
+if error and random.random() < float(os.getenv("FAKE_TESLA_FAIL_RATE", "1.0")):
+    print(f"Error: {error}", file=sys.stderr)
+    sys.exit(1)
+
+state_file = os.getenv("FAKE_TESLA_STATE")
+if state_file:
+    command = []
+    index = 0
+    while index < len(args):
+        if args[index] in ("-key-file", "-vin", "-session-cache", "-domain"):
+            index += 2
+        elif args[index].startswith("-"):
+            index += 1
+        else:
+            command.append(args[index])
+            index += 1
+    with open(state_file, "a") as fp:
+        fp.write(" ".join(command) + "\n")
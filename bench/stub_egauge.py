@@ -0,0 +1,105 @@
+"""Local stand-in for the eGauge web API, answering the Register and Local queries PowerUsage makes
+
+The values come from a plant object with generation(), usage() (house, without the car), car_amps and voltage.
+Run standalone with:
+    python bench/stub_egauge.py [port] [generation W] [usage W] [car amps]
+then point EGDEV in .env at http://127.0.0.1:<port> (EGAUGE_GEN, EGAUGE_USE, EGAUGE_CHARGER and
+EGAUGE_CHARGER_SENSOR as in REGISTERS and the sensor name S1).
+"""
+import sys
+import json
+import time
+import random
+import threading
+import collections
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REGISTERS = ("Generation", "Usage", "Tesla Charger")
+
+
+class StaticPlant:
+    """Constant values, for running the stub by itself"""
+    def __init__(self, generation=5000.0, usage=1000.0, car_amps=0.0, voltage=240.0):
+        self._generation = generation
+        self._usage = usage
+        self.car_amps = car_amps
+        self.voltage = voltage
+
+    def generation(self):
+        return self._generation
+
+    def usage(self):
+        return self._usage
+
+
+class EgaugeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        started = time.thread_time()
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        server = self.server
+        server.requests[url.path] += 1
+        time.sleep(server.latency)
+        if random.random() < server.failure_rate:
+            self.reply(503, {"error": "stub failure"})
+        elif url.path == "/api/auth/rights":
+            self.reply(200, {"usr": "bench", "rights": ["view_settings"]})
+        elif url.path == "/api/register":
+            self.reply(200, self.register(query))
+        elif url.path == "/api/local":
+            self.reply(200, self.local())
+        else:
+            self.reply(404, {"error": "unknown resource"})
+        server.cpu += time.thread_time() - started
+
+    def register(self, query):
+        if "virtual" in query:    # Register info, fetched once per Device
+            return {"registers": [{"name": name, "type": "P", "idx": index} for index, name in enumerate(REGISTERS)]}
+        plant = self.server.plant
+        car = plant.car_amps * plant.voltage
+        rates = (plant.generation(), plant.usage() + car, car)
+        return {"ts": f"{time.time():.3f}",
+                "registers": [{"name": name, "type": "P", "idx": index, "did": index, "rate": rate}
+                              for index, (name, rate) in enumerate(zip(REGISTERS, rates))]}
+
+    def local(self):
+        plant = self.server.plant
+        return {"ts": f"{time.time():.3f}",
+                "values": {"L1": {"rate": {"n": plant.voltage / 2}}, "L2": {"rate": {"n": plant.voltage / 2}},
+                           "S1": {"rate": {"n": plant.car_amps}}}}
+
+    def reply(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_egauge(plant, port=0, latency=0.0, failure_rate=0.0):
+    """Start the stub in a background thread, returns (server, base url)"""
+    server = ThreadingHTTPServer(("127.0.0.1", port), EgaugeHandler)
+    server.daemon_threads = True
+    server.plant = plant
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.requests = collections.Counter()    # Path: requests
+    server.cpu = 0.0    # Thread CPU seconds spent answering
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    values = [float(value) for value in sys.argv[2:5]]
+    server, url = start_egauge(StaticPlant(*values), port)
+    print(f"Stub eGauge listening on {url}")
+    threading.Event().wait()
@@ -0,0 +1,202 @@
+"""Minimal in-process MQTT 3.1.1 broker, enough for paho clients: QoS 0/1, retained messages, wildcards, wills
+
+Run standalone with:
+    python bench/stub_mqtt_broker.py [port]
+then point BROKER and PORT in .env at 127.0.0.1:<port>
+"""
+import sys
+import time
+import socket
+import struct
+import threading
+import socketserver
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+
+def topic_matches(pattern, topic):
+    """MQTT topic filter match, + is one level, # the rest"""
+    parts = pattern.split("/")
+    levels = topic.split("/")
+    for index, part in enumerate(parts):
+        if part == "#":
+            return True
+        if index >= len(levels) or (part != "+" and part != levels[index]):
+            return False
+    return len(parts) == len(levels)
+
+
+def encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack("!H", len(data)) + data
+
+
+def packet(kind, flags, body):
+    return bytes([kind << 4 | flags]) + encode_length(len(body)) + body
+
+
+class Session:
+    """One client connection, packets are written under a lock since other connections publish to it"""
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.subscriptions = {}    # Topic filter: QoS
+        self.will = None
+        self.next_id = 0
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def deliver(self, topic, payload, qos, retain=False):
+        body = encode_string(topic)
+        if qos:
+            self.next_id = self.next_id % 65535 + 1
+            body += struct.pack("!H", self.next_id)
+        self.send(packet(PUBLISH, (qos << 1) | int(retain), body + payload))
+
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        broker = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = self.request.makefile("rb")
+        session = Session(broker, self.request)
+        clean = False
+        try:
+            while True:
+                header = stream.read(1)
+                if not header:
+                    break
+                length, multiplier = 0, 1
+                while True:
+                    byte = stream.read(1)[0]
+                    length += (byte & 0x7F) * multiplier
+                    multiplier *= 128
+                    if not byte & 0x80:
+                        break
+                body = stream.read(length)
+                started = time.thread_time()
+                kind, flags = header[0] >> 4, header[0] & 0x0F
+                if kind == DISCONNECT:
+                    clean = True
+                    break
+                self.dispatch(session, kind, flags, body)
+                broker.cpu += time.thread_time() - started
+        except (OSError, IndexError):
+            pass
+        finally:
+            with broker.lock:
+                if session in broker.sessions:
+                    broker.sessions.remove(session)
+            if session.will and not clean:
+                broker.route(*session.will)
+
+    def dispatch(self, session, kind, flags, body):
+        broker = self.server
+        if kind == CONNECT:
+            name_length = struct.unpack("!H", body[:2])[0]
+            offset = 2 + name_length + 1
+            connect_flags = body[offset]
+            offset += 3    # Flags and keep alive
+            offset += 2 + struct.unpack("!H", body[offset:offset + 2])[0]    # Client id
+            if connect_flags & 0x04:    # Will
+                topic_length = struct.unpack("!H", body[offset:offset + 2])[0]
+                topic = body[offset + 2:offset + 2 + topic_length].decode()
+                offset += 2 + topic_length
+                payload_length = struct.unpack("!H", body[offset:offset + 2])[0]
+                payload = body[offset + 2:offset + 2 + payload_length]
+                session.will = (topic, payload, (connect_flags >> 3) & 3, bool(connect_flags & 0x20))
+            with broker.lock:
+                broker.sessions.append(session)
+            session.send(packet(CONNACK, 0, b"\x00\x00"))
+        elif kind == PUBLISH:
+            qos = (flags >> 1) & 3
+            topic_length = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2 + topic_length].decode()
+            offset = 2 + topic_length
+            if qos:
+                session.send(packet(PUBACK, 0, body[offset:offset + 2]))
+                offset += 2
+            broker.route(topic, body[offset:], qos, bool(flags & 1))
+        elif kind == SUBSCRIBE:
+            packet_id, offset, granted = body[:2], 2, bytearray()
+            new = []
+            while offset < len(body):
+                topic_length = struct.unpack("!H", body[offset:offset + 2])[0]
+                pattern = body[offset + 2:offset + 2 + topic_length].decode()
+                qos = min(body[offset + 2 + topic_length], 1)
+                offset += 3 + topic_length
+                session.subscriptions[pattern] = qos
+                granted.append(qos)
+                new.append((pattern, qos))
+            session.send(packet(SUBACK, 0, packet_id + bytes(granted)))
+            with broker.lock:
+                retained = list(broker.retained.items())
+            for pattern, qos in new:
+                for topic, payload in retained:
+                    if topic_matches(pattern, topic):
+                        session.deliver(topic, payload, qos, retain=True)
+        elif kind == UNSUBSCRIBE:
+            offset = 2
+            while offset < len(body):
+                topic_length = struct.unpack("!H", body[offset:offset + 2])[0]
+                session.subscriptions.pop(body[offset + 2:offset + 2 + topic_length].decode(), None)
+                offset += 2 + topic_length
+            session.send(packet(UNSUBACK, 0, body[:2]))
+        elif kind == PINGREQ:
+            session.send(packet(PINGRESP, 0, b""))
+
+
+class Broker(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, BrokerHandler)
+        self.lock = threading.Lock()
+        self.sessions = []
+        self.retained = {}
+        self.messages = 0    # PUBLISH packets received
+        self.cpu = 0.0    # Thread CPU seconds spent handling packets
+
+    def route(self, topic, payload, qos, retain):
+        with self.lock:
+            self.messages += 1
+            if retain:
+                if payload:
+                    self.retained[topic] = payload
+                else:
+                    self.retained.pop(topic, None)
+            sessions = list(self.sessions)
+        for session in sessions:
+            matches = [sub_qos for pattern, sub_qos in session.subscriptions.items() if topic_matches(pattern, topic)]
+            if matches:
+                try:
+                    session.deliver(topic, payload, min(qos, max(matches)))
+                except OSError:
+                    pass
+
+
+def start_broker(port=0):
+    """Start the broker in a background thread, returns (broker, port)"""
+    broker = Broker(("127.0.0.1", port))
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    return broker, broker.server_address[1]
+
+
+if __name__ == "__main__":
+    broker, port = start_broker(int(sys.argv[1]) if len(sys.argv) > 1 else 1883)
+    print(f"Stub MQTT broker listening on 127.0.0.1:{port}")
+    threading.Event().wait()
@@ -0,0 +1,89 @@
+"""Local stand-in for the systemd notify socket, records sd_notify messages and enforces WatchdogSec like systemd
+
+Run a command under it with:
+    python bench/stub_notify_socket.py [watchdog seconds] -- python PVCharge.py
+It sets NOTIFY_SOCKET and WATCHDOG_USEC for the command, prints every message, and kills the command with SIGABRT
+(as systemd does) when no WATCHDOG=1 arrives within the watchdog period after READY=1.
+"""
+import os
+import sys
+import time
+import socket
+import signal
+import tempfile
+import threading
+import subprocess
+
+
+class NotifySocket:
+    """Datagram socket collecting (monotonic time, message) pairs"""
+    def __init__(self, path=None):
+        self.path = path or os.path.join(tempfile.mkdtemp(prefix="notify"), "notify.sock")
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(self.path)
+        self.messages = []
+        self.received = threading.Condition()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            data = self.socket.recv(4096)
+            with self.received:
+                for message in data.decode().splitlines():
+                    self.messages.append((time.monotonic(), message))
+                self.received.notify_all()
+
+    def environ(self, watchdog_seconds=None):
+        """Environment variables systemd would set for the service"""
+        environ = {"NOTIFY_SOCKET": self.path}
+        if watchdog_seconds:
+            environ["WATCHDOG_USEC"] = str(int(watchdog_seconds * 1e6))
+        return environ
+
+    def count(self, message):
+        with self.received:
+            return sum(1 for _, received in self.messages if received == message)
+
+    def last(self, message):
+        """Time message was last received, None if never"""
+        with self.received:
+            times = [at for at, received in self.messages if received == message]
+        return times[-1] if times else None
+
+    def wait_for(self, message, timeout):
+        """Wait until message has been received, returns True if it was"""
+        with self.received:
+            return self.received.wait_for(lambda: any(received == message for _, received in self.messages), timeout)
+
+    def close(self):
+        self.socket.close()
+        os.remove(self.path)
+
+
+def start_notify_socket(path=None):
+    """Start the socket in a background thread, returns it"""
+    return NotifySocket(path)
+
+
+if __name__ == "__main__":
+    separator = sys.argv.index("--") if "--" in sys.argv else len(sys.argv)
+    watchdog = float(sys.argv[1]) if separator > 1 else 30
+    command = sys.argv[separator + 1:]
+    if not command:
+        sys.exit(__doc__)
+    notify = start_notify_socket()
+    process = subprocess.Popen(command, env={**os.environ, **notify.environ(watchdog)})
+    seen = 0
+    while process.poll() is None:
+        time.sleep(0.5)
+        with notify.received:
+            new, seen = notify.messages[seen:], len(notify.messages)
+        for at, message in new:
+            print(f"{time.strftime('%H:%M:%S')} {message}", flush=True)
+        ready = notify.last("READY=1")
+        if ready is not None and time.monotonic() - (notify.last("WATCHDOG=1") or ready) > watchdog:
+            print(f"Watchdog timeout ({watchdog:.0f} seconds without WATCHDOG=1), killing", flush=True)
+            process.send_signal(signal.SIGABRT)
+            process.wait()
+    notify.close()
+    sys.exit(process.returncode)
@@ -0,0 +1,64 @@
+"""Local stand-in for TeslaBleHttpProxy, answering vehicle commands with a configurable delay and failure rate
+
+Run standalone with:
+    python bench/stub_tesla_proxy.py [port] [latency seconds] [failure rate]
+then point PROXY_HOST in .env at http://127.0.0.1:<port>
+"""
+import sys
+import json
+import time
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"    # Allow keep-alive connections
+    disable_nagle_algorithm = True    # Headers and body are written separately, don't let them wait on delayed ACKs
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        command = self.path.rsplit("/", 1)[-1]
+        self.server.commands.append(command)
+        time.sleep(self.server.latency)
+        if random.random() < self.server.failure_rate:
+            self.reply(503, {"response": None, "error": "vehicle busy"})
+        else:
+            if self.server.on_command is not None:
+                self.server.on_command(command, json.loads(body) if body else {})
+            self.reply(200, {"response": {"result": True, "reason": ""}})
+
+    def reply(self, code, body):
+        payload = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_proxy(port=0, latency=0.0, failure_rate=0.0, on_command=None):
+    """Start the stub in a background thread, returns (server, base url)
+
+    on_command(command, data) is called for every successful command, i.e. to drive a car model.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), ProxyHandler)
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.on_command = on_command
+    server.commands = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    failure_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+    server, url = start_proxy(port, latency, failure_rate)
+    print(f"Stub TeslaBleHttpProxy listening on {url}")
+    threading.Event().wait()
@@ -0,0 +1,53 @@
+import os
+import json
+import time
+import logging
+
+
+class Checkpoint:
+    """Class to keep controller and MQTT state in a JSON file, for a warm restart
+
+    The file is replaced atomically (write, fsync, rename), when the state changes or every CHECKPOINT_INTERVAL,
+    and is only restored if it is younger than CHECKPOINT_MAX_AGE.
+    """
+    def __init__(self, filename, interval=300, max_age=900):
+        self.filename = filename
+        self.interval = interval
+        self.max_age = max_age
+        self.last_state = None
+        self.last_save = 0
+
+    def load(self):
+        """Saved state, or None if there is no recent checkpoint"""
+        try:
+            with open(self.filename, encoding="utf-8") as fp:
+                checkpoint = json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring checkpoint %s: %s", self.filename, e)
+            return None
+        age = time.time() - checkpoint.get("saved", 0)
+        if not 0 <= age <= self.max_age:
+            logging.info("Checkpoint %s is %.0f seconds old, cold start", self.filename, age)
+            return None
+        logging.info("Warm start from checkpoint %s (%.0f seconds old)", self.filename, age)
+        return checkpoint["state"]
+
+    def save(self, state):
+        """Write state if it changed, or the last write is older than interval"""
+        now = time.time()
+        if state == self.last_state and now - self.last_save < self.interval:
+            return
+        temporary = f"{self.filename}.tmp"
+        try:
+            with open(temporary, "w", encoding="utf-8") as fp:
+                json.dump({"saved": now, "state": state}, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temporary, self.filename)
+        except OSError as e:
+            logging.warning("Failed to write checkpoint %s: %s", self.filename, e)
+            return
+        self.last_state = state
+        self.last_save = now
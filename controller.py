@@ -0,0 +1,360 @@
+import time
+import asyncio
+import logging
+import routines
+import metrics
+import tsstore
+import settings
+import decision
+from scheduler import CommandScheduler
+from polling import AdaptivePolling, Cadence
+from publisher import StatePublisher
+
+
+# Controller variables kept across a restart, the delay timers are wall clock times
+CHECKPOINT_FIELDS = ("car_is_charging", "stop_charging_time", "start_charging_time", "fast_polling")
+
+
+class ChargeController:
+    """Class to run the charge control loop as concurrent asyncio tasks"""
+    def __init__(self, config, energy, messages, car, clock=None, sampler=None, planner=None, checkpoint=None,
+                 watchdog=None):
+        self.config = config
+        self.energy = energy
+        self.messages = messages
+        self.car = car
+        self.clock = clock or SystemClock()    # Simulation replaces this with a virtual clock
+        # Control loop variables
+        self.car_is_charging = False
+        self.stop_charging_time = 0
+        self.start_charging_time = 0
+        self.charge_tesla = False
+        self.charge_delay = False
+        self.sun_up = False
+        self.fast_polling = True
+        self.last_step_time = 0
+        self.scheduled_interval = 0    # Sample interval the sampler chose after the sample of the last pass
+        self.vehicle = getattr(energy, "index", 0)    # Charger of this car, for the time-series store
+        # Coordination between tasks, several controllers may share one sampler (and eGauge)
+        self.sampler = sampler or EnergySampler(config, energy, self.clock)
+        self.sample_ready = self.sampler.subscribe(self)    # Set by the sampler after every new sample
+        self.wake = asyncio.Event()    # Set when an MQTT control topic changes while slow polling
+        self.scheduler = CommandScheduler(self)
+        self.planner = planner    # Optional forecast.ChargePlanner, may ask for more than the surplus
+        self.checkpoint = checkpoint    # Optional checkpoint.Checkpoint, saved after every pass
+        self.watchdog = watchdog    # Optional health.Watchdog, every pass must end within LOOP_DEADLINE
+        self.loop_name = f"Control loop {self.vehicle + 1}"
+        self.decision = None    # Outcome of the last pass
+        # Optional retained per-field state topics, with Home Assistant discovery
+        self.publisher = StatePublisher(config, messages.client) if config.get("TOPIC_STATE") else None
+
+    def get_state(self):
+        """Controller and MQTT state for a warm restart"""
+        return {"controller": {name: getattr(self, name) for name in CHECKPOINT_FIELDS},
+                "mqtt": self.messages.get_state()}
+
+    def restore_state(self, state):
+        """Continue where a previous run stopped, the MQTT state is restored by MqttCallbacks"""
+        for name in CHECKPOINT_FIELDS:
+            if name in state["controller"]:
+                setattr(self, name, state["controller"][name])
+
+    async def run(self):
+        """Run sampling, control and status reporting concurrently"""
+        await run_all([self])
+
+    def tasks(self):
+        return [self.control_task(), self.status_task(), self.scheduler.rate_task()]
+
+    async def control_task(self):
+        """Make a charging decision on every new sample (fast), every SLOW_POLLING (slow) or when woken by MQTT"""
+        loop = asyncio.get_running_loop()
+        self.messages.add_listener(lambda event: loop.call_soon_threadsafe(self.wake.set))
+        await self.sample_ready.wait()
+        while True:
+            self.sample_ready.clear()
+            self.wake.clear()
+            step_time = self.clock.time()
+            if self.fast_polling and self.last_step_time:
+                metrics.LOOP_JITTER.observe(max(step_time - self.last_step_time - self.scheduled_interval, 0))
+            self.last_step_time = step_time
+            self.scheduled_interval = self.sampler.interval    # Chosen before this pass was woken
+            if self.watchdog is not None:
+                self.watchdog.begin(self.loop_name)
+            fast_polling = await self.step(step_time)
+            metrics.LOOP_SECONDS.observe(self.clock.time() - step_time)
+            if fast_polling and not self.fast_polling:
+                self.sampler.poll_now.set()
+            self.fast_polling = fast_polling
+            if self.checkpoint is not None:
+                self.checkpoint.save(self.get_state())
+            if self.publisher is not None:
+                self.publisher.publish(self.state_fields())
+            if self.watchdog is not None:
+                self.watchdog.end(self.loop_name)
+            if fast_polling:
+                # Wait for the next sample, the sampler sets the pace
+                await wait_event(self.sample_ready, self.config["SLOW_POLLING"])
+            elif await wait_event(self.wake, self.sampler.polling.slow_interval(self.watch_car())):
+                logging.debug("Control topic changed, checking now")
+                self.sample_ready.clear()
+                self.sampler.poll_now.set()    # Decide on a fresh sample
+                await wait_event(self.sample_ready, self.config["SLOW_POLLING"])
+
+    def watch_car(self):
+        """True if the car must be checked while slow polling, so it does not charge from the grid"""
+        return bool(self.messages.var_topic_prevent_non_solar_charge)
+
+    async def status_task(self):
+        """Publish the status string every REPORT_DELAY, from the latest sample"""
+        await self.sample_ready.wait()
+        while True:
+            status = self.energy.status_report(self.charge_tesla, self.charge_delay, self.sun_up,
+                                               self.car_is_charging, new_sample=False)
+            logging.info(status)
+            logging.debug(self.scheduler.report())
+            if "TOPIC_METRICS" in self.config:
+                self.messages.client.publish(topic=self.config["TOPIC_METRICS"], payload=metrics.summary(), qos=0)
+            self.messages.client.publish(topic=self.config["TOPIC_STATUS"], payload=status, qos=1)
+            await self.clock.sleep(self.config["REPORT_DELAY"])
+
+    async def energy_call(self, func, *args, **kwargs):
+        return await self.sampler.energy_call(func, *args, **kwargs)
+
+    async def energy_wait(self, func, *args, **kwargs):
+        return await self.sampler.energy_wait(func, *args, **kwargs)
+
+    async def car_command(self, func, *args, **kwargs):
+        """Run a blocking car command in a worker thread, so sampling continues meanwhile"""
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def step(self, loop_time):
+        """One pass of the charge decision logic, returns True when fast polling is required"""
+        config = settings.snapshot(self.config)    # One config for the whole pass, even if it is reloaded meanwhile
+        Energy = self.energy
+        Messages = self.messages
+        # All blocking calls in this pass share one time budget
+        deadline = routines.Deadline(config.get("LOOP_BUDGET", 60))
+        # Check if we are allowed to charge
+        self.charge_tesla = Messages.calculate_charge_tesla()
+        self.sun_up = Energy.check_sun_up()
+        self.charge_delay = Messages.calculate_charge_delay(loop_time)
+        logging.debug("Current calculated charge enable: %s", self.charge_tesla)
+        logging.debug("                      Is Sun Up?: %s", self.sun_up)
+        logging.debug("Current prevent non_solar charge: %s", Messages.var_topic_prevent_non_solar_charge)
+        inputs = decision.Inputs(
+            loop_time, self.charge_tesla, self.sun_up, self.charge_delay, Messages.var_topic_prevent_non_solar_charge,
+            Energy.calculate_charge_rate(new_sample=False),
+            self.planned_rate(loop_time),    # Above the surplus only when the sun alone falls short
+            Energy.charge_rate_sensor, Messages.var_topic_teslamate_battery_level,
+            Messages.var_topic_teslamate_charge_limit_soc, Messages.var_topic_teslamate_state)
+        result = decision.decide(self.loop_state(), inputs, config)
+        self.set_loop_state(result.state)
+        self.log_decision(result, inputs, config)
+        if result.decision is not None:
+            self.record_decision(result.decision)
+        for action in result.actions:
+            await self.act(action, result, inputs, config, deadline)
+        return result.fast_polling
+
+    def loop_state(self):
+        return decision.LoopState(self.car_is_charging, self.start_charging_time, self.stop_charging_time)
+
+    def set_loop_state(self, state):
+        self.car_is_charging, self.start_charging_time, self.stop_charging_time = state
+
+    def log_decision(self, result, inputs, config):
+        name = result.decision
+        if name == "set_rate":
+            logging.debug("Car charging, new rate calculated: %s, current rate: %s", result.rate, round(inputs.charge_rate_sensor))
+        elif name == "reduce_to_min":
+            logging.debug("Car charging, Available Energy Reduced, requesting rate: %s", result.rate)
+        elif name == "stop_pending":
+            logging.info("Car charging, Available Energy Reduced, charging at min rate, stopping in: %s seconds", round(config['DELAYED_STOP_TIME'] - (inputs.time - result.state.stop_charging_time)))
+        elif name == "start_pending":
+            logging.info("Car is NOT charging, Energy is Available, starting in: %s seconds", round(config['DELAYED_START_TIME'] - (inputs.time - result.state.start_charging_time)))
+        elif name == "soc_full":
+            logging.info("Car will not charge with only 1% remaining, skipping")
+        elif name in ("slow_poll_stop", "slow_poll_wait"):
+            logging.debug("Slow poll wait, ensure car isn't charging")
+        elif name == "after_hours":
+            logging.debug("Slow poll wait, ignoring car charge")
+
+    async def act(self, action, result, inputs, config, deadline):
+        """Carry out one action of the decision, settling the loop state from the outcome of start and stop"""
+        Energy = self.energy
+        Car = self.car
+        if action == "request_rate":
+            # Queue the new charge rate, the scheduler applies deadband and rate limit, then verifies it
+            self.scheduler.request_rate(result.rate, round(inputs.charge_rate_sensor))
+
+        elif action == "stop":
+            success = await self.scheduler.command("stop_charging", Car.stop_charging, timeout=deadline.remaining(25)) == True
+            state, outcome = decision.stopped(self.loop_state(), success, Energy.charge_rate_sensor, config["MIN_CHARGE"])
+            self.set_loop_state(state)
+            if outcome == "stopped":
+                logging.info("Car charging, Available Energy Reduced, charging was successfully stopped")
+            elif outcome is None:
+                logging.info("Car charging was already stopped, resetting flags")
+            else:
+                logging.warning("Car charging, Available Energy Reduced, charging was NOT successfully stopped")
+            if outcome is not None:
+                self.record_decision(outcome)
+
+        elif action == "wake":    # Only when the car is asleep
+            if await self.scheduler.command("wake", Car.wake, timeout=deadline.remaining(25)):
+                logging.info("Car is NOT charging, Energy is Available, car woken successfully")
+                await self.clock.sleep(5)    # Wait until car is awake
+            else:
+                logging.warning("Car was NOT woken successfully")
+
+        elif action == "start":
+            success = await self.scheduler.command("start_charging", Car.start_charging, timeout=deadline.remaining(25)) == True
+            verified = False
+            if success:
+                logging.info("Car Started Charging Successfully")
+                # Wait until charging is fully started, as long as the car usually takes
+                verified = await self.energy_wait(Energy.verify_new_charge_rate, config["MIN_CHARGE"], timeout=deadline.remaining(20), kind="start")
+                if verified:
+                    logging.info("Charge Rate is greater than min charge")
+            else:
+                logging.warning("Car Charging NOT Started Successfully")
+            state, outcome = decision.started(self.loop_state(), success, verified)
+            self.set_loop_state(state)
+            self.record_decision(outcome)
+
+        elif action == "prevent_stop":    # Not enough sun, and after-hours charging is prevented
+            self.record_decision("prevented")
+            if await self.scheduler.command("stop_charging", Car.stop_charging, timeout=deadline.remaining(25)) == True:  # Stop if it is charging
+                logging.info("Fast poll, Car discovered charging and was stopped successfully")
+            else:
+                logging.warning("Fast poll, Car discovered charging and was NOT stopped successfully")
+
+        elif action == "reset_rate":
+            if inputs.battery_level == inputs.charge_limit_soc:
+                logging.info("Completed charge to: %s%% limit, stopping charge", inputs.charge_limit_soc)
+            await self.scheduler.command("set_charge_rate", Car.set_charge_rate, config["MIN_CHARGE"], timeout=deadline.remaining(25))    # Set charge rate to min charge, to reset for next time
+
+        elif action == "slow_stop":
+            if await self.scheduler.command("stop_charging", Car.stop_charging, timeout=deadline.remaining(25)) == True:     # Stop if it is charging
+                logging.info("Slow poll, Car discovered charging and was stopped successfully")
+                await self.clock.sleep(2)    # Delay to allow stop command to complete
+            else:
+                logging.warning("Slow poll, Car discovered charging and was NOT stopped successfully")
+            await self.energy_call(Energy.sample_sensor, timeout=deadline.remaining(10))    # Force sensor refresh to increase accuracy of subsequent loop
+
+    def planned_rate(self, loop_time):
+        """Charge rate the planner asks for now, 0 without a planner"""
+        if self.planner is None:
+            return 0
+        return self.planner.rate_at(loop_time, self.messages.var_topic_teslamate_battery_level,
+                                    self.messages.var_topic_teslamate_charge_limit_soc)
+
+    def state_fields(self):
+        """Published state, the eGauge values are those of the latest sample"""
+        snapshot = self.sampler.energy.snapshot
+        return {"enabled": self.charge_tesla, "charge_delay": self.charge_delay, "sun_up": self.sun_up,
+                "car_charging": self.car_is_charging, "charge_rate": self.energy.charge_rate_sensor,
+                "new_charge_rate": self.energy.new_charge_rate, "generation": snapshot.generation,
+                "usage": snapshot.usage, "decision": self.decision}
+
+    def record_decision(self, decision):
+        self.decision = decision
+        tsstore.record_decision(self.clock.time(), self.vehicle, decision, self.energy.new_charge_rate, self.energy.charge_rate_sensor)
+
+
+class EnergySampler:
+    """Task keeping the eGauge sample fresh, independently of car commands, for one or more controllers"""
+    def __init__(self, config, energy, clock=None, forecast=None, watchdog=None):
+        self.config = config
+        self.energy = energy
+        self.clock = clock or SystemClock()
+        self.polling = AdaptivePolling(config, energy, self.clock)
+        self.cadence = Cadence(self.clock)    # Samples on a fixed schedule, whatever the eGauge latency
+        self.forecast = forecast    # Optional forecast.SurplusForecast, updated with every sample
+        self.watchdog = watchdog    # Optional health.Watchdog, every sample must be taken within LOOP_DEADLINE
+        self.controllers = []
+        self.sample_ready = []    # One event per controller
+        self.interval = 0    # Seconds until the next sample, as scheduled after the last one
+        self.poll_now = asyncio.Event()    # Wakes the sampler early when a controller switches to fast polling
+
+    def subscribe(self, controller):
+        """Return the event set after every new sample for controller"""
+        self.controllers.append(controller)
+        self.sample_ready.append(asyncio.Event())
+        return self.sample_ready[-1]
+
+    async def run(self):
+        self.cadence.restart()
+        while True:
+            if self.watchdog is not None:
+                self.watchdog.begin("Sampling loop")
+            sampled = await self.energy_call(self.sample)
+            if sampled and self.forecast is not None:
+                snapshot = self.energy.snapshot
+                self.forecast.update(self.clock.time(), snapshot.generation - (snapshot.usage - snapshot.tesla_charger))
+            if self.watchdog is not None:
+                self.watchdog.end("Sampling loop")
+            if sampled:    # A failed read leaves the controllers waiting for the next sample
+                for event in self.sample_ready:
+                    event.set()
+            if any(controller.fast_polling for controller in self.controllers):
+                interval = self.polling.fast_interval(any(controller.car_is_charging for controller in self.controllers))
+            else:
+                interval = 0
+                if not any(controller.watch_car() for controller in self.controllers):
+                    interval = self.polling.night_remaining()
+                # Keep samples fresh enough for the status report while slow polling
+                interval = interval or min(self.config["SLOW_POLLING"], self.config["REPORT_DELAY"])
+            self.interval = interval
+            self.poll_now.clear()
+            if await wait_event(self.poll_now, self.cadence.wait(interval)):
+                self.cadence.restart()    # Woken early, the schedule starts over from now
+
+    def sample(self):
+        """New eGauge sample and charge rate, returns False if the read failed"""
+        if not self.energy.refresh_snapshot(timeout=30):
+            return False
+        self.energy.calculate_charge_rate(False)
+        return True
+
+    async def energy_call(self, func, *args, **kwargs):
+        """Run a blocking eGauge call in a worker thread, one at a time (under the energy lock)"""
+        return await asyncio.to_thread(self.locked, func, *args, **kwargs)
+
+    async def energy_wait(self, func, *args, **kwargs):
+        """Run a blocking eGauge wait in a worker thread, func takes the energy lock for each of its reads"""
+        return await asyncio.to_thread(func, *args, **kwargs)
+
+    def locked(self, func, *args, **kwargs):
+        with self.energy.lock:
+            return func(*args, **kwargs)
+
+
+async def run_all(controllers, watchdog=None):
+    """Run the controllers of all vehicles and their samplers concurrently, each car has its own command queue"""
+    samplers = []
+    for controller in controllers:
+        if controller.sampler not in samplers:
+            samplers.append(controller.sampler)
+    await asyncio.gather(*[sampler.run() for sampler in samplers],
+                         *[task for controller in controllers for task in controller.tasks()],
+                         *([watchdog.run()] if watchdog is not None else []))
+
+
+class SystemClock:
+    """Wall clock time and sleeps for the controller"""
+    def time(self):
+        return time.time()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+async def wait_event(event, timeout):
+    """Wait until event is set or timeout expires, returns True if the event was set"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
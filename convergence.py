@@ -0,0 +1,78 @@
+import time
+import logging
+
+
+class ConvergenceDetector:
+    """Class to wait for the charger current to settle at a new target, learning how long the car takes
+
+    The expected settle time is a recency weighted mean of past changes, in seconds per amp of change (plus a
+    separate estimate for starting to charge, which includes the car's start delay).  The first read after a
+    change waits for most of the expected time, later reads follow at poll intervals, and once enough changes are
+    learned, a change that has not settled by twice the expected time is reported as failed without using the
+    whole timeout.  Such a miss raises the estimate and waits the whole timeout again until enough changes are seen.
+    """
+    def __init__(self, tolerance=0.5, poll=0.5, learn_after=3, alpha=0.3, sleep=time.sleep, now=time.monotonic):
+        self.tolerance = tolerance    # Amps
+        self.poll = poll    # Seconds between reads once the expected time has passed
+        self.learn_after = learn_after    # Changes seen before giving up early
+        self.alpha = alpha
+        self.sleep = sleep
+        self.now = now
+        self.models = {}    # (charger, kind): [seconds per amp, changes seen]
+
+    def expected(self, charger, kind, change):
+        """Expected seconds for a change of change amps, None until one has been seen"""
+        model = self.models.get((charger, kind))
+        if model is None:
+            return None
+        return model[0] * max(change, 1)
+
+    def learn(self, charger, kind, change, seconds):
+        per_amp = seconds / max(change, 1)
+        model = self.models.get((charger, kind))
+        if model is None:
+            self.models[(charger, kind)] = [per_amp, 1]
+        else:
+            model[0] += self.alpha * (per_amp - model[0])
+            model[1] += 1
+
+    def missed(self, charger, kind, change, seconds):
+        """Learn from a change given up on after seconds (a lower bound), the next changes use the whole timeout"""
+        self.learn(charger, kind, change, seconds)
+        self.models[(charger, kind)][1] = 0
+
+    def give_up_after(self, charger, kind, change, timeout):
+        model = self.models.get((charger, kind))
+        if model is None or model[1] < self.learn_after:
+            return timeout
+        return min(timeout, 2 * self.expected(charger, kind, change) + 2 * self.poll)
+
+    def wait(self, read, target, timeout, charger=0, kind="rate"):
+        """Read the current (A, None on a failed read) until it is within tolerance of target, returns True if so"""
+        started = self.now()
+        current = read()
+        if current is not None and abs(current - target) <= self.tolerance:
+            return True
+        change = abs(target - current) if current is not None else target
+        expected = self.expected(charger, kind, change)
+        give_up = self.give_up_after(charger, kind, change, timeout)
+        wait = 0.75 * expected if expected is not None else self.poll    # Skip reads the car can't have settled by
+        reads = 1
+        while True:
+            elapsed = self.now() - started
+            wait = min(wait, give_up - elapsed)
+            if wait <= 0:
+                logging.debug("Charge current %s A did not settle at %s A within %.1f seconds (%s reads, expected %s)",
+                              current, target, elapsed, reads, expected and round(expected, 1))
+                if give_up < timeout:    # Gave up early, the car may have become slower
+                    self.missed(charger, kind, change, elapsed)
+                return False
+            self.sleep(wait)
+            current = read()
+            reads += 1
+            if current is not None and abs(current - target) <= self.tolerance:
+                seconds = self.now() - started
+                self.learn(charger, kind, change, seconds)
+                logging.debug("Charge current settled at %s A in %.1f seconds (%s reads)", target, seconds, reads)
+                return True
+            wait = self.poll
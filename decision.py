@@ -0,0 +1,105 @@
+"""Charge decision of one control loop pass, as a function of its inputs, free of I/O and side effects
+
+ChargeController.step() gathers the inputs, calls decide() and carries out the returned actions, then settles the
+state with stopped() or started() from the command outcomes.  tuner.py replays recorded days through the same
+functions.
+"""
+import math
+import collections
+
+# Carried from one pass to the next, the timers are loop times (0 when not running)
+LoopState = collections.namedtuple("LoopState", ["car_is_charging", "start_charging_time", "stop_charging_time"])
+
+# What one pass sees, charge rates in amps, charge_rate is the rate the surplus allows
+Inputs = collections.namedtuple("Inputs", ["time", "charge_tesla", "sun_up", "charge_delay", "prevent_non_solar_charge",
+                                           "charge_rate", "planned_rate", "charge_rate_sensor", "battery_level",
+                                           "charge_limit_soc", "car_state"])
+
+# Decision to record (None until a command outcome decides it), car actions in order, the rate they ask for,
+# whether to keep fast polling, and the state after the pass
+Decision = collections.namedtuple("Decision", ["decision", "actions", "rate", "fast_polling", "state"])
+
+# Actions: request_rate (queue rate), stop (delayed stop), wake, start, prevent_stop (stop a non-solar charge),
+# reset_rate (set MIN_CHARGE for next time), slow_stop (stop while slow polling)
+WAKE_STATES = ("asleep", "suspended", "offline")    # Car states that need a wake before start_charging
+
+
+def decide(state, inputs, config):
+    """Decision of one pass from the loop state, the inputs and the config (MIN_CHARGE and the delays)"""
+    min_charge = config["MIN_CHARGE"]
+    # Use round() on charge_rate_sensor to prevent constant requests when on the edge of a value
+    charge_rate_sensor = round(inputs.charge_rate_sensor)
+    # A planned top-up draws from the grid, so it only counts while non-solar charging is allowed
+    planned_rate = 0 if inputs.prevent_non_solar_charge else inputs.planned_rate
+    # Use math.floor() on the charge rate to ensure we are always just "under" the available PV generation capacity
+    sufficient = math.floor(inputs.charge_rate) >= min_charge or planned_rate >= min_charge
+
+    if inputs.charge_tesla and inputs.sun_up and not inputs.charge_delay:    # If we are allowed to charge
+        if state.car_is_charging:
+            if sufficient:
+                state = state._replace(stop_charging_time=0)
+                rate = max(math.floor(inputs.charge_rate), math.floor(planned_rate))
+                if charge_rate_sensor != 0:
+                    return Decision("set_rate", ("request_rate",), rate, True, state)
+                return Decision(None, (), rate, True, state)
+            if charge_rate_sensor > min_charge:    # Not enough sun, drop to min charge first
+                return Decision("reduce_to_min", ("request_rate",), min_charge, True, state)
+            # Already at min charge, wait the configured time before stopping
+            waited, stop_charging_time = check_elapsed_time(inputs.time, state.stop_charging_time,
+                                                            config["DELAYED_STOP_TIME"])
+            state = state._replace(stop_charging_time=stop_charging_time)
+            if waited:
+                return Decision(None, ("stop",), None, True, state)
+            return Decision("stop_pending", (), None, True, state)
+
+        if not sufficient:    # Sun isn't generating enough power to charge
+            actions = ("prevent_stop",) if inputs.prevent_non_solar_charge and charge_rate_sensor >= min_charge else ()
+            return Decision("insufficient", actions, None, True, state._replace(start_charging_time=0))
+        if charge_rate_sensor >= min_charge:    # Car is already charging, set the flag
+            return Decision("already_charging", (), None, True,
+                            state._replace(car_is_charging=True, start_charging_time=0))
+        if inputs.charge_limit_soc - inputs.battery_level <= 1:    # Only charge for at least 1%
+            return Decision("soc_full", (), None, True, state)
+        # Wait the configured time before starting
+        waited, start_charging_time = check_elapsed_time(inputs.time, state.start_charging_time,
+                                                         config["DELAYED_START_TIME"])
+        state = state._replace(start_charging_time=start_charging_time)
+        if waited:
+            actions = ("wake", "start") if inputs.car_state in WAKE_STATES else ("start",)
+            return Decision(None, actions, min_charge, True, state)
+        return Decision("start_pending", (), None, True, state)
+
+    if inputs.charge_delay or inputs.prevent_non_solar_charge:
+        # Reset the rate for next time, always clear the flag, the actual charge rate is used to stop
+        actions = ("reset_rate",) if state.car_is_charging else ()
+        state = state._replace(car_is_charging=False)
+        if charge_rate_sensor >= min_charge:
+            return Decision("slow_poll_stop", actions + ("slow_stop",), min_charge, True, state)
+        return Decision("slow_poll_wait", actions, min_charge, False, state)
+
+    return Decision("after_hours", (), None, False, state)    # Charging after sundown is allowed
+
+
+def stopped(state, success, charge_rate_sensor, min_charge):
+    """State and decision after the delayed stop command, no decision if charging had already stopped"""
+    if success:
+        return state._replace(car_is_charging=False, stop_charging_time=0), "stopped"
+    if round(charge_rate_sensor) < min_charge:    # Stop fails when charging has already stopped
+        return state._replace(car_is_charging=False, stop_charging_time=0), None
+    return state, "stop_failed"
+
+
+def started(state, success, verified):
+    """State and decision after start_charging, charging counts once the rate has been verified"""
+    if not success:
+        return state, "start_failed"
+    if verified:
+        state = state._replace(car_is_charging=True, start_charging_time=0)
+    return state, "started"
+
+
+def check_elapsed_time(loop_time, compare_time, wait_time):
+    """(waited long enough, timer), the timer starts at loop_time when it isn't running"""
+    if compare_time == 0:
+        return False, loop_time
+    return (loop_time - compare_time) >= wait_time, compare_time
@@ -0,0 +1,166 @@
+"""Day-ahead surplus forecast from the recorded history, and a charge planner built on it
+
+The forecast is a profile of the solar surplus (W) per time-of-day slot: a recency weighted mean over the last
+FORECAST_DAYS of samples (or backfilled registers) in DATA_DIR, scaled by how today compares so far.  New samples update it incrementally.
+The planner picks an amp target per slot for the rest of the day that reaches charge_limit_soc by CHARGE_DEADLINE,
+using the sunniest slots first and the grid only for what the sun cannot cover.
+"""
+import os
+import time
+import logging
+import datetime
+import collections
+import numpy as np
+import tsstore
+
+SAMPLE_DTYPE = np.dtype([("time", "<f8"), ("generation", "<f4"), ("usage", "<f4"), ("tesla_charger", "<f4"),
+                         ("charge_rate", "<f4"), ("charger_voltage", "<f4")])
+REGISTER_DTYPE = np.dtype([("time", "<f8"), ("generation", "<f4"), ("usage", "<f4"), ("tesla_charger", "<f4")])
+
+Plan = collections.namedtuple("Plan", ["start", "amps", "surplus", "solar_fraction", "solar_only", "reachable"])
+
+
+class SurplusForecast:
+    """Intraday surplus profile, one value per slot, from past days and today's samples"""
+    def __init__(self, slot=900, days=14, decay=0.85):
+        self.slot = slot
+        self.slots = 86400 // slot
+        self.history = np.full((days, self.slots), np.nan)    # Mean surplus per slot of past days, oldest first
+        self.weights = decay ** np.arange(days - 1, -1, -1)    # Yesterday weighs most
+        self.day = None
+        self.midnight = 0
+        self.sums = np.zeros(self.slots)
+        self.counts = np.zeros(self.slots)
+
+    def load(self, directory, today=None):
+        """Fill the history from the sample files of the days before today"""
+        today = today or datetime.date.today()
+        for age in range(len(self.history), 0, -1):
+            day = today - datetime.timedelta(days=age)
+            for kind, dtype in (("samples", SAMPLE_DTYPE), ("registers", REGISTER_DTYPE)):    # Live, else backfilled
+                filename = tsstore.day_file(directory, day, kind)
+                if os.path.exists(filename) and os.path.getsize(filename) > tsstore.HEADER.size + dtype.itemsize:
+                    samples = np.memmap(filename, dtype=dtype, mode="r", offset=tsstore.HEADER.size,
+                                        shape=((os.path.getsize(filename) - tsstore.HEADER.size) // dtype.itemsize,))
+                    self.history[-age] = self.slot_means(day, samples["time"], surplus_of(samples))
+                    break
+        logging.info("Surplus forecast from %s days of history", self.known_days())
+
+    def known_days(self):
+        return int(np.count_nonzero(~np.isnan(self.history).all(axis=1)))
+
+    def slot_means(self, day, times, surplus):
+        """Mean surplus per slot of one day, NaN where there are no samples"""
+        index = self.slot_index(day, times)
+        counts = np.bincount(index, minlength=self.slots)
+        sums = np.bincount(index, weights=surplus, minlength=self.slots)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(counts > 0, sums / counts, np.nan)
+
+    def slot_index(self, day, times):
+        midnight = time.mktime(day.timetuple())
+        return np.clip(((np.asarray(times) - midnight) // self.slot).astype(int), 0, self.slots - 1)
+
+    def update(self, timestamp, surplus):
+        """Add one sample of today, a new day moves today's slots into the history"""
+        day = datetime.date.fromtimestamp(timestamp)
+        if day != self.day:
+            if self.day is not None:
+                self.history = np.roll(self.history, -1, axis=0)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    self.history[-1] = np.where(self.counts > 0, self.sums / self.counts, np.nan)
+            self.day = day
+            self.midnight = time.mktime(day.timetuple())
+            self.sums[:] = 0
+            self.counts[:] = 0
+        index = min(int((timestamp - self.midnight) // self.slot), self.slots - 1)
+        self.sums[index] += surplus
+        self.counts[index] += 1
+
+    def profile(self):
+        """Forecast surplus (W) per slot of today, measured values for the slots already seen"""
+        known = ~np.isnan(self.history)
+        weights = np.where(known, self.weights[:, None], 0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            baseline = np.nansum(self.history * weights, axis=0) / weights.sum(axis=0)
+            today = np.where(self.counts > 0, self.sums / self.counts, np.nan)
+        baseline = np.nan_to_num(baseline)
+        seen = self.counts > 0
+        # Scale the rest of the day by how today compares with the baseline so far (clouds, season),
+        # shrunk toward 1 while only a small part of the day has been seen
+        prior = 0.1 * baseline.clip(min=0).sum()
+        expected = baseline[seen].clip(min=0).sum() + prior
+        ratio = np.clip((today[seen].clip(min=0).sum() + prior) / expected, 0.2, 1.5) if expected > 0 else 1.0
+        return np.where(seen, today, baseline * ratio)
+
+
+class ChargePlanner:
+    """Class to plan charge rates per slot toward the SOC target, from the surplus forecast"""
+    def __init__(self, config, forecast):
+        self.config = config
+        self.forecast = forecast
+        self.voltage = config.get("PLAN_VOLTAGE", 240)
+        self.capacity = config.get("BATTERY_KWH", 75)
+        hour, minute = (int(part) for part in config.get("CHARGE_DEADLINE", "18:00").split(":"))
+        self.deadline = hour * 3600 + minute * 60    # Seconds after midnight
+        self.plan = None
+        self.plan_key = None
+
+    @property
+    def min_charge(self):
+        return self.config["MIN_CHARGE"]
+
+    @property
+    def max_charge(self):
+        return self.config.get("MAX_CHARGE", 32)
+
+    def make_plan(self, now, soc, target_soc):
+        """Amps per slot from now until the deadline"""
+        forecast = self.forecast
+        start = int((now - forecast.midnight) // forecast.slot)
+        end = max(min(self.deadline // forecast.slot, forecast.slots), start + 1)
+        surplus = forecast.profile()[start:end].clip(min=0) / self.voltage    # Amps
+        slot_hours = forecast.slot / 3600
+        needed = max(target_soc - soc, 0) / 100 * self.capacity * 1000 / self.voltage / slot_hours    # Amp-slots
+        # Solar only first, every slot where the surplus reaches the minimum charge rate
+        amps = np.where(surplus >= self.min_charge, np.minimum(surplus, self.max_charge), 0.0)
+        deficit = needed - amps.sum()
+        solar_only = deficit <= 0
+        if not solar_only:
+            # Top up from the grid in the sunniest slots, where the sun still covers most of the charge
+            for index in np.argsort(-surplus, kind="stable"):
+                if deficit <= 0:
+                    break
+                raised = min(max(amps[index] + deficit, self.min_charge), self.max_charge)
+                deficit -= raised - amps[index]
+                amps[index] = raised
+        else:
+            # More sun than needed, charge in the earliest slots until the target is reached
+            cumulative = np.cumsum(amps)
+            amps = np.where(cumulative - amps < needed, np.minimum(amps, needed - (cumulative - amps)), 0.0)
+            amps = np.where(amps >= self.min_charge, amps, 0.0)
+        total = amps.sum()
+        solar_fraction = float(np.minimum(amps, surplus).sum() / total) if total else 1.0
+        return Plan(start, amps, surplus, solar_fraction, bool(solar_only), bool(deficit <= 0))
+
+    def rate_at(self, now, soc, target_soc):
+        """Planned charge rate (A) for now, replanned when the slot or the battery level changes"""
+        if self.forecast.day is None or not self.forecast.known_days():
+            return 0    # Nothing to plan from yet, charge from the surplus only
+        slot = int((now - self.forecast.midnight) // self.forecast.slot)
+        key = (self.forecast.day, slot, soc, target_soc)
+        if key != self.plan_key:
+            self.plan = self.make_plan(now, soc, target_soc)
+            self.plan_key = key
+            logging.debug("Charge plan: %.0f Ah, solar fraction %.2f, reachable: %s",
+                          self.plan.amps.sum() * self.forecast.slot / 3600, self.plan.solar_fraction, self.plan.reachable)
+        index = slot - self.plan.start
+        if self.plan.solar_only:
+            return 0    # The surplus gets there by itself, follow it rather than the forecast
+        if index < 0 or index >= len(self.plan.amps):
+            return 0
+        return float(self.plan.amps[index])
+
+
+def surplus_of(samples):
+    return samples["generation"] - (samples["usage"] - samples["tesla_charger"])
@@ -0,0 +1,121 @@
+"""systemd readiness and watchdog notifications, and recovery from a hung loop before systemd steps in
+
+With Type=notify and WatchdogSec in PVCharge.service, systemd restarts PVCharge when the watchdog pings stop.
+They are sent only while every loop (eGauge sampling, and the control pass of each car) finishes its iterations
+within LOOP_DEADLINE, by default LOOP_BUDGET plus the deliberate waits of a pass.  An iteration running past it
+first gets an in-process recovery (a new eGauge connection and car session), the pings resume as soon as an
+iteration completes in time again.
+
+Without NOTIFY_SOCKET (not started by systemd) nothing is sent, the recovery still applies.
+"""
+import os
+import time
+import socket
+import asyncio
+import logging
+import metrics
+
+# Deliberate waits a control pass adds to LOOP_BUDGET: a rate command still in flight (25 seconds) and the back-off
+# after a not_charging stop (60 seconds)
+PASS_DELAYS = 90
+
+
+class SystemdNotifier:
+    """Class to send sd_notify() messages to the NOTIFY_SOCKET datagram socket, without libsystemd"""
+    def __init__(self, environ=None):
+        environ = os.environ if environ is None else environ
+        address = environ.get("NOTIFY_SOCKET")
+        if address and address.startswith("@"):    # Abstract namespace
+            address = "\0" + address[1:]
+        self.address = address
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) if address else None
+        # Watchdog period, unless WATCHDOG_PID names another process (i.e. a helper started by PVCharge)
+        usec = environ.get("WATCHDOG_USEC")
+        pid = environ.get("WATCHDOG_PID")
+        self.watchdog_seconds = int(usec) / 1e6 if usec and (not pid or int(pid) == os.getpid()) else None
+
+    def notify(self, state):
+        """Send state (i.e. "READY=1"), returns True if it was sent"""
+        if self.socket is None:
+            return False
+        try:
+            self.socket.sendto(state.encode(), self.address)
+            return True
+        except OSError as e:
+            logging.warning("sd_notify %s failed: %s", state.split("=")[0], e)
+            return False
+
+
+class Watchdog:
+    """Class to ping the systemd watchdog while the loops keep to their deadlines
+
+    Each loop marks its iterations with begin() and end().  An iteration still running after LOOP_DEADLINE stops
+    the pings and calls recover(loop) once, an iteration that ended late keeps them off until the next one of
+    that loop ends in time.
+    """
+    def __init__(self, config, notifier, recover=None, clock=time.monotonic):
+        self.config = config
+        self.notifier = notifier
+        self.recover = recover
+        self.clock = clock
+        self.running = {}    # Loop: start of the iteration in progress
+        self.late = set()    # Loops whose last iteration ended past the deadline
+        self.recovered = set()    # Loops recovered since their last iteration in time
+        self.pings = 0
+
+    # Read on use, so a config reload applies at once
+    @property
+    def deadline(self):
+        return self.config.get("LOOP_DEADLINE", self.config.get("LOOP_BUDGET", 60) + PASS_DELAYS)
+
+    @property
+    def interval(self):
+        """Seconds between checks, half the systemd watchdog period (as sd_watchdog_enabled() advises)"""
+        if self.notifier.watchdog_seconds:
+            return min(self.notifier.watchdog_seconds / 2, 10)
+        return 10
+
+    def begin(self, loop):
+        self.running[loop] = self.clock()
+
+    def end(self, loop):
+        started = self.running.pop(loop, None)
+        if started is None:
+            return
+        elapsed = self.clock() - started
+        if elapsed > self.deadline:
+            logging.warning("%s iteration took %.0f seconds, past its %.0f second deadline", loop, elapsed, self.deadline)
+            self.late.add(loop)
+        else:
+            if loop in self.late or loop in self.recovered:
+                logging.info("%s is back within its deadline", loop)
+                self.notifier.notify("STATUS=Running")
+            self.late.discard(loop)
+            self.recovered.discard(loop)
+
+    def hung(self):
+        """Loops with an iteration running past the deadline"""
+        now = self.clock()
+        return [loop for loop, started in self.running.items() if now - started > self.deadline]
+
+    def check(self):
+        """Ping the watchdog if every loop is on time, else recover newly hung loops, returns True after a ping"""
+        hung = self.hung()
+        for loop in hung:
+            if loop not in self.recovered:
+                self.recovered.add(loop)
+                metrics.LOOP_HANGS.inc(loop=loop)
+                logging.error("%s iteration running for over %.0f seconds, recovering", loop, self.deadline)
+                self.notifier.notify(f"STATUS=Recovering {loop}")
+                if self.recover is not None:
+                    self.recover(loop)
+        if hung or self.late:
+            return False
+        self.pings += self.notifier.notify("WATCHDOG=1")
+        return True
+
+    async def run(self):
+        self.notifier.notify("READY=1")
+        while True:
+            self.check()
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,128 @@
+"""Logging for PVCharge, records are queued on the hot path and written by a background thread
+
+- Messages use %-style arguments, so they are only formatted if they are written
+- The log file is written in blocks, every LOG_FLUSH_INTERVAL seconds or at once for a warning, and rotated at
+  LOG_MAX_BYTES
+- With LOG_LEVEL INFO, the last DEBUG_RING debug records are kept in memory, and written ahead of any warning
+"""
+import time
+import queue
+import atexit
+import logging
+import collections
+import logging.handlers
+
+FORMAT = '%(asctime)s %(levelname)s %(module)s - %(funcName)s: %(message)s'
+DATEFMT = '%Y-%m-%d %H:%M:%S'
+LIBRARIES = ("urllib3", "requests", "paho", "egauge", "asyncio")    # Loggers kept at LOG_LEVEL with a DEBUG_RING
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that leaves formatting to the listener thread"""
+    def prepare(self, record):
+        return record
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """RotatingFileHandler that flushes in blocks instead of after every record
+
+    The file size is counted here, RotatingFileHandler.shouldRollover() seeks the stream to find it, and the seek
+    writes out the buffer with every record.
+    """
+    def __init__(self, filename, max_bytes, backup_count, flush_interval, buffer_size=65536):
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.last_flush = time.monotonic()
+        self.force_flush = False
+        self.size = 0    # Bytes in the file, written or buffered
+        self.record_size = 0    # Bytes of the record being emitted
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+
+    def _open(self):
+        stream = open(self.baseFilename, self.mode, buffering=self.buffer_size, encoding=self.encoding)
+        self.size = stream.seek(0, 2)    # Appending to the file left by an earlier run
+        return stream
+
+    def shouldRollover(self, record):
+        if self.maxBytes <= 0:
+            return False
+        self.record_size = len(f"{self.format(record)}{self.terminator}".encode(self.encoding))
+        return self.size > 0 and self.size + self.record_size >= self.maxBytes
+
+    def emit(self, record):
+        self.force_flush = record.levelno >= logging.WARNING
+        super().emit(record)
+        self.size += self.record_size
+
+    def flush(self):
+        """Called by StreamHandler after every record, only flush when a block is due"""
+        if self.force_flush or time.monotonic() - self.last_flush >= self.flush_interval:
+            super().flush()
+            self.last_flush = time.monotonic()
+            self.force_flush = False
+
+    def close(self):
+        self.force_flush = True
+        self.flush()
+        super().close()
+
+
+class DebugRingHandler(logging.Handler):
+    """Keeps recent records below the log level, and passes them to target when a warning comes along"""
+    def __init__(self, target, level, size):
+        super().__init__(logging.DEBUG)
+        self.target = target
+        self.write_level = level
+        self.ring = collections.deque(maxlen=size)
+
+    def emit(self, record):
+        if record.levelno < self.write_level:
+            self.ring.append(record)
+            return
+        if record.levelno >= logging.WARNING and self.ring:
+            self.target.handle(logging.makeLogRecord({"msg": f"--- {len(self.ring)} recent debug records ---",
+                                                      "levelno": logging.INFO, "levelname": "INFO",
+                                                      "module": __name__, "funcName": "dump",
+                                                      "created": self.ring[0].created}))
+            for old in self.ring:
+                self.target.handle(old)
+            self.ring.clear()
+        self.target.handle(record)
+
+
+STOP = []    # Called once, in order, by shutdown()
+
+
+def shutdown():
+    """Write out the log, at exit or when PVCharge is stopped, records logged later are dropped"""
+    while STOP:
+        STOP.pop(0)()
+
+
+def setup_logging(config):
+    """Log through a queue to the rotating LOG_FILE, returns the listener (stopped by shutdown())"""
+    level = {"INFO": logging.INFO, "DEBUG": logging.DEBUG}.get(config["LOG_LEVEL"], logging.INFO)
+    file_handler = BufferedRotatingFileHandler(config["LOG_FILE"], config.get("LOG_MAX_BYTES", 1000000),
+                                               config.get("LOG_BACKUPS", 3), config.get("LOG_FLUSH_INTERVAL", 30))
+    file_handler.setFormatter(logging.Formatter(FORMAT, DATEFMT))
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    root_level = level
+    ring_size = config.get("DEBUG_RING", 500)
+    if ring_size and level > logging.DEBUG:
+        # Debug records stay in the ring, in the thread that logs them, until a warning puts them on the queue
+        handler = DebugRingHandler(handler, level, ring_size)
+        root_level = logging.DEBUG
+        for name in LIBRARIES:    # Only PVCharge's own debug records are worth creating
+            logging.getLogger(name).setLevel(level)
+    listener = logging.handlers.QueueListener(records, file_handler)
+    root = logging.getLogger()
+    root.handlers.clear()
+    root.addHandler(handler)
+    root.setLevel(root_level)
+    listener.start()
+    STOP[:] = [listener.stop, file_handler.close]    # What is still queued, then what is buffered
+    atexit.register(shutdown)
+    if config["LOG_LEVEL"] not in ("INFO", "DEBUG"):
+        logging.warning("Unknown logging level")
+    return listener
@@ -0,0 +1,150 @@
+import json
+import time
+import bisect
+import logging
+import functools
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, one set of buckets per label combination"""
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}    # Label values: [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [0] * (len(self.buckets) + 2)
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):    # Larger values only show in +Inf
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = {key: list(values) for key, values in self.series.items()}
+        for key, values in series.items():
+            labels = format_labels(self.labelnames, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="+Inf"}} {values[-1]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {values[-2]:.6f}")
+            lines.append(f"{self.name}_count{{{labels}}} {values[-1]}")
+        return lines
+
+    def summary(self):
+        with self.lock:
+            return {",".join(key) or "all": {"count": values[-1], "mean": values[-2] / values[-1]}
+                    for key, values in self.series.items() if values[-1]}
+
+
+class Counter:
+    """Monotonic counter, one value per label combination"""
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.series = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = dict(self.series)
+        for key, value in series.items():
+            lines.append(f"{self.name}{{{format_labels(self.labelnames, key)}}} {value}")
+        return lines
+
+    def summary(self):
+        with self.lock:
+            return {",".join(key) or "all": value for key, value in self.series.items()}
+
+
+def format_labels(labelnames, values):
+    return ",".join(f'{name}="{value}"' for name, value in zip(labelnames, values))
+
+
+def timed(histogram, **labels):
+    """Decorator recording the run time of each call in histogram"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    """Compact JSON summary of all metrics, for publishing over MQTT"""
+    return json.dumps({metric.name: metric.summary() for metric in REGISTRY})
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        payload = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address="127.0.0.1"):
+    """Serve /metrics from a background thread, on localhost unless address is given ("" for all interfaces)"""
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="Metrics", daemon=True).start()
+    logging.info("Metrics available on %s:%s", address or "*", port)
+    return server
+
+
+REGISTRY = []
+
+# Hot-path instrumentation
+STAGE_SECONDS = Histogram("pvcharge_stage_seconds", "Duration of eGauge reads and charge rate verification",
+                          ("stage",))
+COMMAND_SECONDS = Histogram("pvcharge_car_command_seconds", "Duration of car commands", ("interface", "command"))
+LOOP_SECONDS = Histogram("pvcharge_loop_seconds", "Duration of one control loop pass")
+LOOP_JITTER = Histogram("pvcharge_loop_jitter_seconds", "Delay of fast polling passes beyond the scheduled sample interval")
+EGAUGE_TIMEOUTS = Counter("pvcharge_egauge_timeouts_total", "eGauge reads that timed out", ("read",))
+CAR_ERRORS = Counter("pvcharge_car_errors_total", "Failed car commands by error class", ("error",))
+LOOP_OVERRUNS = Counter("pvcharge_loop_overruns_total", "eGauge samples that started after their scheduled time")
+LOOP_HANGS = Counter("pvcharge_loop_hangs_total", "Loop iterations running past LOOP_DEADLINE", ("loop",))
@@ -0,0 +1,132 @@
+import math
+import logging
+import metrics
+
+J2000 = 946728000    # 2000-01-01 12:00 UTC (epoch seconds)
+
+
+class AdaptivePolling:
+    """Class to pick the eGauge poll interval from the sun's position and the recent volatility of the surplus
+
+    While fast polling, the interval stretches from FAST_POLLING up to MAX_FAST_POLLING as the surplus steadies
+    (its standard deviation over the smoothing window falls below VOLATILE_AMPS), or while the car is not charging
+    and the surplus is far below MIN_CHARGE.  With LATITUDE and LONGITUDE set, polling stops from SUN_MARGIN after
+    sunset until SUN_MARGIN before sunrise.
+    """
+    def __init__(self, config, energy, clock):
+        self.config = config
+        self.energy = energy
+        self.clock = clock
+
+    # Read on use, so a config reload applies at once
+    @property
+    def fast(self):
+        return self.config["FAST_POLLING"]
+
+    @property
+    def max_fast(self):
+        return max(self.config.get("MAX_FAST_POLLING", self.fast), self.fast)
+
+    @property
+    def volatile_amps(self):
+        return self.config.get("VOLATILE_AMPS", 2)
+
+    @property
+    def latitude(self):
+        return self.config.get("LATITUDE")
+
+    @property
+    def longitude(self):
+        return self.config.get("LONGITUDE")
+
+    @property
+    def sun_margin(self):
+        return self.config.get("SUN_MARGIN", 1800)
+
+    def fast_interval(self, charging):
+        """Seconds until the next sample while fast polling"""
+        history = self.energy.history
+        voltage = history["charger_voltage"].latest()
+        if self.max_fast == self.fast or history["surplus"].count < 2 or not voltage:
+            return self.fast
+        volatility = math.sqrt(history["surplus"].variance()) / voltage    # Amps
+        calm = max(1 - volatility / self.volatile_amps, 0)
+        if not charging:    # Nothing to adjust until the surplus gets near the minimum charge rate
+            shortfall = self.config["MIN_CHARGE"] - history["surplus"].latest() / voltage
+            calm = max(calm, min(shortfall / self.config["MIN_CHARGE"], 1))
+        return self.fast + (self.max_fast - self.fast) * calm
+
+    def night_remaining(self):
+        """Seconds until polling resumes before sunrise, 0 in daytime or without coordinates"""
+        if self.latitude is None or self.longitude is None:
+            return 0
+        now = self.clock.time()
+        sunrise, sunset = sun_times(now, self.latitude, self.longitude)
+        if now > sunset + self.sun_margin:
+            sunrise, sunset = sun_times(now + 86400, self.latitude, self.longitude)
+        if now >= sunrise - self.sun_margin:
+            return 0
+        return sunrise - self.sun_margin - now
+
+    def slow_interval(self, watch=False):
+        """Seconds until the next check while slow polling, all night unless watch (the car must not charge)"""
+        if not watch:
+            night = self.night_remaining()
+            if night:
+                logging.debug("Night, sleeping %.1f hours", night / 3600)
+                return night
+        return self.config["SLOW_POLLING"]
+
+
+class Cadence:
+    """Class to run a loop at a fixed rate, each tick is due one interval after the previous one was due
+
+    The time the work takes comes out of the wait, so the period does not drift with eGauge or car latency.  Work
+    that runs past the next tick is an overrun: the next tick starts at once, and the schedule restarts from there
+    rather than bursting to catch up.
+    """
+    def __init__(self, clock):
+        self.clock = clock
+        self.due = None    # Time the current tick was due
+        self.overruns = 0
+
+    def wait(self, interval):
+        """Seconds until the next tick, interval after the current one"""
+        now = self.clock.time()
+        if self.due is None:
+            self.due = now
+        self.due += interval
+        if now > self.due:
+            logging.debug("Loop overrun by %.2f seconds", now - self.due)
+            self.overruns += 1
+            metrics.LOOP_OVERRUNS.inc()
+            self.due = now
+        return self.due - now
+
+    def restart(self):
+        """The current tick starts now, i.e. after an early wake"""
+        self.due = self.clock.time()
+
+
+def sun_times(timestamp, latitude, longitude):
+    """Sunrise and sunset (epoch seconds) of the local day of timestamp, NOAA sunrise equation
+
+    Longitude is east positive.  Returns (-inf, inf) during polar day and (noon, noon) during polar night.
+    """
+    day = round((timestamp - J2000) / 86400 + longitude / 360)    # Days from J2000 to this local solar noon
+    mean_noon = day - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_noon) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = mean_noon + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    latitude = math.radians(latitude)
+    cos_hour_angle = ((math.sin(math.radians(-0.833)) - math.sin(latitude) * math.sin(declination)) /
+                      (math.cos(latitude) * math.cos(declination)))
+    noon = J2000 + transit * 86400
+    if cos_hour_angle < -1:
+        return -math.inf, math.inf
+    if cos_hour_angle > 1:
+        return noon, noon
+    half_day = math.degrees(math.acos(cos_hour_angle)) / 360 * 86400
+    return noon - half_day, noon + half_day
@@ -0,0 +1,77 @@
+import json
+import logging
+
+# Field: (name, Home Assistant component, unit, device class, decimals), None decimals for text and on/off
+FIELDS = {
+    "enabled": ("Charging enabled", "binary_sensor", None, None, None),
+    "charge_delay": ("Charge delay", "binary_sensor", None, None, None),
+    "sun_up": ("Sun up", "binary_sensor", None, None, None),
+    "car_charging": ("Car charging", "binary_sensor", None, "battery_charging", None),
+    "charge_rate": ("Charge rate", "sensor", "A", "current", 1),
+    "new_charge_rate": ("Target charge rate", "sensor", "A", "current", 1),
+    "generation": ("Solar generation", "sensor", "W", "power", -1),
+    "usage": ("House usage", "sensor", "W", "power", -1),
+    "decision": ("Last decision", "sensor", None, None, None),
+}
+
+
+class StatePublisher:
+    """Class to publish the controller state as retained per-field topics, only the fields that changed
+
+    Numbers are rounded first (amps to 0.1 A, watts to 10 W), so sensor noise alone publishes nothing.  The fields
+    of one control pass go out together, and are advertised to Home Assistant through MQTT discovery, with
+    TOPIC_STATE/availability set to offline by the broker if PVCharge goes away.
+    """
+    def __init__(self, config, client):
+        self.client = client
+        self.availability = f"{config['TOPIC_STATE']}/availability"
+        self.node = config.get("TESLA_VIN", "car")    # Only set for VEHICLES entries
+        self.base = config["TOPIC_STATE"] if "TESLA_VIN" not in config else f"{config['TOPIC_STATE']}/{self.node}"
+        self.name = config.get("NAME", "PVCharge")
+        self.discovery_prefix = config.get("HA_DISCOVERY_PREFIX", "homeassistant")
+        self.last = {}    # Field: last published payload
+        self.announced = False
+        self.published = 0
+        client.user_data_get()["subscribers"].append(self)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        """After a reconnect the broker may have lost the retained topics, publish everything again"""
+        self.announced = False
+        self.last = {}
+
+    def publish(self, state):
+        """Publish the fields of state that changed since the last call"""
+        if not self.announced:
+            self.announce()
+        for field, value in state.items():
+            payload = format_value(value, FIELDS[field][4], FIELDS[field][1])
+            if self.last.get(field) != payload:
+                self.client.publish(topic=f"{self.base}/{field}", payload=payload, qos=1, retain=True)
+                self.last[field] = payload
+                self.published += 1
+
+    def announce(self):
+        self.announced = True
+        self.client.publish(topic=self.availability, payload="online", qos=1, retain=True)
+        if not self.discovery_prefix:
+            return
+        device = {"identifiers": [f"pvcharge_{self.node}"], "name": self.name, "manufacturer": "PVCharge"}
+        for field, (name, component, unit, device_class, decimals) in FIELDS.items():
+            discovery = {"name": name, "unique_id": f"pvcharge_{self.node}_{field}", "state_topic": f"{self.base}/{field}",
+                         "availability_topic": self.availability, "device": device}
+            if unit:
+                discovery.update(unit_of_measurement=unit, state_class="measurement")
+            if device_class:
+                discovery["device_class"] = device_class
+            self.client.publish(topic=f"{self.discovery_prefix}/{component}/pvcharge_{self.node}/{field}/config",
+                                payload=json.dumps(discovery), qos=1, retain=True)
+        logging.info("Announced %s state topics under %s", len(FIELDS), self.base)
+
+
+def format_value(value, decimals, component):
+    if component == "binary_sensor":
+        return "ON" if value else "OFF"
+    if decimals is None:
+        return str(value)
+    value = round(value, decimals)
+    return str(int(value)) if decimals <= 0 else f"{value:.{decimals}f}"
@@ -1,27 +1,45 @@
 import os
 import sys
+import signal
 import subprocess
 import math
 import time
 import logging
-import tomllib
+import queue
+import threading
+import collections
+import functools
+import concurrent.futures
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 from egauge import webapi
 from egauge.webapi.device import Register, Local
 import paho.mqtt.client as mqtt
-from stopit import threading_timeoutable as timeoutable
+from smoothing import SampleRing
+import metrics
+import tsstore
+import settings
+from convergence import ConvergenceDetector
+from metrics import timed, STAGE_SECONDS, COMMAND_SECONDS
 
 # Load parameters from .env
 load_dotenv()
-# Load config file
-with open("config.toml", mode="rb") as fp:
-    config = tomllib.load(fp)
+# Load config file, checked and shared with every module (see settings.py)
+config = settings.shared()
+
+
+# Timestamped set of values read from the eGauge, registers in W, sensors in A and V
+# tesla_charger is the total of all charger registers, charge_rate the first charger's sensor,
+# chargers and charge_rates hold the values of each charger circuit
+EnergySnapshot = collections.namedtuple("EnergySnapshot", ["timestamp", "generation", "usage", "tesla_charger",
+                                                           "charge_rate", "charger_voltage", "chargers",
+                                                           "charge_rates"], defaults=((), ()))
 
 
 class PowerUsage:
     """Class to request data from the eGauge web API"""
-    def __init__(self):
+    def __init__(self, chargers=None, check_connection=True):
         # Load parameters from .env
         self.meter_dev = os.getenv("EGDEV")
         self.meter_user = os.getenv("EGUSR")
@@ -30,6 +48,10 @@ class PowerUsage:
         self.eGauge_use = os.getenv("EGAUGE_USE")
         self.eGauge_charger = os.getenv("EGAUGE_CHARGER")
         self.eGauge_charger_sensor = os.getenv("EGAUGE_CHARGER_SENSOR")
+        # (register, sensor) of every charger circuit, the first one is the default car
+        self.chargers = chargers or [(self.eGauge_charger, self.eGauge_charger_sensor)]
+        self.charger_regs = [0] * len(self.chargers)
+        self.charge_rate_sensors = [0] * len(self.chargers)
         self.register_sample = 0
         self.sensor_sample = 0
         self.generation_reg = 0
@@ -38,103 +60,206 @@ class PowerUsage:
         self.charge_rate_sensor = 0
         self.charger_voltage_sensor = 0
         self.new_charge_rate = 0
+        # Snapshot is shared by all consumers until it is older than SAMPLE_TTL
+        self.sample_ttl = config.get("SAMPLE_TTL", 1)
+        self.snapshot = EnergySnapshot(-math.inf, 0, 0, 0, 0, 0)
+        self.init_history()
+        # Waits for the charger current after a change, and learns how long the car takes
+        self.convergence = ConvergenceDetector(config.get("VERIFY_TOLERANCE", 0.5))
+        self.lock = threading.Lock()    # One eGauge request at a time, taken per read while verifying a charge rate
 
         # Initialize eGauge
         self.my_eGauge = webapi.device.Device(self.meter_dev, webapi.JWTAuth(self.meter_user, self.meter_password))
 
-        # verify we can talk to the meter:
+        # verify we can talk to the meter (skipped on a warm restart, the first sample will tell):
+        if check_connection:
+            self.check_connection()
+        else:
+            logging.info("Warm restart, eGauge %s not checked", self.meter_dev)
+
+    def check_connection(self):
         try:
-            rights = self.my_eGauge.get("/auth/rights").get("rights", [])
+            rights = self.my_eGauge.get("/auth/rights", timeout=30).get("rights", [])
         except webapi.Error as e:
-            logging.critical(f"Sorry, failed to connect to {self.meter_dev}: {e}")
+            logging.critical("Sorry, failed to connect to %s: %s", self.meter_dev, e)
             sys.exit(1)
-        logging.info(f"Connected to eGauge {self.meter_dev} (user {self.meter_user}, rights={rights})")
+        logging.info("Connected to eGauge %s (user %s, rights=%s)", self.meter_dev, self.meter_user, rights)
 
-    @timeoutable('Timeout')
-    def sample_register(self):
+    def reset_connection(self):
+        """Start over with a new eGauge device, without the token and register info of one that hung"""
+        logging.warning("Resetting the connection to eGauge %s", self.meter_dev)
+        self.my_eGauge = webapi.device.Device(self.meter_dev, webapi.JWTAuth(self.meter_user, self.meter_password))
+
+    @timed(STAGE_SECONDS, stage="sample_register")
+    def sample_register(self, timeout=30):
         """Sample registers and convert kW to W"""
-        self.register_sample = Register(self.my_eGauge, {"rate": "True", "time": "now"})
+        if timeout <= 0:
+            metrics.EGAUGE_TIMEOUTS.inc(read="register")
+            return 'Timeout'
+        try:
+            self.register_sample = Register(self.my_eGauge, {"rate": "True", "time": "now"}, timeout=timeout)
+        except webapi.Error as e:
+            if egauge_timed_out(e):
+                metrics.EGAUGE_TIMEOUTS.inc(read="register")
+                return 'Timeout'
+            raise
         self.generation_reg = self.register_sample.pq_rate(self.eGauge_gen).value * 1000
-        logging.debug(f"   Generation reg: {self.generation_reg:.0f}")
+        logging.debug("   Generation reg: %.0f", self.generation_reg)
         self.usage_reg = self.register_sample.pq_rate(self.eGauge_use).value * 1000
-        logging.debug(f"        Usage reg: {self.usage_reg:.0f}")
-        self.tesla_charger_reg = self.register_sample.pq_rate(self.eGauge_charger).value * 1000
-        logging.debug(f"Tesla charger reg: {self.tesla_charger_reg:.0f}")
-
-    @timeoutable('Timeout')
-    def sample_sensor(self):
-        self.sensor_sample = Local(self.my_eGauge, "l=L1:L2&s=all")
+        logging.debug("        Usage reg: %.0f", self.usage_reg)
+        self.charger_regs = [self.register_sample.pq_rate(register).value * 1000 for register, sensor in self.chargers]
+        self.tesla_charger_reg = sum(self.charger_regs)
+        logging.debug("Tesla charger reg: %.0f", self.tesla_charger_reg)
+
+    @timed(STAGE_SECONDS, stage="sample_sensor")
+    def sample_sensor(self, timeout=30):
+        if timeout <= 0:
+            metrics.EGAUGE_TIMEOUTS.inc(read="sensor")
+            return 'Timeout'
+        try:
+            self.sensor_sample = Local(self.my_eGauge, "l=L1:L2&s=all", timeout=timeout)
+        except webapi.Error as e:
+            if egauge_timed_out(e):
+                metrics.EGAUGE_TIMEOUTS.inc(read="sensor")
+                return 'Timeout'
+            raise
         self.charger_voltage_sensor = (self.sensor_sample.rate("L1", "n") +
                                        self.sensor_sample.rate("L2", "n"))
-        logging.debug(f" Charger voltage sensor: {self.charger_voltage_sensor:.2f}")
-        self.charge_rate_sensor = self.sensor_sample.rate(self.eGauge_charger_sensor, "n")
-        logging.debug(f"     Charge rate sensor: {self.charge_rate_sensor:.2f}")
+        logging.debug(" Charger voltage sensor: %.2f", self.charger_voltage_sensor)
+        self.charge_rate_sensors = [self.sensor_sample.rate(sensor, "n") for register, sensor in self.chargers]
+        self.charge_rate_sensor = self.charge_rate_sensors[0]
+        logging.debug("     Charge rate sensor: %.2f", self.charge_rate_sensor)
+        # Keep the snapshot current, the register values keep their original timestamp
+        self.snapshot = self.snapshot._replace(charge_rate=self.charge_rate_sensor,
+                                               charger_voltage=self.charger_voltage_sensor,
+                                               charge_rates=tuple(self.charge_rate_sensors))
+
+    def sample_snapshot(self, timeout=30):
+        """Sample registers and sensors back-to-back, and store them as one timestamped snapshot"""
+        deadline = Deadline(timeout)
+        if self.sample_register(timeout=deadline.remaining()) == 'Timeout':
+            return 'Timeout'
+        if self.sample_sensor(timeout=deadline.remaining()) == 'Timeout':
+            return 'Timeout'
+        self.snapshot = EnergySnapshot(time.monotonic(), self.generation_reg, self.usage_reg, self.tesla_charger_reg,
+                                       self.charge_rate_sensor, self.charger_voltage_sensor,
+                                       tuple(self.charger_regs), tuple(self.charge_rate_sensors))
+        self.record_history(self.snapshot)
+
+    def init_history(self):
+        """Ring buffers of recent snapshots, used to smooth the charge rate calculation"""
+        self.smoothing = config.get("SMOOTHING", "none")
+        window = config.get("SMOOTHING_WINDOW", 15)
+        alpha = config.get("SMOOTHING_ALPHA", 0.3)
+        self.history = {field: SampleRing(window, alpha) for field in EnergySnapshot._fields[1:6]}
+        self.history["surplus"] = SampleRing(window, alpha)    # Power available to the car (W)
+
+    def record_history(self, snapshot):
+        history = self.history
+        history["generation"].append(snapshot.generation)
+        history["usage"].append(snapshot.usage)
+        history["tesla_charger"].append(snapshot.tesla_charger)
+        history["charge_rate"].append(snapshot.charge_rate)
+        history["charger_voltage"].append(snapshot.charger_voltage)
+        history["surplus"].append(snapshot.generation - (snapshot.usage - snapshot.tesla_charger))
+        tsstore.record_sample(snapshot)
+
+    def refresh_snapshot(self, timeout=30):
+        """Sample the eGauge only if the current snapshot is older than SAMPLE_TTL"""
+        if (time.monotonic() - self.snapshot.timestamp) >= self.sample_ttl:
+            if self.sample_snapshot(timeout=timeout) == 'Timeout':
+                logging.warning("eGauge read timed out")
+                return False
+        else:
+            logging.debug("Using cached eGauge snapshot")
+        return True
 
-    def calculate_charge_rate(self, new_sample):
+    def calculate_charge_rate(self, new_sample, smoothing=None):
         if new_sample:
-            if self.sample_register(timeout=30) == 'Timeout':
-                logging.warning("eGauge Register read timed out")
-                return self.new_charge_rate
-            if self.sample_sensor(timeout=30) == 'Timeout':
-                logging.warning("eGauge Sensor read timed out")
+            if not self.refresh_snapshot(timeout=30):
                 return self.new_charge_rate
         # Calculate the charge rate
-        self.new_charge_rate = ((self.generation_reg - (self.usage_reg - self.tesla_charger_reg)) /
-                                self.charger_voltage_sensor)
-        logging.debug(f"New charge rate: {self.new_charge_rate:.2f}")
+        method = smoothing or self.smoothing
+        if method == "none":
+            snapshot = self.snapshot
+            surplus = snapshot.generation - (snapshot.usage - snapshot.tesla_charger)
+            voltage = snapshot.charger_voltage
+        else:    # Use the smoothed surplus, so passing clouds don't each trigger a new rate
+            surplus = self.history["surplus"].smoothed(method)
+            voltage = self.history["charger_voltage"].smoothed(method)
+        if voltage <= 0:    # No sample yet (or a 0 V reading), keep the last rate
+            logging.debug("No charger voltage, keeping charge rate: %.2f", self.new_charge_rate)
+            return self.new_charge_rate
+        self.new_charge_rate = surplus / voltage
+        logging.debug("New charge rate: %.2f", self.new_charge_rate)
         return self.new_charge_rate
 
-    def verify_new_charge_rate(self, new_charge_rate):
-        for attempts in range(0, 6):
-            if self.sample_sensor(timeout=10) == 'Timeout':
+    @timed(STAGE_SECONDS, stage="verify_new_charge_rate")
+    def verify_new_charge_rate(self, new_charge_rate, timeout=10, charger=0, kind="rate"):
+        """Wait for the charger current to settle at new_charge_rate, kind is "rate" or "start" (from 0 A)"""
+        deadline = Deadline(timeout)
+
+        def read():
+            with self.lock:    # Only for the read, the sampler keeps sampling while the car settles
+                timed_out = self.sample_sensor(timeout=deadline.remaining()) == 'Timeout'
+            if timed_out:
                 logging.warning("eGauge Sensor read timed out")
-            # Use round() on the verify step (vs math.floor()) to prevent constant requests for the same value
-            if round(self.charge_rate_sensor) == new_charge_rate:
-                logging.debug("New charge rate verified")
-                return True
-            time.sleep(0.5)
+                return None
+            return self.charge_rate_sensors[charger]
+
+        # Within VERIFY_TOLERANCE (default 0.5 A, as round()) to prevent constant requests for the same value
+        if self.convergence.wait(read, new_charge_rate, timeout, charger, kind):
+            logging.debug("New charge rate verified")
+            return True
         logging.debug("New charge rate NOT verified")
         return False
 
-    def sufficient_generation(self, min_charge):
-        charge_rate = math.floor(self.calculate_charge_rate(new_sample=True))
-        logging.debug(f"New charge rate (floor): {charge_rate}")
+    def sufficient_generation(self, min_charge, new_sample=True):
+        charge_rate = math.floor(self.calculate_charge_rate(new_sample))
+        logging.debug("New charge rate (floor): %s", charge_rate)
         if charge_rate >= min_charge:
             return True
         else:
             return False
 
-    def check_sun_up(self):
-        if self.generation_reg > config["MIN_SOLAR"]:
+    def check_sun_up(self, new_sample=False):
+        if new_sample:
+            self.refresh_snapshot(timeout=30)
+        if self.snapshot.generation > config["MIN_SOLAR"]:
             return True
         else:
             return False
 
     def status_report(self, charge_tesla, charge_delay, sun_up, car_is_charging, new_sample):
         if new_sample:
-            self.calculate_charge_rate(new_sample)
-        # Build status string
-        status = "Status: "
-        if ((charge_tesla and sun_up) and not charge_delay):
-            status += "En:1 "
-        elif charge_delay == True:
-            status += "Delay "
-        else:
-            status += "En:0 "
-        if car_is_charging:
-            status += "Chg:1 "
-        else:
-            status += "Chg:0 "
-        status += ("Cur:" + str(round(self.charge_rate_sensor)) + " " + "New:" +
-                   str(math.floor(self.new_charge_rate)))
-        return status
+            self.calculate_charge_rate(new_sample)    # Served from the snapshot, unless it has expired
+        return format_status(charge_tesla, charge_delay, sun_up, car_is_charging, self.charge_rate_sensor,
+                             self.new_charge_rate)
+
+
+def format_status(charge_tesla, charge_delay, sun_up, car_is_charging, charge_rate, new_charge_rate):
+    # Build status string
+    status = "Status: "
+    if ((charge_tesla and sun_up) and not charge_delay):
+        status += "En:1 "
+    elif charge_delay == True:
+        status += "Delay "
+    else:
+        status += "En:0 "
+    if car_is_charging:
+        status += "Chg:1 "
+    else:
+        status += "Chg:0 "
+    status += ("Cur:" + str(round(charge_rate)) + " " + "New:" +
+               str(math.floor(new_charge_rate)))
+    return status
 
 
 class TeslaProxy:
     """Class to send commands to TeslaBleHttpProxy"""
-    def __init__(self):
+    def __init__(self, vin=None):
         # Load parameters from .env
-        self.tesla_vin = os.getenv("TESLA_VIN")
+        self.tesla_vin = vin or os.getenv("TESLA_VIN")
         self.tesla_proxy_host = os.getenv("PROXY_HOST")
         # Test for existence of TeslaBleHttpProxy
         if self.tesla_proxy_host == None:
@@ -142,149 +267,346 @@ class TeslaProxy:
             logging.critical("Please point to TeslaBleHttpProxy in .env")
             sys.exit(1)
         self.tesla_proxy_base_command = self.tesla_proxy_host + "/api/1/vehicles/" + self.tesla_vin + "/command/"
+        # Keep-alive connection to the proxy, shared by all commands
+        self.http = create_http_session()
 
-    def set_charge_rate(self, charge_rate):
+    @timed(COMMAND_SECONDS, interface="proxy", command="set_charge_rate")
+    def set_charge_rate(self, charge_rate, timeout=25):
         command = self.tesla_proxy_base_command + "set_charging_amps"
         logging.debug(command)
         data = {}
         data["charging_amps"] = charge_rate
-        rc = call_http_post(command, data)
-        time.sleep(5)
-        return rc
+        # Setting the same amps twice is harmless, so this command may be retried
+        # The caller verifies the new rate on the charger current, no need to wait here
+        return call_http_post(command, data, timeout=timeout, session=self.http, retries=2)
 
-    def start_charging(self):
+    @timed(COMMAND_SECONDS, interface="proxy", command="start_charging")
+    def start_charging(self, timeout=25):
         command = self.tesla_proxy_base_command + "charge_start"
         logging.debug(command)
         data = ""
-        return call_http_post(command, data)
+        return call_http_post(command, data, timeout=timeout, session=self.http)
 
-    def stop_charging(self):
+    @timed(COMMAND_SECONDS, interface="proxy", command="stop_charging")
+    def stop_charging(self, timeout=25):
         command = self.tesla_proxy_base_command + "charge_stop"
         logging.debug(command)
         data = ""
-        rc = call_http_post(command, data)
+        rc = call_http_post(command, data, timeout=timeout, session=self.http)
         time.sleep(5)
         return rc
 
-    def wake(self):
+    @timed(COMMAND_SECONDS, interface="proxy", command="wake")
+    def wake(self, timeout=25):
         command = self.tesla_proxy_base_command + "wake_up"
         logging.debug(command)
         data = ""
-        return call_http_post(command, data)
-
-
-def call_http_post(cmd, data):
-    if data == "":
-        r = requests.post(url=cmd, data=data)
-    else:
-        r = requests.post(url=cmd, json=data)
-    if r.status_code == 200:    # good return code
-        result = r.json()
-        logging.debug(result)
-    else:
-        logging.warning(result)
-    return result["response"]["result"]
+        return call_http_post(command, data, timeout=timeout, session=self.http)
+
+    def reset_session(self):
+        """Drop the keep-alive connections to the proxy, the next command opens a new one"""
+        logging.warning("Resetting the connection to TeslaBleHttpProxy")
+        http, self.http = self.http, create_http_session()
+        http.close()
+
+
+def create_http_session():
+    """Return a requests Session that keeps its connection to the proxy alive between commands"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def call_http_post(cmd, data, timeout=25, session=requests, retries=0):
+    """POST a proxy command, retrying connection failures up to retries times within the timeout"""
+    deadline = Deadline(timeout)
+    for attempt in range(retries + 1):
+        if attempt > 0:
+            time.sleep(min(0.5 * 2 ** (attempt - 1), deadline.remaining()))    # Back off before retrying
+        if deadline.remaining() <= 0:
+            logging.warning("Loop time budget exhausted, Tesla command skipped")
+            return False
+        try:
+            if data == "":
+                r = session.post(url=cmd, data=data, timeout=deadline.remaining())
+            else:
+                r = session.post(url=cmd, json=data, timeout=deadline.remaining())
+        except requests.exceptions.Timeout:
+            logging.warning("Last Tesla command timed out")
+            metrics.CAR_ERRORS.inc(error="timeout")
+            continue
+        except requests.exceptions.ConnectionError as e:
+            logging.warning("Last Tesla command failed to connect to proxy: %s", e)
+            metrics.CAR_ERRORS.inc(error="proxy_connection")
+            continue
+        if r.status_code == 200:    # good return code
+            try:
+                result = r.json()
+            except ValueError:
+                logging.warning("Invalid reply from proxy: %s", r.text)
+                return False
+            logging.debug(result)
+            return result["response"]["result"]
+        elif r.status_code >= 500:    # proxy or car busy, worth another try
+            logging.warning("Proxy returned %s: %s", r.status_code, r.text)
+            metrics.CAR_ERRORS.inc(error=f"http_{r.status_code}")
+        else:
+            logging.warning("Proxy returned %s: %s", r.status_code, r.text)
+            metrics.CAR_ERRORS.inc(error=f"http_{r.status_code}")
+            return False
+    return False
 
 
 class TeslaCommands:
     """Class to handle commands sent to Tesla Vehicle Command SDK"""
-    def __init__(self):
+    def __init__(self, vin=None, session_cache=None):
         # Load parameters from .env
         self.tesla_control_bin = os.getenv("TESLA_CONTROL_BIN")
         self.tesla_key_file = os.getenv("TESLA_KEY_FILE")
         self.tesla_base_command = [self.tesla_control_bin, '-ble', '-key-file', self.tesla_key_file]
+        if vin is not None:    # Otherwise tesla-control uses TESLA_VIN from the environment
+            self.tesla_base_command += ['-vin', vin]
         # Test for existence of tesla-control
         if not os.path.exists(self.tesla_control_bin):
-            logging.critical(f"tesla-control not found at: {self.tesla_control_bin}")
+            logging.critical("tesla-control not found at: %s", self.tesla_control_bin)
             logging.critical("Please point to it in .env, or install it from:")
             logging.critical("https://github.com/teslamotors/vehicle-command/tree/main/cmd/tesla-control")
             sys.exit(1)
+        # All commands go through one session worker, which keeps the vehicle session between commands
+        self.session = get_tesla_session(self.tesla_base_command, session_cache or config.get("TESLA_SESSION_CACHE"))
 
-    def set_charge_rate(self, charge_rate):
-        command = self.tesla_base_command + ['charging-set-amps']
+    @timed(COMMAND_SECONDS, interface="ble", command="set_charge_rate")
+    def set_charge_rate(self, charge_rate, timeout=25):
+        command = ['charging-set-amps']
         command.append(str(charge_rate))
         logging.debug(command)
-        result, delay = call_sub_error_handler(command, timeout=25)
+        result, delay = self.session.run(command, timeout=timeout)
         return result
 
-    def start_charging(self):
-        command = self.tesla_base_command + ['charging-start']
+    @timed(COMMAND_SECONDS, interface="ble", command="start_charging")
+    def start_charging(self, timeout=25):
+        command = ['charging-start']
         logging.debug(command)
-        result, delay = call_sub_error_handler(command, timeout=25)
+        result, delay = self.session.run(command, timeout=timeout)
         return result
 
-    def stop_charging(self):
-        command = self.tesla_base_command + ['charging-stop']
+    @timed(COMMAND_SECONDS, interface="ble", command="stop_charging")
+    def stop_charging(self, timeout=25):
+        command = ['charging-stop']
         logging.debug(command)
-        result, delay = call_sub_error_handler(command, timeout=25)
+        result, delay = self.session.run(command, timeout=timeout)
         if delay > 0:
             time.sleep(delay)
         return result
 
-    def wake(self):
-        command = self.tesla_base_command + ['-domain', 'vcsec', 'wake']
+    @timed(COMMAND_SECONDS, interface="ble", command="wake")
+    def wake(self, timeout=25):
+        command = ['-domain', 'vcsec', 'wake']
         logging.debug(command)
-        result, delay = call_sub_error_handler(command, timeout=25)
+        result, delay = self.session.run(command, timeout=timeout)
         return result
 
-
-@timeoutable('Timeout')
-def call_sub_error_handler(cmd):
+    def reset_session(self):
+        """Drop the cached vehicle session, the next command performs a new BLE handshake"""
+        if self.session.cache_file is not None:
+            self.session.reset()
+
+
+class TeslaSession:
+    """Long-lived worker that runs queued tesla-control commands one at a time, over one cached vehicle session"""
+    def __init__(self, base_command, cache_file=None):
+        self.base_command = list(base_command)
+        self.cache_file = cache_file
+        if self.cache_file is not None:
+            # Session info is saved after the first handshake, later commands skip it
+            self.base_command += ['-session-cache', self.cache_file]
+        self.commands = queue.Queue()
+        self.latency = {}    # Command name: [count, total seconds, max seconds]
+        self.worker = threading.Thread(target=self.run_worker, name="TeslaSession", daemon=True)
+        self.worker.start()
+
+    def run(self, command, timeout=25):
+        """Queue a command and wait for its (result, delay), time spent queued counts against timeout"""
+        future = concurrent.futures.Future()
+        self.commands.put((command, Deadline(timeout), future))
+        return future.result()
+
+    def run_worker(self):
+        while True:
+            command, deadline, future = self.commands.get()
+            start = time.monotonic()
+            try:
+                result, delay, error = call_sub_error_handler(self.base_command + command, timeout=deadline.remaining())
+                if error is not None:
+                    metrics.CAR_ERRORS.inc(error=error)
+                if error in ("context_deadline", "closed_pipe") and self.cache_file is not None:
+                    # The session dropped, reconnect with a fresh handshake and retry once
+                    self.reset()
+                    result, delay, error = call_sub_error_handler(self.base_command + command,
+                                                                  timeout=deadline.remaining())
+                    if error is not None:
+                        metrics.CAR_ERRORS.inc(error=error)
+                self.record([arg for arg in command if not arg.isdigit()][-1], time.monotonic() - start)
+                future.set_result((result, delay))
+            except Exception as e:
+                future.set_exception(e)
+
+    def reset(self):
+        """Discard the cached session, the next command performs a new handshake"""
+        logging.info("Tesla session dropped, reconnecting")
+        try:
+            os.remove(self.cache_file)
+        except FileNotFoundError:
+            pass
+
+    def record(self, name, elapsed):
+        stats = self.latency.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        logging.debug("tesla-control %s took %.2f seconds (average %.2f)", name, elapsed, stats[1] / stats[0])
+
+    def latency_report(self):
+        """Return {command: (count, mean seconds, max seconds)}"""
+        return {name: (count, total / count, longest) for name, (count, total, longest) in self.latency.items()}
+
+
+tesla_sessions = {}
+
+
+def get_tesla_session(base_command, cache_file=None):
+    """Return the session worker for this tesla-control command line, all users share one worker"""
+    key = (tuple(base_command), cache_file)
+    if key not in tesla_sessions:
+        tesla_sessions[key] = TeslaSession(base_command, cache_file)
+    return tesla_sessions[key]
+
+
+def create_car(vehicle_config=None):
+    """Return the car command class selected in config, for one vehicle of VEHICLES or the default car"""
+    vehicle_config = vehicle_config or config
+    vin = vehicle_config.get("TESLA_VIN")    # Only set for VEHICLES entries, the default car uses .env
+    if vehicle_config.get("ENABLE_TESLA_PROXY"):
+        logging.debug("Using TeslaProxy")
+        return TeslaProxy(vin)
+    logging.debug("Using TeslaCommands")
+    session_cache = None
+    if vin is not None and "TESLA_SESSION_CACHE" in vehicle_config:
+        session_cache = f"{vin}_{vehicle_config['TESLA_SESSION_CACHE']}"    # Each car has its own session
+    return TeslaCommands(vin, session_cache)
+
+
+def call_sub_error_handler(cmd, timeout=25):
+    """Run a tesla-control command, returns (result, delay, error class or None)"""
+    if timeout <= 0:
+        logging.warning("Loop time budget exhausted, Tesla command skipped")
+        return False, 0, "timeout"
     try:
-        result = subprocess.run(args=cmd, capture_output=True, text=True, check=True)
-        if result.stdout != "":
-            logging.debug(result.stdout)
+        stdout = run_with_deadline(cmd, timeout)
+        if stdout != "":
+            logging.debug(stdout)
+    except subprocess.TimeoutExpired:
+        logging.warning("Last Tesla command exceeded its %.0f second deadline and was killed", timeout)
+        return False, 0, "timeout"
     except subprocess.CalledProcessError as error:
-        logging.debug(f"{type(error).__name__} - {error}")
-        logging.debug(f"Error: {error.stderr}")
+        logging.debug("%s - %s", type(error).__name__, error)
+        logging.debug("Error: %s", error.stderr)
         delay = 0
         if "not_charging" in error.stderr:
             # We have a match for "car could not execute command: not_charging" (precooling error)
             logging.info("Attempted to stop charging when car was only Pre-Cooling!  Delaying: 60 seconds")
             delay = 60
+            error_class = "not_charging"
         elif "is_charging" in error.stderr:
             # We have a match for "car could not execute command: is_charging" (already charging condition)
             logging.info("Attempted to start charging when car was already charging!")
-            return True, 0    # Return True as this isn't really an error condition
+            return True, 0, "is_charging"    # Return True as this isn't really an error condition
         elif "context deadline exceeded" in error.stderr:
             # We have a match for the timeout error
             logging.warning("Last Tesla command timed out")
+            error_class = "context_deadline"
         elif "read/write on closed pipe" in error.stderr:
             # Match for ATT request failed read/write on closed pipe
             logging.warning("Last Tesla command failed to connect over Bluetooth")
+            error_class = "closed_pipe"
         else:
             logging.warning("Unknown error, note error output")
-            logging.warning(f"Error: {error.stderr}")
-        return False, delay
-    return True, 0
-
-def check_elapsed_time(loop_time, compare_time, wait_time):
-    if compare_time == 0:
-        compare_time = time.time()    # Set counter to current time
-        return False, compare_time
-    elif (loop_time - compare_time) >= wait_time:
-        # Compare current loop time to first time
-    	return True, compare_time
-    else:
-        # We haven't waited long enough, keep waiting
-    	return False, compare_time
+            logging.warning("Error: %s", error.stderr)
+            error_class = "unknown"
+        return False, delay, error_class
+    return True, 0, None
+
+
+def run_with_deadline(cmd, timeout):
+    """Run cmd in its own process group, killing the whole group if it is still running at the deadline"""
+    with subprocess.Popen(args=cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                          start_new_session=True) as process:
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            # Kill the group, so no child is left holding the BLE adapter or our pipes open
+            os.killpg(process.pid, signal.SIGKILL)
+            process.communicate()
+            raise
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, output=stdout, stderr=stderr)
+    return stdout
+
+
+def egauge_timed_out(error):
+    """Return True if an eGauge webapi error was caused by a request timeout"""
+    return any(isinstance(arg, requests.exceptions.Timeout) for arg in error.args)
+
+
+class Deadline:
+    """Time budget shared by all blocking calls made during one loop iteration"""
+    def __init__(self, budget):
+        self.expires = time.monotonic() + budget
+
+    def remaining(self, limit=None):
+        """Seconds left in the budget (never negative), optionally capped at limit"""
+        remaining = max(self.expires - time.monotonic(), 0)
+        if limit is not None:
+            return min(remaining, limit)
+        return remaining
+
+
+MqttEvent = collections.namedtuple("MqttEvent", ["kind", "value", "time"])
+
+# State variable set by each kind of event
+EVENT_STATE = {
+    "prevent_non_solar_charge": "var_topic_prevent_non_solar_charge",
+    "geofence": "var_topic_teslamate_geofence",
+    "plugged_in": "var_topic_teslamate_plugged_in",
+    "battery_level": "var_topic_teslamate_battery_level",
+    "charge_limit_soc": "var_topic_teslamate_charge_limit_soc",
+    "state": "var_topic_teslamate_state",
+}
+# MqttCallbacks variables kept across a restart
+MQTT_STATE = tuple(EVENT_STATE.values()) + ("var_topic_charge_delay", "var_charge_delay_time")
+# Events that may change whether the car should charge, the control loop wakes on these
+WAKE_EVENTS = ("prevent_non_solar_charge", "charge_delay", "geofence", "plugged_in", "charge_limit_soc", "reload")
 
 
 class MqttCallbacks:
-    """Class to handle MQTT"""
-    def __init__(self):
+    """Class to handle MQTT, one instance per car, sharing the first instance's client"""
+    def __init__(self, vehicle_config=None, client=None, car_cmd=None, state=None):
+        self.config = vehicle_config or config
         # Load parameters from .env
         self.broker = os.getenv("BROKER")
         self.port = int(os.getenv("PORT"))
         self.client_id = os.getenv("CLIENT_ID")
-        self.topic_prevent_non_solar_charge = config["TOPIC_PREVENT_NON_SOLAR_CHARGE"]
-        self.topic_charge_delay = config["TOPIC_CHARGE_DELAY"]
-        self.topic_teslamate_geofence = config["TOPIC_TESLAMATE_GEOFENCE"]
-        self.topic_teslamate_plugged_in = config["TOPIC_TESLAMATE_PLUGGED_IN"]
-        self.topic_teslamate_battery_level = config["TOPIC_TESLAMATE_BATTERY_LEVEL"]
-        self.topic_teslamate_charge_limit_soc = config["TOPIC_TESLAMATE_CHARGE_LIMIT_SOC"]
-        self.topic_teslamate_state = config["TOPIC_TESLAMATE_STATE"]
-        if config["PREVENT_NON_SOLAR_CHARGE"] == "True":
+        self.topic_prevent_non_solar_charge = self.config["TOPIC_PREVENT_NON_SOLAR_CHARGE"]
+        self.topic_charge_delay = self.config["TOPIC_CHARGE_DELAY"]
+        self.topic_teslamate_geofence = self.config["TOPIC_TESLAMATE_GEOFENCE"]
+        self.topic_teslamate_plugged_in = self.config["TOPIC_TESLAMATE_PLUGGED_IN"]
+        self.topic_teslamate_battery_level = self.config["TOPIC_TESLAMATE_BATTERY_LEVEL"]
+        self.topic_teslamate_charge_limit_soc = self.config["TOPIC_TESLAMATE_CHARGE_LIMIT_SOC"]
+        self.topic_teslamate_state = self.config["TOPIC_TESLAMATE_STATE"]
+        self.topic_reload = self.config.get("TOPIC_RELOAD") if client is None else None    # Config is shared, once per client
+        if self.config["PREVENT_NON_SOLAR_CHARGE"]:
             self.var_topic_prevent_non_solar_charge = True
         else:
             self.var_topic_prevent_non_solar_charge = False
@@ -295,99 +617,158 @@ class MqttCallbacks:
         self.var_topic_teslamate_battery_level = 0
         self.var_topic_teslamate_charge_limit_soc = 0
         self.var_topic_teslamate_state = False
-
-        if "ENABLE_TESLA_PROXY" in config:
-            if config["ENABLE_TESLA_PROXY"] == "True":
-                self.car_cmd = TeslaProxy()
-            else:
-                self.car_cmd = TeslaCommands()
-        else:
-            self.car_cmd = TeslaCommands()
-
-        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id, protocol=mqtt.MQTTv311,
-                                  clean_session=True)
-        self.client.on_connect = self.on_connect
-        self.client.message_callback_add(self.topic_prevent_non_solar_charge, self.on_message_prevent_non_solar_charge)
-        self.client.message_callback_add(self.topic_charge_delay, self.on_message_charge_delay)
-        self.client.message_callback_add(self.topic_teslamate_geofence, self.on_message_geofence)
-        self.client.message_callback_add(self.topic_teslamate_plugged_in, self.on_message_plugged_in)
-        self.client.message_callback_add(self.topic_teslamate_battery_level, self.on_message_battery_level)
-        self.client.message_callback_add(self.topic_teslamate_charge_limit_soc, self.on_message_charge_limit_soc)
-        self.client.message_callback_add(self.topic_teslamate_state, self.on_message_state)
-        self.client.connect(host=self.broker, port=self.port, keepalive=60)
-        self.client.loop_start()
+        if state:    # Warm restart, retained messages from the broker override these
+            self.restore_state(state)
+
+        self.car_cmd = car_cmd or create_car(self.config)
+        self.events = queue.SimpleQueue()    # Parsed messages, applied in order by the event worker
+        self.actions = queue.SimpleQueue()    # Car commands, run by the action worker
+        self.listeners = []
+        threading.Thread(target=self.event_worker, name="MQTT events", daemon=True).start()
+        threading.Thread(target=self.action_worker, name="MQTT car actions", daemon=True).start()
+
+        owns_client = client is None
+        if owns_client:
+            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id, protocol=mqtt.MQTTv311,
+                                 clean_session=True, userdata={"subscribers": [], "handlers": {}})
+            client.on_connect = on_connect_all
+            if self.config.get("TOPIC_STATE"):    # Home Assistant shows the state topics as unavailable
+                client.will_set(f"{self.config['TOPIC_STATE']}/availability", payload="offline", qos=1, retain=True)
+        self.client = client
+        self.add_callback(self.topic_prevent_non_solar_charge, self.on_message_prevent_non_solar_charge)
+        self.add_callback(self.topic_charge_delay, self.on_message_charge_delay)
+        self.add_callback(self.topic_teslamate_geofence, self.on_message_geofence)
+        self.add_callback(self.topic_teslamate_plugged_in, self.on_message_plugged_in)
+        self.add_callback(self.topic_teslamate_battery_level, self.on_message_battery_level)
+        self.add_callback(self.topic_teslamate_charge_limit_soc, self.on_message_charge_limit_soc)
+        self.add_callback(self.topic_teslamate_state, self.on_message_state)
+        if self.topic_reload:
+            self.add_callback(self.topic_reload, self.on_message_reload)
+        self.client.user_data_get()["subscribers"].append(self)
+        if owns_client:
+            self.client.connect(host=self.broker, port=self.port, keepalive=60)
+            self.client.loop_start()
+
+    def add_callback(self, topic, handler):
+        """Register handler for topic, several cars may share a topic (i.e. the control topics)"""
+        handlers = self.client.user_data_get()["handlers"]
+        if topic not in handlers:
+            handlers[topic] = []
+            self.client.message_callback_add(topic, functools.partial(dispatch_message, handlers[topic]))
+        handlers[topic].append(handler)
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
-        if reason_code != 0:
-            logging.critical(f"Failed to connect, return code {reason_code}\n")
-            sys.exit(1)
         self.client.subscribe(topic=self.topic_prevent_non_solar_charge, qos=1)
-        logging.debug(f"Subscribed to: {self.topic_prevent_non_solar_charge}")
+        logging.debug("Subscribed to: %s", self.topic_prevent_non_solar_charge)
         self.client.subscribe(topic=self.topic_charge_delay, qos=1)
-        logging.debug(f"Subscribed to: {self.topic_charge_delay}")
+        logging.debug("Subscribed to: %s", self.topic_charge_delay)
         self.client.subscribe(topic=self.topic_teslamate_geofence, qos=1)
-        logging.debug(f"Subscribed to: {self.topic_teslamate_geofence}")
+        logging.debug("Subscribed to: %s", self.topic_teslamate_geofence)
         self.client.subscribe(topic=self.topic_teslamate_plugged_in, qos=1)
-        logging.debug(f"Subscribed to: {self.topic_teslamate_plugged_in}")
+        logging.debug("Subscribed to: %s", self.topic_teslamate_plugged_in)
         self.client.subscribe(topic=self.topic_teslamate_battery_level, qos=1)
-        logging.debug(f"Subscribed to: {self.topic_teslamate_battery_level}")
+        logging.debug("Subscribed to: %s", self.topic_teslamate_battery_level)
         self.client.subscribe(topic=self.topic_teslamate_charge_limit_soc, qos=1)
-        logging.debug(f"Subscribed to: {self.topic_teslamate_charge_limit_soc}")
+        logging.debug("Subscribed to: %s", self.topic_teslamate_charge_limit_soc)
         self.client.subscribe(topic=self.topic_teslamate_state, qos=1)
-        logging.debug(f"Subscribed to: {self.topic_teslamate_state}")
+        logging.debug("Subscribed to: %s", self.topic_teslamate_state)
+        if self.topic_reload:
+            self.client.subscribe(topic=self.topic_reload, qos=1)
+            logging.debug("Subscribed to: %s", self.topic_reload)
+
+    def get_state(self):
+        return {name: getattr(self, name) for name in MQTT_STATE}
 
+    def restore_state(self, state):
+        for name in MQTT_STATE:
+            if name in state:
+                setattr(self, name, state[name])
+
+    # Callbacks run on the paho network thread, they only parse the payload and queue it for the event worker
     def on_message_prevent_non_solar_charge(self, client, userdata, msg):
         logging.debug(msg.payload.decode('utf-8'))
-        if msg.payload.decode("utf-8") == "True":
-            self.var_topic_prevent_non_solar_charge = True
-        else:  # All messages not matching "True" mapped to "False"
-            self.var_topic_prevent_non_solar_charge = False
+        # All messages not matching "True" mapped to "False"
+        self.put_event("prevent_non_solar_charge", msg.payload.decode("utf-8") == "True")
 
     def on_message_charge_delay(self, client, userdata, msg):
         logging.debug(msg.payload.decode('utf-8'))
         if msg.payload.decode("utf-8") == "delay":
-            self.var_topic_charge_delay = 60 * 60    # Convert minutes to seconds
-            self.var_charge_delay_time = time.time()
+            self.put_event("charge_delay", 60 * 60)    # Convert minutes to seconds
         elif str.isnumeric(msg.payload.decode("utf-8")):
-            self.var_topic_charge_delay = int(msg.payload.decode("utf-8")) * 60
-            self.var_charge_delay_time = time.time()
+            self.put_event("charge_delay", int(msg.payload.decode("utf-8")) * 60)
         else:  # All messages not matching "delay" or numeric, cancel the delay
-            self.var_topic_charge_delay = 0
-            self.var_charge_delay_time = 0
-        logging.debug(f"Charge delay: {self.var_topic_charge_delay / 60} minutes")
+            self.put_event("charge_delay", 0)
 
     def on_message_geofence(self, client, userdata, msg):
         logging.debug(msg.payload.decode('utf-8'))
-        if msg.payload.decode("utf-8") == "Home":
-            self.var_topic_teslamate_geofence = True
-        else:  # All messages not matching "Home" mapped to "False"
-            self.var_topic_teslamate_geofence = False
+        # All messages not matching "Home" mapped to "False"
+        self.put_event("geofence", msg.payload.decode("utf-8") == "Home")
 
     def on_message_plugged_in(self, client, userdata, msg):
         logging.debug(msg.payload.decode('utf-8'))
-        if msg.payload.decode("utf-8") == "true":
-            if (not self.var_topic_teslamate_plugged_in) and self.var_topic_prevent_non_solar_charge:
-                # If previous state was False, and prevent_non_solar_charge is True, stop charging immediately
-                time.sleep(4)    # Delay to ensure success of the stop command
-                if self.car_cmd.stop_charging() == True:
-                    logging.info("Charging stopped upon plugin, prevent_non_solar_charge active")
-                else:
-                    logging.warning("Charging NOT stopped upon plugin, prevent_non_solar_charge active")
-            self.var_topic_teslamate_plugged_in = True
-        else:
-            self.var_topic_teslamate_plugged_in = False
+        self.put_event("plugged_in", msg.payload.decode("utf-8") == "true")
 
     def on_message_battery_level(self, client, userdata, msg):
         logging.debug(msg.payload.decode('utf-8'))
-        self.var_topic_teslamate_battery_level = int(msg.payload.decode("utf-8"))
+        self.put_event("battery_level", int(msg.payload.decode("utf-8")))
 
     def on_message_charge_limit_soc(self, client, userdata, msg):
         logging.debug(msg.payload.decode('utf-8'))
-        self.var_topic_teslamate_charge_limit_soc = int(msg.payload.decode("utf-8"))
+        self.put_event("charge_limit_soc", int(msg.payload.decode("utf-8")))
 
     def on_message_state(self, client, userdata, msg):
         logging.debug(msg.payload.decode('utf-8'))
-        self.var_topic_teslamate_state = msg.payload.decode("utf-8")
+        self.put_event("state", msg.payload.decode("utf-8"))
+
+    def on_message_reload(self, client, userdata, msg):
+        logging.info("Config reload requested via MQTT")
+        self.put_event("reload", msg.payload.decode("utf-8"))
+
+    def put_event(self, kind, value):
+        self.events.put(MqttEvent(kind, value, time.time()))
+
+    def add_listener(self, listener):
+        """Call listener(event) from the event worker whenever a control topic changes the charging conditions"""
+        self.listeners.append(listener)
+
+    def event_worker(self):
+        while True:
+            event = self.events.get()
+            try:
+                if self.apply_event(event) and event.kind in WAKE_EVENTS:
+                    for listener in self.listeners:
+                        listener(event)
+            except Exception:
+                logging.exception("Failed to handle %s", event)
+
+    def apply_event(self, event):
+        """Update the state from event, returns True if it changed"""
+        if event.kind == "reload":
+            return settings.shared().reload()
+        if event.kind == "charge_delay":
+            changed = bool(event.value or self.var_topic_charge_delay)    # A new delay restarts the wait
+            self.var_topic_charge_delay = event.value
+            self.var_charge_delay_time = event.time if event.value else 0
+            logging.debug("Charge delay: %s minutes", self.var_topic_charge_delay / 60)
+            return changed
+        if event.kind == "plugged_in" and event.value:
+            if (not self.var_topic_teslamate_plugged_in) and self.var_topic_prevent_non_solar_charge:
+                # If previous state was False, and prevent_non_solar_charge is True, stop charging immediately
+                self.actions.put(event)
+        name = EVENT_STATE[event.kind]
+        changed = getattr(self, name) != event.value
+        setattr(self, name, event.value)
+        return changed
+
+    def action_worker(self):
+        """Run car commands triggered by MQTT messages, without holding up the event worker"""
+        while True:
+            event = self.actions.get()
+            time.sleep(max(event.time + 4 - time.time(), 0))    # Delay to ensure success of the stop command
+            if self.car_cmd.stop_charging() == True:
+                logging.info("Charging stopped upon plugin, prevent_non_solar_charge active")
+            else:
+                logging.warning("Charging NOT stopped upon plugin, prevent_non_solar_charge active")
 
     def calculate_charge_tesla(self):
         # Charge if: Car is at Home, Car is plugged in, and battery < charge_limit_soc
@@ -406,7 +787,21 @@ class MqttCallbacks:
                 return False
             else:
                 # We haven't waited long enough, keep waiting
-                logging.debug(f"Charge delay, allowed to charge in: {round(self.var_topic_charge_delay - (loop_time - self.var_charge_delay_time))} seconds")
+                logging.debug("Charge delay, allowed to charge in: %s seconds", round(self.var_topic_charge_delay - (loop_time - self.var_charge_delay_time)))
                 return True
         else:  # No delay is active
             return False
+
+
+def on_connect_all(client, userdata, flags, reason_code, properties):
+    """Subscribe the topics of every car sharing this client, also after a reconnect"""
+    if reason_code != 0:
+        logging.critical("Failed to connect, return code %s\n", reason_code)
+        sys.exit(1)
+    for subscriber in userdata["subscribers"]:
+        subscriber.on_connect(client, userdata, flags, reason_code, properties)
+
+
+def dispatch_message(handlers, client, userdata, msg):
+    for handler in handlers:
+        handler(client, userdata, msg)
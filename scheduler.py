@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import tsstore
+
+
+class CommandScheduler:
+    """Class to sit between the control loop and the car, coalescing and rate limiting charge rate changes
+
+    Charge rate changes are queued with request_rate() and return immediately, only the latest pending
+    target is sent, no sooner than MIN_COMMAND_INTERVAL after the previous one.  Start, stop and wake
+    are sent with command(), ahead of any queued rate change, and are awaited by the caller.
+    """
+    def __init__(self, controller):
+        self.controller = controller
+        self.config = controller.config
+        self.clock = controller.clock
+        self.pending_rate = None
+        self.last_rate_time = -self.min_interval
+        self.rate_requested = asyncio.Event()
+        self.busy = asyncio.Lock()    # One car command at a time
+        self.priority_waiting = 0
+        self.priority_done = asyncio.Event()
+        self.priority_done.set()
+        # Accounting
+        self.stats = {}    # Command name: [sent, succeeded, total latency, max latency]
+        self.coalesced = 0    # Rate requests replaced by a newer target before they were sent
+        self.suppressed = 0    # Rate requests inside the deadband
+
+    # Read on use, so a config reload applies at once
+    @property
+    def deadband(self):
+        return self.config.get("RATE_DEADBAND", 1)
+
+    @property
+    def min_interval(self):
+        return self.config.get("MIN_COMMAND_INTERVAL", 10)
+
+    @property
+    def min_charge(self):
+        return self.config["MIN_CHARGE"]
+
+    def request_rate(self, charge_rate, current_rate):
+        """Queue a charge rate change, replacing any change not yet sent
+
+        Changes inside RATE_DEADBAND are dropped, unless they reach down to MIN_CHARGE: the car has to get
+        there before the delayed stop can start.
+        """
+        if charge_rate == current_rate or (min(charge_rate, current_rate) > self.min_charge and
+                                           abs(charge_rate - current_rate) < self.deadband):
+            if self.pending_rate is not None:
+                logging.debug("Pending charge rate %s no longer needed", self.pending_rate)
+                self.pending_rate = None
+                self.rate_requested.clear()
+            self.suppressed += 1
+            return
+        if self.pending_rate is not None and self.pending_rate != charge_rate:
+            self.coalesced += 1
+        self.pending_rate = charge_rate
+        self.rate_requested.set()
+
+    async def command(self, name, func, *args, **kwargs):
+        """Send a start/stop/wake (or forced rate) command ahead of queued rate changes, returns its result"""
+        if name in ("stop_charging", "set_charge_rate"):
+            self.pending_rate = None    # Superseded by this command
+            self.rate_requested.clear()
+        self.priority_waiting += 1
+        self.priority_done.clear()
+        try:
+            return await self.dispatch(name, func, *args, **kwargs)
+        finally:
+            self.priority_waiting -= 1
+            if self.priority_waiting == 0:
+                self.priority_done.set()
+
+    async def dispatch(self, name, func, *args, **kwargs):
+        async with self.busy:
+            start = self.clock.time()
+            result = await self.controller.car_command(func, *args, **kwargs)
+            self.record(name, result == True, self.clock.time() - start)
+            return result
+
+    async def rate_task(self):
+        """Send queued charge rate changes, at most one per MIN_COMMAND_INTERVAL"""
+        while True:
+            await self.rate_requested.wait()
+            wait = self.last_rate_time + self.min_interval - self.clock.time()
+            if wait > 0:
+                await self.clock.sleep(wait)    # Later requests coalesce meanwhile
+            await self.dispatch_pending()
+
+    async def dispatch_pending(self):
+        """Send the pending charge rate if the minimum interval has passed, then verify it"""
+        if self.pending_rate is None:
+            self.rate_requested.clear()
+            return
+        if self.clock.time() - self.last_rate_time < self.min_interval:
+            return
+        await self.priority_done.wait()
+        charge_rate = self.pending_rate
+        if charge_rate is None:    # Cancelled by a priority command
+            return
+        self.pending_rate = None
+        self.rate_requested.clear()
+        self.last_rate_time = self.clock.time()
+        if await self.dispatch("set_charge_rate", self.controller.car.set_charge_rate, charge_rate, timeout=25) == True:
+            if await self.controller.energy_wait(self.controller.energy.verify_new_charge_rate, charge_rate, timeout=15):
+                logging.info("Car charging, new rate: %s successfully set", charge_rate)
+                self.controller.messages.client.publish(topic=self.config["TOPIC_CHARGE_RATE"], payload=charge_rate,
+                                                        qos=1)
+        else:
+            logging.warning("Car charging, new rate was NOT successfully set")
+
+    def record(self, name, success, elapsed):
+        stats = self.stats.setdefault(name, [0, 0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += success
+        stats[2] += elapsed
+        stats[3] = max(stats[3], elapsed)
+        tsstore.record_command(self.clock.time(), self.controller.vehicle, name, success, elapsed)
+        logging.debug("%s %s in %.2f seconds", name, "succeeded" if success else "failed", elapsed)
+
+    def report(self):
+        """Summary of commands sent, their outcome and latency"""
+        report = ", ".join(f"{name}: {ok}/{sent} ok, avg {total / sent:.1f}s, max {longest:.1f}s"
+                           for name, (sent, ok, total, longest) in self.stats.items())
+        return f"Commands {report or 'none'}; coalesced: {self.coalesced}, deadband: {self.suppressed}"
@@ -0,0 +1,171 @@
+"""config.toml, loaded once and checked against SCHEMA, shared by every module
+
+- Values have native types, the "True"/"False" strings of older config files become bools
+- The values are an immutable mapping, a reload builds a new one and swaps it in with one assignment,
+  so a reader sees either the old or the new config, never a mix
+- reload() is called on SIGHUP or a message on TOPIC_RELOAD, a config that fails the checks is ignored
+- Keys read once at start (RESTART_KEYS) are logged as needing a restart when they change
+"""
+import types
+import logging
+import tomllib
+import threading
+import collections.abc
+
+# Key: type, a float key also takes an int
+SCHEMA = {
+    "LOG_FILE": str, "LOG_LEVEL": str, "LOG_MAX_BYTES": int, "LOG_BACKUPS": int, "LOG_FLUSH_INTERVAL": float,
+    "DEBUG_RING": int,
+    "PREVENT_NON_SOLAR_CHARGE": bool, "ENABLE_TESLA_PROXY": bool, "TESLA_SESSION_CACHE": str,
+    "TOPIC_PREVENT_NON_SOLAR_CHARGE": str, "TOPIC_CHARGE_DELAY": str, "TOPIC_TESLAMATE_GEOFENCE": str,
+    "TOPIC_TESLAMATE_PLUGGED_IN": str, "TOPIC_TESLAMATE_BATTERY_LEVEL": str, "TOPIC_TESLAMATE_CHARGE_LIMIT_SOC": str,
+    "TOPIC_TESLAMATE_STATE": str, "TOPIC_STATUS": str, "TOPIC_CHARGE_RATE": str, "TOPIC_METRICS": str,
+    "TOPIC_RELOAD": str, "TOPIC_STATE": str, "HA_DISCOVERY_PREFIX": str,
+    "MIN_CHARGE": int, "MIN_SOLAR": float, "SLOW_POLLING": float, "FAST_POLLING": float, "MAX_FAST_POLLING": float,
+    "VOLATILE_AMPS": float, "LATITUDE": float, "LONGITUDE": float, "SUN_MARGIN": float,
+    "DELAYED_START_TIME": float, "DELAYED_STOP_TIME": float, "REPORT_DELAY": float, "RATE_DEADBAND": float,
+    "MIN_COMMAND_INTERVAL": float, "LOOP_BUDGET": float, "LOOP_DEADLINE": float, "SAMPLE_TTL": float,
+    "VERIFY_TOLERANCE": float,
+    "SMOOTHING": str, "SMOOTHING_WINDOW": int, "SMOOTHING_ALPHA": float,
+    "PLAN_CHARGING": bool, "CHARGE_DEADLINE": str, "BATTERY_KWH": float, "MAX_CHARGE": int, "PLAN_VOLTAGE": float,
+    "FORECAST_SLOT": int, "FORECAST_DAYS": int,
+    "METRICS_PORT": int, "METRICS_ADDRESS": str,
+    "DATA_DIR": str, "STORE_FLUSH_BYTES": int, "STORE_FLUSH_INTERVAL": float,
+    "CHECKPOINT_FILE": str, "CHECKPOINT_INTERVAL": float, "CHECKPOINT_MAX_AGE": float,
+    "NAME": str, "TESLA_VIN": str, "EGAUGE_CHARGER": str, "EGAUGE_CHARGER_SENSOR": str, "PRIORITY": int,
+}
+REQUIRED = ("LOG_FILE", "LOG_LEVEL", "PREVENT_NON_SOLAR_CHARGE", "TOPIC_PREVENT_NON_SOLAR_CHARGE", "TOPIC_CHARGE_DELAY",
+            "TOPIC_TESLAMATE_GEOFENCE", "TOPIC_TESLAMATE_PLUGGED_IN", "TOPIC_TESLAMATE_BATTERY_LEVEL",
+            "TOPIC_TESLAMATE_CHARGE_LIMIT_SOC", "TOPIC_TESLAMATE_STATE", "TOPIC_STATUS", "TOPIC_CHARGE_RATE",
+            "MIN_CHARGE", "MIN_SOLAR", "SLOW_POLLING", "FAST_POLLING", "DELAYED_START_TIME", "DELAYED_STOP_TIME",
+            "REPORT_DELAY")
+# Read when the connections, files and helper objects are set up, a reload does not change these
+RESTART_KEYS = ("LOG_FILE", "LOG_MAX_BYTES", "LOG_BACKUPS", "LOG_FLUSH_INTERVAL", "DEBUG_RING", "ENABLE_TESLA_PROXY",
+                "TESLA_SESSION_CACHE", "TOPIC_PREVENT_NON_SOLAR_CHARGE", "TOPIC_CHARGE_DELAY",
+                "TOPIC_TESLAMATE_GEOFENCE", "TOPIC_TESLAMATE_PLUGGED_IN", "TOPIC_TESLAMATE_BATTERY_LEVEL",
+                "TOPIC_TESLAMATE_CHARGE_LIMIT_SOC", "TOPIC_TESLAMATE_STATE", "TOPIC_RELOAD", "TOPIC_STATE",
+                "HA_DISCOVERY_PREFIX", "SAMPLE_TTL", "VERIFY_TOLERANCE", "SMOOTHING", "SMOOTHING_WINDOW",
+                "SMOOTHING_ALPHA", "PLAN_CHARGING", "CHARGE_DEADLINE", "BATTERY_KWH", "PLAN_VOLTAGE", "FORECAST_SLOT",
+                "FORECAST_DAYS", "METRICS_PORT", "METRICS_ADDRESS", "DATA_DIR", "STORE_FLUSH_BYTES",
+                "STORE_FLUSH_INTERVAL", "CHECKPOINT_FILE", "TESLA_VIN", "EGAUGE_CHARGER", "EGAUGE_CHARGER_SENSOR",
+                "VEHICLES")
+
+CONFIG = None
+
+
+class Settings(collections.abc.Mapping):
+    """Class to hold the checked, read-only config, one instance per file and per VEHICLES entry"""
+    def __init__(self, filename="config.toml", parent=None, index=None):
+        self.filename = filename
+        self.parent = parent
+        self.index = index    # VEHICLES entry, merged over the parent's values
+        self.children = []
+        self.lock = threading.Lock()    # One reload at a time, readers never wait
+        if parent is None:
+            self.values = check(read(filename))
+        else:
+            self.values = parent.vehicle_values(index)
+
+    def __getitem__(self, key):
+        return self.values[key]
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return f"Settings({self.filename!r}, index={self.index})"
+
+    def vehicle(self, index):
+        """Settings of VEHICLES entry index, keys not set there are taken from this config, reloaded with it"""
+        child = Settings(self.filename, self, index)
+        self.children.append(child)
+        return child
+
+    def vehicle_values(self, index):
+        return freeze({**{key: value for key, value in self.values.items() if key != "VEHICLES"},
+                       **self.values["VEHICLES"][index]})
+
+    def reload(self):
+        """Read the file again and swap in the new values, returns True if they changed"""
+        with self.lock:
+            try:
+                values = check(read(self.filename))
+                if len(values.get("VEHICLES", ())) != len(self.values.get("VEHICLES", ())):
+                    raise ValueError("the number of VEHICLES can only change with a restart")
+            except (OSError, tomllib.TOMLDecodeError, ValueError) as e:
+                logging.warning("Config reload failed, keeping the current config: %s", e)
+                return False
+            changed = self.swap(values)
+            for child in self.children:
+                changed = child.swap(self.vehicle_values(child.index)) or changed
+            if not changed:
+                logging.info("Config reloaded, no changes")
+            return changed
+
+    def swap(self, values):
+        changed = sorted(key for key in values.keys() | self.values.keys()
+                         if key != "VEHICLES" and values.get(key) != self.values.get(key))
+        self.values = values
+        name = "" if self.index is None else f" (vehicle {self.index + 1})"
+        for key in changed:
+            if key in RESTART_KEYS:
+                logging.warning("Config%s: %s changed, takes effect after a restart", name, key)
+            else:
+                logging.info("Config%s: %s = %s", name, key, values.get(key))
+        return bool(changed)
+
+
+def read(filename):
+    with open(filename, mode="rb") as fp:
+        return tomllib.load(fp)
+
+
+def check(raw, where="config.toml", required=REQUIRED):
+    """Converted, frozen copy of raw, raises ValueError naming the first bad key"""
+    values = {}
+    for key in required:
+        if key not in raw:
+            raise ValueError(f"{where}: {key} is missing")
+    for key, value in raw.items():
+        if key == "VEHICLES":
+            values[key] = tuple(check(vehicle, f"VEHICLES[{n}]", ()) for n, vehicle in enumerate(value))
+            continue
+        values[key] = convert(key, value, where)
+    return freeze(values)
+
+
+def convert(key, value, where):
+    kind = SCHEMA.get(key)
+    if kind is None:
+        return value    # Unknown keys are passed through unchecked
+    if kind is bool:
+        if isinstance(value, str) and value in ("True", "False"):
+            return value == "True"
+        if isinstance(value, bool):
+            return value
+        raise ValueError(f"{where}: {key} must be true/false (or \"True\"/\"False\"), not {value!r}")
+    if kind is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    if isinstance(value, kind) and not isinstance(value, bool):
+        return value
+    raise ValueError(f"{where}: {key} must be {'a number' if kind is float else kind.__name__}, not {value!r}")
+
+
+def freeze(values):
+    return types.MappingProxyType(values)
+
+
+def snapshot(config):
+    """The current values of config, which stay the same while a reload swaps in new ones"""
+    return config.values if isinstance(config, Settings) else config
+
+
+def shared(filename="config.toml"):
+    """The config every module uses, loaded on the first call"""
+    global CONFIG
+    if CONFIG is None:
+        CONFIG = Settings(filename)
+    return CONFIG
@@ -0,0 +1,357 @@
+"""Offline plant simulator, replays generation/usage traces through the PVCharge control loop on a virtual clock
+
+Run from the PVCharge directory (routines.py reads config.toml on import):
+    python simulator.py trace.csv [trace.csv ...]
+    python simulator.py --synthetic 1
+
+Trace CSV columns: time (epoch seconds or ISO 8601), generation (W), usage (W, house load without the car)
+"""
+import sys
+import csv
+import math
+import bisect
+import random
+import asyncio
+import threading
+import argparse
+import logging
+import datetime
+import routines
+import controller
+import publisher
+from convergence import ConvergenceDetector
+
+
+class VirtualClock:
+    """Clock for the controller, time only moves when something sleeps, and the plant is integrated as it moves"""
+    def __init__(self, start, plant=None):
+        self.now = start
+        self.plant = plant
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        if self.plant is not None:
+            self.plant.integrate(self.now, self.now + seconds)
+        self.now += seconds
+
+    async def sleep(self, seconds):
+        self.advance(seconds)
+        await asyncio.sleep(0)
+
+
+class Trace:
+    """Generation and house usage over time, held constant between samples"""
+    def __init__(self, times, generation, usage):
+        self.times = times
+        self.generation = generation
+        self.usage = usage
+
+    @classmethod
+    def from_csv(cls, filename):
+        times, generation, usage = [], [], []
+        with open(filename, newline="") as fp:
+            for row in csv.DictReader(fp):
+                times.append(parse_time(row["time"]))
+                generation.append(float(row["generation"]))
+                usage.append(float(row["usage"]))
+        return cls(times, generation, usage)
+
+    @classmethod
+    def synthetic(cls, days=1, peak=6000, house=600, clouds=0.3, step=60, seed=1):
+        """Clear-sky bell curve from 06:00 to 20:00 with random cloud dips, and a constant house load"""
+        rng = random.Random(seed)
+        start = datetime.datetime(2024, 6, 1).timestamp()
+        times, generation, usage = [], [], []
+        cloud = 1.0
+        for t in range(0, days * 86400, step):
+            hour = (t % 86400) / 3600
+            sun = max(math.sin(math.pi * (hour - 6) / 14), 0) if 6 <= hour <= 20 else 0
+            if rng.random() < clouds * step / 600:    # A cloud passes now and then
+                cloud = rng.uniform(0.2, 0.7)
+            else:
+                cloud = min(cloud + 0.1, 1.0)
+            times.append(start + t)
+            generation.append(peak * sun * cloud)
+            usage.append(house + rng.uniform(-100, 100))
+        return cls(times, generation, usage)
+
+    def at(self, t):
+        index = max(bisect.bisect_right(self.times, t) - 1, 0)
+        return self.generation[index], self.usage[index]
+
+
+class CarModel:
+    """Car and charger, current follows the requested amps with a start delay and a limited ramp rate"""
+    def __init__(self, clock, soc=50, charge_limit_soc=80, capacity_kwh=75, max_amps=32, voltage=240,
+                 ramp_rate=2.0, start_delay=3.0, command_latency=1.5):
+        self.clock = clock
+        self.soc = soc
+        self.charge_limit_soc = charge_limit_soc
+        self.capacity_kwh = capacity_kwh
+        self.max_amps = max_amps
+        self.voltage = voltage
+        self.ramp_rate = ramp_rate    # A/s
+        self.start_delay = start_delay    # Seconds between charge_start and current flowing
+        self.command_latency = command_latency    # Seconds each BLE command takes
+        self.charging = False
+        self.asleep = True
+        self.target_amps = max_amps
+        self.amps = 0.0
+        self.charging_since = 0
+
+    def step(self, seconds):
+        """Move the charger current toward its target and add the energy to the battery"""
+        if self.charging and self.soc >= self.charge_limit_soc:
+            self.charging = False
+        target = 0.0
+        if self.charging and (self.clock.now - self.charging_since) >= self.start_delay:
+            target = self.target_amps
+        change = max(min(target - self.amps, self.ramp_rate * seconds), -self.ramp_rate * seconds)
+        self.amps += change
+        self.soc += self.power() * seconds / 3600 / (self.capacity_kwh * 1000) * 100
+
+    def power(self):
+        return self.amps * self.voltage
+
+
+class Plant:
+    """Trace playback plus the car, accumulating the energy flows used for the report"""
+    def __init__(self, trace, car):
+        self.trace = trace
+        self.car = car
+        self.surplus_wh = 0.0    # Solar left over after the house load
+        self.car_wh = 0.0
+        self.car_solar_wh = 0.0
+        self.grid_import_wh = 0.0
+
+    def integrate(self, start, end, resolution=1.0):
+        t = start
+        while t < end:
+            dt = min(resolution, end - t)
+            generation, usage = self.trace.at(t)
+            self.car.step(dt)
+            car = self.car.power()
+            surplus = max(generation - usage, 0)
+            self.surplus_wh += surplus * dt / 3600
+            self.car_wh += car * dt / 3600
+            self.car_solar_wh += min(car, surplus) * dt / 3600
+            self.grid_import_wh += max(usage + car - generation, 0) * dt / 3600
+            t += dt
+
+
+class FakePowerUsage(routines.PowerUsage):
+    """PowerUsage reading the plant instead of an eGauge, the rate calculation itself is the real one"""
+    def __init__(self, plant, clock):
+        self.plant = plant
+        self.clock = clock
+        self.generation_reg = 0
+        self.usage_reg = 0
+        self.tesla_charger_reg = 0
+        self.charger_regs = [0]
+        self.charge_rate_sensor = 0
+        self.charge_rate_sensors = [0]
+        self.charger_voltage_sensor = 0
+        self.new_charge_rate = 0
+        self.sample_ttl = 0    # Every request is a new sample, virtual time does not move time.monotonic()
+        self.snapshot = routines.EnergySnapshot(-math.inf, 0, 0, 0, 0, 0)
+        self.init_history()
+        self.convergence = ConvergenceDetector(sleep=clock.advance, now=clock.time)
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.sensor_reads = 0
+
+    def sample_register(self, timeout=30):
+        generation, usage = self.plant.trace.at(self.clock.now)
+        self.samples += 1
+        self.generation_reg = generation
+        self.usage_reg = usage + self.plant.car.power()
+        self.tesla_charger_reg = self.plant.car.power()
+        self.charger_regs = [self.tesla_charger_reg]
+
+    def sample_sensor(self, timeout=30):
+        self.sensor_reads += 1
+        self.charger_voltage_sensor = self.plant.car.voltage
+        self.charge_rate_sensor = self.plant.car.amps
+        self.charge_rate_sensors = [self.charge_rate_sensor]
+        self.snapshot = self.snapshot._replace(charge_rate=self.charge_rate_sensor,
+                                               charger_voltage=self.charger_voltage_sensor,
+                                               charge_rates=tuple(self.charge_rate_sensors))
+
+
+class FakeClient:
+    """Stand-in for the paho client, keeps published messages"""
+    def __init__(self):
+        self.published = []
+        self.userdata = {"subscribers": [], "handlers": {}}
+
+    def user_data_get(self):
+        return self.userdata
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+class FakeMqttCallbacks(routines.MqttCallbacks):
+    """MqttCallbacks with TeslaMate values taken from the car model instead of the broker"""
+    def __init__(self, car, prevent_non_solar_charge=False):
+        self.car = car
+        self.client = FakeClient()
+        self.var_topic_prevent_non_solar_charge = prevent_non_solar_charge
+        self.var_topic_charge_delay = 0
+        self.var_charge_delay_time = 0
+        self.var_topic_teslamate_geofence = True
+        self.var_topic_teslamate_plugged_in = True
+        self.update()
+
+    def update(self):
+        """TeslaMate publishes whole percent values"""
+        self.var_topic_teslamate_battery_level = int(self.car.soc)
+        self.var_topic_teslamate_charge_limit_soc = self.car.charge_limit_soc
+        self.var_topic_teslamate_state = "asleep" if self.car.asleep else "online"
+
+
+class FakeCar:
+    """Command interface of TeslaCommands/TeslaProxy, acting on the car model"""
+    def __init__(self, car, clock):
+        self.car = car
+        self.clock = clock
+        self.commands = {}
+
+    def command(self, name):
+        self.commands[name] = self.commands.get(name, 0) + 1
+        self.clock.advance(self.car.command_latency)
+        return not self.car.asleep or name == "wake"
+
+    def set_charge_rate(self, charge_rate, timeout=25):
+        if self.command("set_charge_rate"):
+            self.car.target_amps = max(min(charge_rate, self.car.max_amps), 0)
+            return True
+        return False
+
+    def start_charging(self, timeout=25):
+        if self.command("start_charging") and self.car.soc < self.car.charge_limit_soc:
+            if not self.car.charging:
+                self.car.charging = True
+                self.car.charging_since = self.clock.now
+            return True
+        return False
+
+    def stop_charging(self, timeout=25):
+        if self.command("stop_charging"):
+            self.car.charging = False
+            return True
+        return False
+
+    def wake(self, timeout=25):
+        self.command("wake")
+        self.car.asleep = False
+        return True
+
+
+class Simulation:
+    """Runs the controller decision logic over a trace, the way the control and energy tasks would"""
+    def __init__(self, trace, config=None, car_options=None, prevent_non_solar_charge=False, planner=None):
+        self.config = config or routines.config
+        self.trace = trace
+        self.clock = VirtualClock(trace.times[0])
+        self.car = CarModel(self.clock, **(car_options or {}))
+        self.plant = Plant(trace, self.car)
+        self.clock.plant = self.plant
+        self.energy = FakePowerUsage(self.plant, self.clock)
+        self.messages = FakeMqttCallbacks(self.car, prevent_non_solar_charge)
+        self.car_cmd = FakeCar(self.car, self.clock)
+        self.planner = planner
+        self.controller = controller.ChargeController(self.config, self.energy, self.messages, self.car_cmd,
+                                                      clock=self.clock, planner=planner)
+
+    async def run(self):
+        end = self.trace.times[-1]
+        self.passes = 0
+        while self.clock.now < end:
+            self.energy.calculate_charge_rate(True)
+            if self.planner is not None:    # The forecast learns from the trace as it plays
+                snapshot = self.energy.snapshot
+                self.planner.forecast.update(self.clock.now, snapshot.generation - (snapshot.usage - snapshot.tesla_charger))
+            self.messages.update()
+            fast_polling = await self.controller.step(self.clock.now)
+            await self.controller.scheduler.dispatch_pending()
+            self.controller.fast_polling = fast_polling
+            if self.controller.publisher is not None:
+                self.controller.publisher.publish(self.controller.state_fields())
+                self.passes += 1
+            polling = self.controller.sampler.polling
+            if fast_polling:
+                interval = polling.fast_interval(self.controller.car_is_charging)
+            else:
+                interval = polling.slow_interval(self.controller.watch_car())
+            self.clock.advance(min(interval, end - self.clock.now))    # A night's sleep may run past the trace
+        return self.report()
+
+    def report(self):
+        plant = self.plant
+        return {
+            "days": (self.trace.times[-1] - self.trace.times[0]) / 86400,
+            "surplus_kwh": plant.surplus_wh / 1000,
+            "car_kwh": plant.car_wh / 1000,
+            "car_solar_kwh": plant.car_solar_wh / 1000,
+            "solar_capture_ratio": plant.car_solar_wh / plant.surplus_wh if plant.surplus_wh else 0,
+            "grid_import_kwh": plant.grid_import_wh / 1000,
+            "car_commands": sum(self.car_cmd.commands.values()),
+            "commands": dict(self.car_cmd.commands),
+            "egauge_samples": self.energy.samples,
+            "sensor_reads": self.energy.sensor_reads,
+            "state_fields": self.passes * len(publisher.FIELDS),
+            "state_publishes": self.controller.publisher.published if self.controller.publisher else 0,
+            "final_soc": self.car.soc,
+        }
+
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def print_report(name, report):
+    print(f"{name}:")
+    print(f"   Days simulated: {report['days']:.2f}")
+    print(f"    Solar surplus: {report['surplus_kwh']:.2f} kWh")
+    print(f"   Car energy use: {report['car_kwh']:.2f} kWh ({report['car_solar_kwh']:.2f} kWh solar)")
+    print(f"    Solar capture: {report['solar_capture_ratio'] * 100:.1f} %")
+    print(f"      Grid import: {report['grid_import_kwh']:.2f} kWh")
+    print(f"     Car commands: {report['car_commands']} {report['commands']}")
+    print(f"   eGauge samples: {report['egauge_samples']}")
+    print(f"     Sensor reads: {report['sensor_reads']}")
+    print(f"  State publishes: {report['state_publishes']} of {report['state_fields']} field updates")
+    print(f"        Final SOC: {report['final_soc']:.1f} %")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay generation/usage traces through the PVCharge control loop")
+    parser.add_argument("traces", nargs="*", help="CSV trace files (time, generation, usage)")
+    parser.add_argument("--synthetic", type=int, metavar="DAYS", help="Simulate synthetic days instead of a trace")
+    parser.add_argument("--soc", type=float, default=50, help="Battery level at the start (percent)")
+    parser.add_argument("--limit", type=int, default=80, help="Charge limit SOC (percent)")
+    parser.add_argument("--plan", action="store_true", help="Plan charging from a forecast learnt over the trace")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    traces = [(filename, Trace.from_csv(filename)) for filename in args.traces]
+    if args.synthetic:
+        traces.append((f"{args.synthetic} synthetic day(s)", Trace.synthetic(days=args.synthetic)))
+    if not traces:
+        parser.error("provide a trace file or --synthetic")
+    for name, trace in traces:
+        planner = None
+        if args.plan:
+            import forecast
+            planner = forecast.ChargePlanner(routines.config, forecast.SurplusForecast(routines.config.get("FORECAST_SLOT", 900)))
+        simulation = Simulation(trace, car_options={"soc": args.soc, "charge_limit_soc": args.limit}, planner=planner)
+        print_report(name, asyncio.run(simulation.run()))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+import bisect
+from array import array
+
+
+class SampleRing:
+    """Fixed-size ring of float samples in a compact array, with incremental EWMA, mean, variance and median"""
+    def __init__(self, size, alpha=0.3):
+        self.size = size
+        self.alpha = alpha
+        self.values = array('d', bytes(8 * size))
+        self.ordered = []    # Same samples kept sorted, for the median
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.ewma = None
+        self.appended = 0
+
+    def append(self, value):
+        if self.count == self.size:    # Drop the oldest sample
+            old = self.values[self.index]
+            self.total -= old
+            self.total_sq -= old * old
+            del self.ordered[bisect.bisect_left(self.ordered, old)]
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.total += value
+        self.total_sq += value * value
+        bisect.insort(self.ordered, value)
+        if self.ewma is None:
+            self.ewma = value
+        else:
+            self.ewma += self.alpha * (value - self.ewma)
+        self.appended += 1
+        if self.appended % (self.size * 64) == 0:
+            # Running sums collect floating point error, rebuild them from the array now and then
+            self.total = sum(self.ordered)
+            self.total_sq = sum(v * v for v in self.ordered)
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total / self.count
+
+    def variance(self):
+        if self.count == 0:
+            return 0.0
+        mean = self.total / self.count
+        return max(self.total_sq / self.count - mean * mean, 0.0)
+
+    def median(self):
+        if self.count == 0:
+            return 0.0
+        middle = self.count // 2
+        if self.count % 2:
+            return self.ordered[middle]
+        return (self.ordered[middle - 1] + self.ordered[middle]) / 2
+
+    def latest(self):
+        if self.count == 0:
+            return 0.0
+        return self.values[self.index - 1]
+
+    def smoothed(self, method):
+        """Value for the configured smoothing method: "ewma", "median" or "none" (latest sample)"""
+        if self.count == 0:
+            return 0.0
+        if method == "ewma":
+            return self.ewma
+        elif method == "median":
+            return self.median()
+        return self.latest()
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The modules live at the top of the repository, and the bench stubs next to them
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+
+import settings
+
+# Modules load config.toml from the working directory on import, the tests use the example
+settings.shared(os.path.join(ROOT, "example_config.toml"))
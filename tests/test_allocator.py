@@ -0,0 +1,46 @@
+import types
+import allocator
+
+
+def messages(battery_level, charge_tesla=True):
+    return types.SimpleNamespace(calculate_charge_tesla=lambda: charge_tesla,
+                                 var_topic_teslamate_battery_level=battery_level)
+
+
+def power(available, chargers=(0, 0)):
+    return types.SimpleNamespace(calculate_charge_rate=lambda new_sample, smoothing=None: available,
+                                 snapshot=types.SimpleNamespace(charger_voltage=240, chargers=chargers))
+
+
+def vehicle(priority=1, min_charge=6, max_charge=16):
+    return {"PRIORITY": priority, "MIN_CHARGE": min_charge, "MAX_CHARGE": max_charge}
+
+
+def test_split_by_priority_before_battery_level():
+    surplus = allocator.SurplusAllocator(power(20))
+    surplus.add_vehicle(vehicle(priority=2), messages(20))
+    surplus.add_vehicle(vehicle(priority=1), messages(80))
+    assert surplus.allocate() == [4, 16]
+
+
+def test_lowest_battery_first_at_equal_priority():
+    surplus = allocator.SurplusAllocator(power(20))
+    first = surplus.add_vehicle(vehicle(), messages(70))
+    second = surplus.add_vehicle(vehicle(), messages(30))
+    assert surplus.allocate() == [4, 16]
+    assert second.calculate_charge_rate(False) == 16
+    assert not first.sufficient_generation(6, new_sample=False)
+
+
+def test_share_below_min_charge_goes_to_the_next_car():
+    surplus = allocator.SurplusAllocator(power(10))
+    surplus.add_vehicle(vehicle(priority=1, min_charge=12, max_charge=32), messages(20))
+    surplus.add_vehicle(vehicle(priority=2), messages(20))
+    assert surplus.allocate() == [10, 10]
+
+
+def test_car_that_may_not_charge_keeps_nothing():
+    surplus = allocator.SurplusAllocator(power(20, chargers=(2400, 0)))    # Charging at 10 A anyway
+    surplus.add_vehicle(vehicle(), messages(20, charge_tesla=False))
+    surplus.add_vehicle(vehicle(), messages(50))
+    assert surplus.allocate() == [0, 10]
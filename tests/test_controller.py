@@ -0,0 +1,53 @@
+import asyncio
+import routines
+import settings
+import controller
+import simulator
+
+
+class FirstReadTimesOut(simulator.FakePowerUsage):
+    """The eGauge does not answer the first register read"""
+    def __init__(self, plant, clock):
+        super().__init__(plant, clock)
+        self.timeouts = 1
+
+    def sample_register(self, timeout=30):
+        if self.timeouts:
+            self.timeouts -= 1
+            return 'Timeout'
+        return super().sample_register(timeout)
+
+
+def build(config):
+    trace = simulator.Trace.synthetic()
+    clock = simulator.VirtualClock(trace.times[0] + 12 * 3600)
+    car = simulator.CarModel(clock)
+    clock.plant = simulator.Plant(trace, car)
+    energy = FirstReadTimesOut(clock.plant, clock)
+    messages = simulator.FakeMqttCallbacks(car)
+    messages.listeners = []
+    charge_controller = controller.ChargeController(config, energy, messages, simulator.FakeCar(car, clock), clock=clock)
+    return energy, charge_controller
+
+
+def test_no_rate_without_a_charger_voltage():
+    energy, charge_controller = build(routines.config)
+    assert energy.calculate_charge_rate(False) == 0
+    assert energy.calculate_charge_rate(False, smoothing="ewma") == 0
+
+
+def test_first_sample_timing_out_leaves_the_control_loop_running():
+    config = dict(settings.snapshot(routines.config), FAST_POLLING=0.02, MAX_FAST_POLLING=0.02, SLOW_POLLING=0.1)
+    energy, charge_controller = build(config)
+
+    async def run():
+        try:
+            await asyncio.wait_for(controller.run_all([charge_controller]), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+    asyncio.run(run())
+    assert energy.timeouts == 0
+    assert energy.samples > 1
+    assert charge_controller.last_step_time
+    assert energy.new_charge_rate != 0    # Computed from the samples after the timeout
@@ -0,0 +1,78 @@
+import time
+import asyncio
+import threading
+import types
+import controller
+import routines
+from convergence import ConvergenceDetector
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return self.now
+
+
+def car(clock, target, settle):
+    """Charger current read by the detector, at target settle seconds after the change"""
+    started = clock.time()
+    return lambda: target if clock.time() - started >= settle else 0
+
+
+def learned(clock, detector, settle, changes=3):
+    for _ in range(changes):
+        assert detector.wait(car(clock, 10, settle), 10, 30)
+
+
+def test_settle_time_is_learned():
+    clock = FakeClock()
+    detector = ConvergenceDetector(sleep=clock.sleep, now=clock.time)
+    learned(clock, detector, 5)
+    assert 4 < detector.expected(0, "rate", 10) < 6
+
+
+def test_gives_up_early_once_learned():
+    clock = FakeClock()
+    detector = ConvergenceDetector(sleep=clock.sleep, now=clock.time)
+    learned(clock, detector, 5)
+    started = clock.time()
+    assert not detector.wait(car(clock, 10, 100), 10, 30)
+    assert clock.time() - started < 15
+
+
+def test_slower_car_is_verified_after_a_miss():
+    clock = FakeClock()
+    detector = ConvergenceDetector(sleep=clock.sleep, now=clock.time)
+    learned(clock, detector, 5)
+    before = detector.expected(0, "rate", 10)
+    assert not detector.wait(car(clock, 10, 20), 10, 30)    # Slower than twice the estimate
+    assert detector.expected(0, "rate", 10) > before
+    assert detector.give_up_after(0, "rate", 10, 30) == 30
+    assert detector.wait(car(clock, 10, 20), 10, 30)
+
+
+def test_sampling_continues_while_a_charge_rate_is_verified():
+    energy = types.SimpleNamespace(lock=threading.Lock())
+    sampler = controller.EnergySampler(routines.config, energy)
+    events = []
+
+    def verify():
+        for _ in range(2):
+            with energy.lock:
+                events.append("read")
+            time.sleep(0.2)
+        events.append("verified")
+
+    async def both():
+        waiting = asyncio.create_task(sampler.energy_wait(verify))
+        await asyncio.sleep(0.05)
+        await sampler.energy_call(events.append, "sample")
+        await waiting
+
+    asyncio.run(both())
+    assert events.index("sample") < events.index("verified")
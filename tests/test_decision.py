@@ -0,0 +1,37 @@
+import decision
+
+CONFIG = {"MIN_CHARGE": 6, "DELAYED_START_TIME": 10, "DELAYED_STOP_TIME": 90}
+CHARGING = decision.LoopState(True, 0, 0)
+
+
+def inputs(charge_rate=2.0, planned_rate=0, prevent_non_solar_charge=False, charge_rate_sensor=10.0):
+    return decision.Inputs(time=1000, charge_tesla=True, sun_up=True, charge_delay=False,
+                           prevent_non_solar_charge=prevent_non_solar_charge, charge_rate=charge_rate,
+                           planned_rate=planned_rate, charge_rate_sensor=charge_rate_sensor, battery_level=50,
+                           charge_limit_soc=80, car_state="online")
+
+
+def test_planned_rate_tops_up_the_surplus():
+    result = decision.decide(CHARGING, inputs(planned_rate=12), CONFIG)
+    assert result.decision == "set_rate"
+    assert result.rate == 12
+
+
+def test_prevent_non_solar_charge_overrides_the_plan():
+    result = decision.decide(CHARGING, inputs(planned_rate=12, prevent_non_solar_charge=True), CONFIG)
+    assert result.decision == "reduce_to_min"
+    assert result.rate == 6
+
+
+def test_plan_does_not_start_a_grid_charge_when_prevented():
+    stopped = decision.LoopState(False, 0, 0)
+    result = decision.decide(stopped, inputs(planned_rate=12, prevent_non_solar_charge=True, charge_rate_sensor=0),
+                             CONFIG)
+    assert result.decision == "insufficient"
+    assert result.actions == ()
+
+
+def test_surplus_still_charges_when_non_solar_is_prevented():
+    result = decision.decide(CHARGING, inputs(charge_rate=14.7, prevent_non_solar_charge=True), CONFIG)
+    assert result.decision == "set_rate"
+    assert result.rate == 14
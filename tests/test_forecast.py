@@ -0,0 +1,57 @@
+import math
+import time
+import datetime
+import pytest
+
+np = pytest.importorskip("numpy")    # Charge planning is optional
+import forecast
+
+YESTERDAY = time.mktime(datetime.date(2024, 6, 1).timetuple())
+TODAY = YESTERDAY + 86400
+CONFIG = {"MIN_CHARGE": 6, "MAX_CHARGE": 32, "PLAN_VOLTAGE": 240, "BATTERY_KWH": 75, "CHARGE_DEADLINE": "18:00"}
+
+
+def learned(peak):
+    """Forecast that has seen one clear day with a surplus peaking at peak W"""
+    surplus = forecast.SurplusForecast(slot=900, days=3)
+    for t in range(0, 86400, 300):
+        hour = t / 3600
+        surplus.update(YESTERDAY + t, peak * max(math.sin(math.pi * (hour - 6) / 14), 0))
+    surplus.update(TODAY, 0)    # Midnight, yesterday moves into the history
+    return surplus
+
+
+def test_new_day_moves_into_the_history():
+    surplus = learned(6000)
+    assert surplus.known_days() == 1
+    noon = 12 * 4
+    assert surplus.profile()[noon] == pytest.approx(6000 * math.sin(math.pi * 6 / 14), rel=0.05)
+
+
+def test_no_plan_without_history():
+    planner = forecast.ChargePlanner(CONFIG, forecast.SurplusForecast(slot=900, days=3))
+    assert planner.rate_at(TODAY + 8 * 3600, 50, 80) == 0
+
+
+def test_sunny_forecast_leaves_charging_to_the_surplus():
+    planner = forecast.ChargePlanner(CONFIG, learned(8000))
+    plan = planner.make_plan(TODAY + 8 * 3600, 70, 80)
+    assert plan.solar_only and plan.reachable
+    assert plan.solar_fraction == 1.0
+    assert planner.rate_at(TODAY + 12 * 3600, 70, 80) == 0
+
+
+def test_tops_up_in_the_sunniest_slots_when_the_forecast_falls_short():
+    planner = forecast.ChargePlanner(CONFIG, learned(2500))
+    now = TODAY + 8 * 3600
+    plan = planner.make_plan(now, 20, 80)
+    assert not plan.solar_only
+    assert plan.reachable
+    assert 0 < plan.solar_fraction < 1
+    topped_up = plan.amps > plan.surplus
+    assert topped_up.any()
+    # The grid fills the sunniest slots first
+    assert plan.surplus[topped_up].min() >= plan.surplus[~topped_up & (plan.amps == 0)].max(initial=0)
+    assert all(amps == 0 or 6 <= amps <= 32 for amps in plan.amps)
+    noon = TODAY + 13 * 3600
+    assert planner.rate_at(noon, 20, 80) >= 6
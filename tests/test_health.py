@@ -0,0 +1,64 @@
+import asyncio
+import health
+from stub_notify_socket import start_notify_socket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def watchdog(config=None):
+    notify = start_notify_socket()
+    clock = FakeClock()
+    recovered = []
+    dog = health.Watchdog(config or {"LOOP_DEADLINE": 90}, health.SystemdNotifier(notify.environ(20)),
+                          recovered.append, clock)
+    return notify, clock, recovered, dog
+
+
+def test_ready_and_pings_while_on_time():
+    notify, clock, recovered, dog = watchdog()
+    try:
+        asyncio.run(asyncio.wait_for(dog.run(), 0.2))
+    except asyncio.TimeoutError:
+        pass
+    assert notify.wait_for("READY=1", 2)
+    assert notify.wait_for("WATCHDOG=1", 2)
+    assert notify.last("READY=1") <= notify.last("WATCHDOG=1")
+    notify.close()
+
+
+def test_hung_loop_is_recovered_once_and_pings_resume():
+    notify, clock, recovered, dog = watchdog()
+    dog.begin("Control loop 1")
+    clock.now = 100
+    assert not dog.check()
+    assert not dog.check()
+    assert notify.wait_for("STATUS=Recovering Control loop 1", 2)
+    assert recovered == ["Control loop 1"]
+    dog.end("Control loop 1")    # Ended late, still no pings
+    assert not dog.check()
+    dog.begin("Control loop 1")
+    clock.now = 110
+    dog.end("Control loop 1")
+    assert dog.check()
+    assert notify.wait_for("WATCHDOG=1", 2)
+    assert notify.count("WATCHDOG=1") == 1
+    assert notify.count("STATUS=Recovering Control loop 1") == 1
+    assert notify.last("STATUS=Running") <= notify.last("WATCHDOG=1")
+    notify.close()
+
+
+def test_default_deadline_covers_the_not_charging_back_off():
+    notify, clock, recovered, dog = watchdog({"LOOP_BUDGET": 60})
+    assert dog.deadline >= 60 + 60
+    dog.begin("Control loop 1")
+    clock.now = 60 + 25 + 60 + 2    # A stop pass with a rate command in flight and the back-off
+    dog.end("Control loop 1")
+    assert dog.check()
+    assert notify.wait_for("WATCHDOG=1", 2)
+    notify.close()
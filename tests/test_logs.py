@@ -0,0 +1,94 @@
+import os
+import logging
+import logs
+
+
+def make_handler(tmp_path, max_bytes=1000000, flush_interval=30):
+    handler = logs.BufferedRotatingFileHandler(str(tmp_path / "PVCharge.log"), max_bytes, 3, flush_interval)
+    handler.setFormatter(logging.Formatter(logs.FORMAT, logs.DATEFMT))
+    return handler
+
+
+def record(message, level=logging.INFO):
+    return logging.makeLogRecord({"msg": message, "levelno": level, "levelname": logging.getLevelName(level)})
+
+
+def test_records_stay_buffered_until_the_flush_interval(tmp_path):
+    handler = make_handler(tmp_path)
+    for n in range(50):
+        handler.handle(record(f"Info record {n}"))
+    assert os.path.getsize(handler.baseFilename) == 0
+    handler.last_flush -= 30    # The interval has passed
+    handler.handle(record("One more"))
+    assert os.path.getsize(handler.baseFilename) > 0
+    handler.close()
+
+
+def test_warning_is_written_at_once(tmp_path):
+    handler = make_handler(tmp_path)
+    handler.handle(record("Info record"))
+    assert os.path.getsize(handler.baseFilename) == 0
+    handler.handle(record("Warning record", logging.WARNING))
+    with open(handler.baseFilename) as fp:
+        assert fp.read().count("\n") == 2
+    handler.close()
+
+
+def test_rotates_at_max_bytes(tmp_path):
+    handler = make_handler(tmp_path, max_bytes=2000)
+    for n in range(100):
+        handler.handle(record(f"Info record {n}"))
+    handler.close()
+    assert os.path.exists(handler.baseFilename + ".1")
+    assert os.path.getsize(handler.baseFilename) < 2000
+    assert os.path.getsize(handler.baseFilename + ".1") < 2000
+
+
+def test_size_counts_the_existing_file(tmp_path):
+    with open(tmp_path / "PVCharge.log", "w") as fp:
+        fp.write("x" * 1990)
+    handler = make_handler(tmp_path, max_bytes=2000)
+    handler.handle(record("Info record"))
+    handler.close()
+    assert os.path.getsize(handler.baseFilename + ".1") == 1990
+
+
+def setup(tmp_path, **config):
+    root = logging.getLogger()
+    saved = root.handlers[:], root.level
+    logs.setup_logging({"LOG_FILE": str(tmp_path / "PVCharge.log"), "LOG_LEVEL": "INFO", **config})
+    return saved
+
+
+def restore(saved):
+    root = logging.getLogger()
+    root.handlers[:], level = saved
+    root.setLevel(level)
+
+
+def test_shutdown_writes_queued_and_buffered_records(tmp_path):
+    saved = setup(tmp_path)
+    try:
+        logging.info("Stopping soon")
+        logs.shutdown()
+    finally:
+        restore(saved)
+    with open(tmp_path / "PVCharge.log") as fp:
+        assert "Stopping soon" in fp.read()
+
+
+def test_debug_ring_keeps_library_debug_out(tmp_path):
+    saved = setup(tmp_path, DEBUG_RING=10)
+    try:
+        assert not logging.getLogger("urllib3").isEnabledFor(logging.DEBUG)
+        logging.getLogger("urllib3").debug("Starting new HTTP connection")
+        logging.debug("Charge rate sensor: 16.00")
+        logging.warning("eGauge read timed out")
+        logs.shutdown()
+    finally:
+        restore(saved)
+        logging.getLogger("urllib3").setLevel(logging.NOTSET)
+    with open(tmp_path / "PVCharge.log") as fp:
+        log = fp.read()
+    assert "Charge rate sensor" in log and "eGauge read timed out" in log
+    assert "HTTP connection" not in log
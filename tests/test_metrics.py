@@ -0,0 +1,14 @@
+import urllib.request
+import metrics
+
+
+def test_metrics_served_on_localhost_by_default():
+    server = metrics.start_http_server(0)
+    try:
+        address, port = server.server_address
+        assert address == "127.0.0.1"
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as reply:
+            assert b"pvcharge_loop_seconds" in reply.read()
+    finally:
+        server.shutdown()
+        server.server_close()
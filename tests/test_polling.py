@@ -0,0 +1,66 @@
+import types
+import polling
+from smoothing import SampleRing
+
+NOON = 1717264800    # 2024-06-01 12:00 in Denver (MDT)
+EVENING = NOON + 11 * 3600    # 23:00, sunset was at 20:22
+CONFIG = {"FAST_POLLING": 2, "MAX_FAST_POLLING": 10, "VOLATILE_AMPS": 2, "MIN_CHARGE": 6, "SLOW_POLLING": 60,
+          "LATITUDE": 39.74, "LONGITUDE": -104.99, "SUN_MARGIN": 1800}
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def adaptive(surplus, now=NOON, **config):
+    history = {"surplus": SampleRing(15), "charger_voltage": SampleRing(15)}
+    for watts in surplus:
+        history["surplus"].append(watts)
+        history["charger_voltage"].append(240)
+    energy = types.SimpleNamespace(history=history)
+    return polling.AdaptivePolling({**CONFIG, **config}, energy, FakeClock(now))
+
+
+def test_interval_stretches_as_the_surplus_steadies():
+    assert adaptive([2400] * 10).fast_interval(charging=True) == 10
+    assert adaptive([2400, 4800] * 5).fast_interval(charging=True) == 2
+
+
+def test_far_below_min_charge_polls_slowly_until_charging():
+    volatile_and_low = [960, 0] * 5
+    assert adaptive(volatile_and_low).fast_interval(charging=False) == 10
+    assert adaptive(volatile_and_low).fast_interval(charging=True) == 2
+
+
+def test_sun_times_in_denver():
+    sunrise, sunset = polling.sun_times(NOON, 39.74, -104.99)
+    assert abs(sunrise - (NOON - 6 * 3600 - 26 * 60)) < 300    # 05:34
+    assert abs(sunset - (NOON + 8 * 3600 + 22 * 60)) < 300    # 20:22
+
+
+def test_no_polling_after_sunset():
+    evening = adaptive([], now=EVENING)
+    sunrise, _ = polling.sun_times(EVENING + 86400, 39.74, -104.99)
+    assert evening.night_remaining() == sunrise - 1800 - EVENING
+    assert evening.slow_interval() == evening.night_remaining()
+    assert evening.slow_interval(watch=True) == 60    # The car must not charge overnight, keep checking
+
+
+def test_polling_in_daytime_or_without_coordinates():
+    assert adaptive([]).night_remaining() == 0
+    assert adaptive([], now=EVENING, LATITUDE=None).slow_interval() == 60
+
+
+def test_cadence_keeps_its_period():
+    clock = FakeClock(0)
+    cadence = polling.Cadence(clock)
+    assert cadence.wait(2) == 2
+    clock.now = 2.5    # The work took half a second
+    assert cadence.wait(2) == 1.5
+    clock.now = 7    # Overrun, the next tick starts at once
+    assert cadence.wait(2) == 0
+    assert cadence.overruns == 1
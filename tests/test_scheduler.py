@@ -0,0 +1,89 @@
+import types
+import asyncio
+from scheduler import CommandScheduler
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeCar:
+    def __init__(self):
+        self.rates = []
+
+    def set_charge_rate(self, charge_rate, timeout=25):
+        self.rates.append(charge_rate)
+        return True
+
+
+async def direct(func, *args, **kwargs):
+    return func(*args, **kwargs)
+
+
+def scheduler(**config):
+    config = {"MIN_CHARGE": 6, "RATE_DEADBAND": 2, "MIN_COMMAND_INTERVAL": 10, "TOPIC_CHARGE_RATE": "rate", **config}
+    controller = types.SimpleNamespace(
+        config=config, clock=FakeClock(), vehicle=0, car=FakeCar(), car_command=direct, energy_wait=direct,
+        energy=types.SimpleNamespace(verify_new_charge_rate=lambda rate, timeout: True),
+        messages=types.SimpleNamespace(client=types.SimpleNamespace(publish=lambda **kwargs: None)))
+    return CommandScheduler(controller)
+
+
+def test_deadband_suppresses_small_changes():
+    commands = scheduler()
+    commands.request_rate(11, 10)
+    assert commands.pending_rate is None
+    assert commands.suppressed == 1
+    commands.request_rate(12, 10)
+    assert commands.pending_rate == 12
+
+
+def test_drop_to_min_charge_ignores_the_deadband():
+    commands = scheduler()
+    commands.request_rate(6, 7)    # reduce_to_min from MIN_CHARGE + 1 A
+    assert commands.pending_rate == 6
+    commands.request_rate(6, 6)
+    assert commands.pending_rate is None
+
+
+def test_changes_coalesce_inside_the_command_interval():
+    commands = scheduler()
+    car = commands.controller.car
+
+    async def run():
+        commands.request_rate(10, 6)
+        await commands.dispatch_pending()
+        commands.request_rate(14, 10)
+        commands.request_rate(16, 10)
+        await commands.dispatch_pending()    # Too soon, stays pending
+        assert car.rates == [10]
+        commands.clock.now += 10
+        await commands.dispatch_pending()
+
+    asyncio.run(run())
+    assert car.rates == [10, 16]
+    assert commands.coalesced == 1
+    assert commands.stats["set_charge_rate"][:2] == [2, 2]
+
+
+def test_stop_cancels_a_pending_rate():
+    commands = scheduler()
+    car = commands.controller.car
+    stops = []
+
+    async def run():
+        commands.request_rate(12, 8)
+        assert await commands.command("stop_charging", lambda timeout=25: stops.append(timeout) or True) == True
+        await commands.dispatch_pending()
+
+    asyncio.run(run())
+    assert stops == [25]
+    assert car.rates == []
+    assert commands.stats["stop_charging"][:2] == [1, 1]
@@ -0,0 +1,28 @@
+import datetime
+import tsstore
+
+
+def test_append_after_a_torn_record(tmp_path):
+    day = datetime.date(2024, 6, 1)
+    at = datetime.datetime(2024, 6, 1, 12).timestamp()
+    store = tsstore.TimeSeriesStore(str(tmp_path))
+    store.append("samples", at, 5000, 1000, 0, 0, 240)
+    store.flush()
+    filename = tsstore.day_file(str(tmp_path), day, "samples")
+    with open(filename, "ab") as fp:
+        fp.write(b"\0" * 5)    # A crash in the middle of a record
+    store.append("samples", at + 1, 5100, 1000, 0, 0, 240)
+    store.flush()
+    samples = list(tsstore.StoreReader(str(tmp_path)).scan("samples"))
+    assert [sample.generation for sample in samples] == [5000, 5100]
+    assert [sample.time for sample in samples] == [at, at + 1]
+
+
+def test_torn_header_is_rewritten(tmp_path):
+    day = datetime.date(2024, 6, 1)
+    at = datetime.datetime(2024, 6, 1, 12).timestamp()
+    filename = tsstore.day_file(str(tmp_path), day, "registers")
+    with open(filename, "wb") as fp:
+        fp.write(tsstore.MAGIC)
+    tsstore.append_records(str(tmp_path), day, "registers", [(at, 1.0, 2.0, 3.0)])
+    assert tsstore.last_time(filename, "registers") == at
@@ -0,0 +1,209 @@
+"""Compact time-series store for eGauge samples, control decisions and car commands
+
+Each kind of record goes to its own file per day (i.e. data/2024-06-01.samples), as fixed-width little-endian
+records behind a short header.  Records are buffered in memory and written in blocks, to spare the SD card.
+
+Reading uses mmap, so months of history can be scanned without loading it:
+    reader = tsstore.StoreReader("data")
+    for sample in reader.scan("samples", start=time.time() - 86400):
+        print(sample.generation)
+"""
+import os
+import mmap
+import time
+import atexit
+import struct
+import logging
+import datetime
+import threading
+import collections
+
+MAGIC = b"PVTS"
+VERSION = 1
+HEADER = struct.Struct("<4sHH")    # Magic, version, record size
+
+# Kind: (record format, field names), every record starts with its time (epoch seconds)
+KINDS = {
+    "samples": ("<d5f", ("time", "generation", "usage", "tesla_charger", "charge_rate", "charger_voltage")),
+    "decisions": ("<dBBxxff", ("time", "vehicle", "decision", "new_charge_rate", "charge_rate")),
+    "commands": ("<dBB?xf", ("time", "vehicle", "command", "success", "latency")),
+    "registers": ("<d3f", ("time", "generation", "usage", "tesla_charger")),    # eGauge history, see backfill.py
+}
+RECORDS = {kind: (struct.Struct(fmt), collections.namedtuple(kind.capitalize(), fields))
+           for kind, (fmt, fields) in KINDS.items()}
+
+# Decision branches of the control loop, the code is stored, never renumber
+DECISIONS = ("set_rate", "reduce_to_min", "stop_pending", "stopped", "stop_failed", "start_pending", "started",
+             "start_failed", "soc_full", "already_charging", "insufficient", "prevented", "slow_poll_stop",
+             "slow_poll_wait", "after_hours")
+COMMANDS = ("set_charge_rate", "start_charging", "stop_charging", "wake")
+
+
+class TimeSeriesStore:
+    """Buffered writer of daily record files"""
+    def __init__(self, directory, flush_bytes=4096, flush_interval=300):
+        self.directory = directory
+        self.flush_bytes = flush_bytes    # One SD card page
+        self.flush_interval = flush_interval    # Longest time records stay in memory (seconds)
+        self.buffers = {kind: bytearray() for kind in KINDS}
+        self.days = {kind: None for kind in KINDS}    # Day of the records in each buffer
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, kind, *values):
+        record, fields = RECORDS[kind]
+        day = datetime.date.fromtimestamp(values[0])
+        with self.lock:
+            if self.days[kind] != day:    # Rotate, the previous day goes to its own file
+                self.write(kind)
+                self.days[kind] = day
+            self.buffers[kind] += record.pack(*values)
+            if (len(self.buffers[kind]) >= self.flush_bytes or
+                    time.monotonic() - self.last_flush >= self.flush_interval):
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        for kind in KINDS:
+            self.write(kind)
+        self.last_flush = time.monotonic()
+
+    def write(self, kind):
+        buffer = self.buffers[kind]
+        if not buffer:
+            return
+        filename = day_file(self.directory, self.days[kind], kind)
+        try:
+            with open_day_file(filename, RECORDS[kind][0]) as fp:
+                fp.write(buffer)
+        except OSError as e:
+            logging.warning("Failed to write %s: %s", filename, e)
+        buffer.clear()
+
+
+class StoreReader:
+    """Memory-mapped reader of the daily record files"""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def days(self, kind):
+        """Days with records of kind, oldest first"""
+        suffix = f".{kind}"
+        return sorted(datetime.date.fromisoformat(name[:-len(suffix)])
+                      for name in os.listdir(self.directory) if name.endswith(suffix))
+
+    def scan(self, kind, start=None, end=None):
+        """Yield the records of kind with start <= time < end, as named tuples"""
+        first = datetime.date.fromtimestamp(start) if start is not None else None
+        last = datetime.date.fromtimestamp(end) if end is not None else None
+        for day in self.days(kind):
+            if (first and day < first) or (last and day > last):
+                continue
+            yield from self.scan_file(day_file(self.directory, day, kind), kind, start, end)
+
+    def scan_file(self, filename, kind, start=None, end=None):
+        record, fields = RECORDS[kind]
+        with open(filename, "rb") as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size <= HEADER.size:
+                return
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                magic, version, record_size = HEADER.unpack_from(mm)
+                if magic != MAGIC or record_size != record.size:
+                    raise ValueError(f"{filename} is not a {kind} file of this version")
+                count = (size - HEADER.size) // record.size    # Ignore a partly written last record
+                index = self.find(mm, record, count, start) if start is not None else 0
+                view = memoryview(mm)[HEADER.size + index * record.size:HEADER.size + count * record.size]
+                try:
+                    for values in record.iter_unpack(view):
+                        if end is not None and values[0] >= end:
+                            break
+                        yield fields._make(values)
+                finally:
+                    view.release()
+
+    @staticmethod
+    def find(mm, record, count, start):
+        """Index of the first record at or after start, records are appended in time order"""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if record.unpack_from(mm, HEADER.size + middle * record.size)[0] < start:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+
+def day_file(directory, day, kind):
+    return os.path.join(directory, f"{day.isoformat()}.{kind}")
+
+
+def last_time(filename, kind):
+    """Time of the last complete record in filename, None if there is none"""
+    record = RECORDS[kind][0]
+    try:
+        with open(filename, "rb") as fp:
+            count = (os.fstat(fp.fileno()).st_size - HEADER.size) // record.size
+            if count <= 0:
+                return None
+            fp.seek(HEADER.size + (count - 1) * record.size)
+            return record.unpack(fp.read(record.size))[0]
+    except FileNotFoundError:
+        return None
+
+
+def append_records(directory, day, kind, records):
+    """Append a block of records (tuples, in time order) to the file of day, in one write"""
+    record = RECORDS[kind][0]
+    filename = day_file(directory, day, kind)
+    data = bytearray()
+    for values in records:
+        data += record.pack(*values)
+    with open_day_file(filename, record) as fp:
+        fp.write(data)
+
+
+def open_day_file(filename, record):
+    """Open filename for appending records, after its header, or after its last complete record if a crash tore one"""
+    fp = open(filename, "ab")
+    size = fp.tell()
+    if size < HEADER.size:    # New file, or a torn header
+        fp.truncate(0)
+        fp.write(HEADER.pack(MAGIC, VERSION, record.size))
+    else:
+        fp.truncate(HEADER.size + (size - HEADER.size) // record.size * record.size)    # Drop a torn record
+        fp.seek(0, os.SEEK_END)
+    return fp
+
+
+def open_store(directory, flush_bytes=4096, flush_interval=300):
+    """Start recording, the record_* functions do nothing until this is called"""
+    global STORE
+    STORE = TimeSeriesStore(directory, flush_bytes, flush_interval)
+    atexit.register(STORE.flush)
+    logging.info("Recording samples, decisions and commands in %s", directory)
+    return STORE
+
+
+def record_sample(snapshot):
+    if STORE is not None:
+        STORE.append("samples", time.time(), snapshot.generation, snapshot.usage, snapshot.tesla_charger,
+                     snapshot.charge_rate, snapshot.charger_voltage)
+
+
+def record_decision(timestamp, vehicle, decision, new_charge_rate, charge_rate):
+    if STORE is not None:
+        STORE.append("decisions", timestamp, vehicle, DECISIONS.index(decision), new_charge_rate, charge_rate)
+
+
+def record_command(timestamp, vehicle, command, success, latency):
+    if STORE is not None and command in COMMANDS:
+        STORE.append("commands", timestamp, vehicle, COMMANDS.index(command), success, latency)
+
+
+STORE = None
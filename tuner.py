@@ -0,0 +1,343 @@
+"""Parameter sweep tuner, replays recorded days through the charge decision logic for many settings at once
+
+Run from the PVCharge directory (it starts from config.toml):
+    python tuner.py --days 30                               # The last 30 days of DATA_DIR history
+    python tuner.py june.csv --synthetic 7                  # simulator.py traces, and/or synthetic days
+    python tuner.py --days 30 --sweep MIN_CHARGE=5,6,7,8 --search random --samples 500 --output tuned.toml
+
+Every combination of the swept settings is replayed over every day with decision.decide(), on all cores.  The
+replay is leaner than simulator.py: one car model step per pass (polled as AdaptivePolling would, without the night
+skip), and car commands that always succeed and are verified at once, so a day takes tens of milliseconds instead
+of a second.
+Combinations are ranked by the solar energy that went into the car, less the grid import and car commands
+(weighted by --grid-weight and --command-weight), and the best one is written as a copy of config.toml.
+"""
+import os
+import re
+import sys
+import math
+import time
+import random
+import argparse
+import datetime
+import itertools
+import collections
+import concurrent.futures
+import decision
+import settings
+import simulator
+import tsstore
+from smoothing import SampleRing
+
+# Swept by default, the current config.toml value is always tried as well
+SWEEP = {
+    "MIN_CHARGE": (5, 6, 7, 8, 10),
+    "MIN_SOLAR": (250, 500, 1000, 1500),
+    "DELAYED_START_TIME": (0, 10, 30, 60, 120),
+    "DELAYED_STOP_TIME": (30, 90, 180, 300, 600),
+    "FAST_POLLING": (2, 5, 10, 20),
+}
+
+Result = collections.namedtuple("Result", ["params", "car_solar_kwh", "surplus_kwh", "grid_import_kwh", "commands",
+                                           "score"])
+
+
+class DayReplay:
+    """One day through decide() and the simulator car model, on a virtual clock that steps a whole pass at a time"""
+    def __init__(self, trace, config, soc=50, charge_limit_soc=80, prevent_non_solar_charge=False):
+        self.trace = trace
+        self.config = config
+        self.clock = simulator.VirtualClock(trace.times[0])
+        self.car = simulator.CarModel(self.clock, soc=soc, charge_limit_soc=charge_limit_soc)
+        self.car.target_amps = config["MIN_CHARGE"]
+        self.prevent_non_solar_charge = prevent_non_solar_charge
+        self.surplus = SampleRing(config.get("SMOOTHING_WINDOW", 15), config.get("SMOOTHING_ALPHA", 0.3))
+        self.index = 0    # Trace row of the current time
+        self.pending_rate = None
+        self.last_rate_time = -math.inf
+        self.commands = 0
+        self.surplus_wh = 0.0
+        self.car_wh = 0.0
+        self.car_solar_wh = 0.0
+        self.grid_import_wh = 0.0
+
+    def run(self):
+        config = self.config
+        car = self.car
+        clock = self.clock
+        end = self.trace.times[-1]
+        state = decision.LoopState(False, 0, 0)
+        while clock.now < end:
+            generation, usage = self.values()
+            self.surplus.append(generation - usage)
+            charge_rate = self.surplus.smoothed(config.get("SMOOTHING", "none")) / car.voltage
+            inputs = decision.Inputs(clock.now, True, generation > config["MIN_SOLAR"], False,
+                                     self.prevent_non_solar_charge, charge_rate, 0, car.amps,
+                                     int(car.soc), car.charge_limit_soc, "asleep" if car.asleep else "online")
+            result = decision.decide(state, inputs, config)
+            state = result.state
+            for action in result.actions:
+                state = self.act(action, result, state)
+            self.send_pending_rate()
+            interval = self.fast_interval(state.car_is_charging) if result.fast_polling else config["SLOW_POLLING"]
+            self.advance(min(interval, end - clock.now))
+        return self
+
+    def fast_interval(self, charging):
+        """AdaptivePolling.fast_interval() on the replayed surplus"""
+        fast = self.config["FAST_POLLING"]
+        max_fast = max(self.config.get("MAX_FAST_POLLING", fast), fast)
+        if max_fast == fast or self.surplus.count < 2:
+            return fast
+        voltage = self.car.voltage
+        calm = max(1 - math.sqrt(self.surplus.variance()) / voltage / self.config.get("VOLATILE_AMPS", 2), 0)
+        if not charging:
+            min_charge = self.config["MIN_CHARGE"]
+            calm = max(calm, min((min_charge - self.surplus.latest() / voltage) / min_charge, 1))
+        return fast + (max_fast - fast) * calm
+
+    def act(self, action, result, state):
+        car = self.car
+        min_charge = self.config["MIN_CHARGE"]
+        if action == "request_rate":
+            if abs(result.rate - round(car.amps)) < self.config.get("RATE_DEADBAND", 1):
+                self.pending_rate = None
+            else:
+                self.pending_rate = result.rate
+        elif action == "wake":
+            self.command()
+            car.asleep = False
+            self.advance(5)
+        elif action == "start":
+            success = self.command() and car.soc < car.charge_limit_soc
+            if success and not car.charging:
+                car.charging = True
+                car.charging_since = self.clock.now
+            if success:    # Verified once the current reaches MIN_CHARGE
+                self.advance(car.start_delay)
+                self.advance(min(car.target_amps, min_charge) / car.ramp_rate)
+            state = decision.started(state, success, success)[0]
+        elif action == "reset_rate":
+            if self.command():
+                car.target_amps = min_charge
+        else:    # stop, prevent_stop and slow_stop
+            success = self.command()
+            if success:
+                car.charging = False
+            if action == "stop":
+                state = decision.stopped(state, success, car.amps, min_charge)[0]
+        return state
+
+    def command(self):
+        """Count a car command and let its latency pass, False if the car is asleep"""
+        self.commands += 1
+        self.advance(self.car.command_latency)
+        return not self.car.asleep
+
+    def send_pending_rate(self):
+        """The CommandScheduler: the latest requested rate, no sooner than MIN_COMMAND_INTERVAL after the last"""
+        if self.pending_rate is None or self.clock.now - self.last_rate_time < self.config.get("MIN_COMMAND_INTERVAL", 10):
+            return
+        rate, self.pending_rate = self.pending_rate, None
+        self.last_rate_time = self.clock.now
+        if self.command():
+            self.car.target_amps = max(min(rate, self.car.max_amps), 0)
+
+    def values(self):
+        times = self.trace.times
+        while self.index + 1 < len(times) and times[self.index + 1] <= self.clock.now:
+            self.index += 1
+        return self.trace.generation[self.index], self.trace.usage[self.index]
+
+    def advance(self, seconds):
+        generation, usage = self.values()
+        self.car.step(seconds)
+        car = self.car.power()
+        surplus = max(generation - usage, 0)
+        self.surplus_wh += surplus * seconds / 3600
+        self.car_wh += car * seconds / 3600
+        self.car_solar_wh += min(car, surplus) * seconds / 3600
+        self.grid_import_wh += max(usage + car - generation, 0) * seconds / 3600
+        self.clock.now += seconds
+
+
+# Set in each worker process by init_worker, so the days are sent once per process rather than per combination
+WORKER = {}
+
+
+def init_worker(days, config, options):
+    WORKER.update(days=days, config=config, options=options)
+
+
+def evaluate(params):
+    """Totals of all days under the worker config with params applied"""
+    config = {**WORKER["config"], **params}
+    totals = [0.0, 0.0, 0.0, 0]
+    for trace in WORKER["days"]:
+        replay = DayReplay(trace, config, **WORKER["options"]).run()
+        totals[0] += replay.car_solar_wh / 1000
+        totals[1] += replay.surplus_wh / 1000
+        totals[2] += replay.grid_import_wh / 1000
+        totals[3] += replay.commands
+    return params, totals
+
+
+def sweep(days, config, combinations, options, grid_weight=1.0, command_weight=0.01, workers=None):
+    """Results of all combinations, best first"""
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(len(combinations) // (workers * 8), 1)    # Few round trips, yet an even spread at the end
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(workers, initializer=init_worker,
+                                                initargs=(days, config, options)) as executor:
+        for params, (car_solar, surplus, grid_import, commands) in executor.map(evaluate, combinations,
+                                                                                chunksize=chunksize):
+            score = (car_solar - grid_weight * grid_import - command_weight * commands) / len(days)
+            results.append(Result(params, car_solar, surplus, grid_import, commands, score))
+    return sorted(results, key=lambda result: result.score, reverse=True)
+
+
+def grid(ranges, search="grid", samples=1000, seed=1):
+    """Combinations of the swept values, all of them or a random sample"""
+    keys = list(ranges)
+    combinations = [dict(zip(keys, values)) for values in itertools.product(*ranges.values())]
+    if search == "random" and samples < len(combinations):
+        combinations = random.Random(seed).sample(combinations, samples)
+    return combinations
+
+
+def sweep_ranges(config, overrides):
+    """SWEEP with the KEY=v1,v2 overrides, plus the current value of each key"""
+    ranges = {key: list(values) for key, values in SWEEP.items()}
+    for override in overrides:
+        key, _, values = override.partition("=")
+        kind = settings.SCHEMA.get(key)
+        if kind not in (int, float) or not values:
+            raise ValueError(f"--sweep {override}: expected KEY=v1,v2,... with a numeric config key")
+        ranges[key] = [kind(value) for value in values.split(",")]
+    for key, values in ranges.items():
+        if key in config and config[key] not in values:
+            values.append(config[key])
+        values.sort()
+    return ranges
+
+
+def load_days(directory, count):
+    """The last count recorded days in directory, live samples where there are any, else backfilled registers"""
+    reader = tsstore.StoreReader(directory)
+    recorded = sorted(set(reader.days("samples")) | set(reader.days("registers")))[-count:]
+    days = []
+    for day in recorded:
+        for kind in ("samples", "registers"):
+            filename = tsstore.day_file(directory, day, kind)
+            if os.path.exists(filename):
+                records = list(reader.scan_file(filename, kind))
+                if len(records) > 1:
+                    days.append(simulator.Trace([record.time for record in records],
+                                                [record.generation for record in records],
+                                                [record.usage - record.tesla_charger for record in records]))
+                    break
+    return days
+
+
+def split_days(trace):
+    """One trace per local calendar day"""
+    days = []
+    for day, rows in itertools.groupby(zip(trace.times, trace.generation, trace.usage),
+                                       key=lambda row: datetime.date.fromtimestamp(row[0])):
+        times, generation, usage = zip(*rows)
+        if len(times) > 1:
+            days.append(simulator.Trace(list(times), list(generation), list(usage)))
+    return days
+
+
+def tuned_config(text, params):
+    """config.toml text with the values of params replaced, keeping the comments in line"""
+    for key, value in params.items():
+        value = f"{value:g}" if isinstance(value, float) else str(value)
+        pattern = re.compile(rf"^({key}\s*=\s*)(\S+)(.*)$", re.MULTILINE)
+        if pattern.search(text):
+            text = pattern.sub(lambda match: match.group(1) + align(value, match.group(2), match.group(3)), text, count=1)
+        else:
+            text += f"{key} = {value}\n"
+    return text
+
+
+def align(value, old, rest):
+    """value followed by rest, the comment of rest in the same column as after old where there is room"""
+    if not rest:
+        return value
+    spaces = len(rest) - len(rest.lstrip())
+    shift = min(len(value) - len(old), spaces - 1)
+    return value.ljust(len(old)) + rest if shift <= 0 else value + rest[shift:]
+
+
+def print_results(results, current, days, top):
+    print(f"{'Rank':>4} {'Solar kWh':>9} {'Capture':>7} {'Grid kWh':>8} {'Commands':>8} {'Score':>7}  Settings (per day averages)")
+    for rank, result in enumerate(results, 1):
+        if rank <= top or result.params == current:
+            capture = result.car_solar_kwh / result.surplus_kwh * 100 if result.surplus_kwh else 0
+            settings_text = " ".join(f"{key}={value:g}" for key, value in result.params.items())
+            print(f"{rank:>4} {result.car_solar_kwh / days:>9.2f} {capture:>6.1f}% {result.grid_import_kwh / days:>8.2f} "
+                  f"{result.commands / days:>8.1f} {result.score:>7.2f}  {settings_text}"
+                  f"{'   (current)' if result.params == current else ''}")
+
+
+def main():
+    config = settings.shared()
+    parser = argparse.ArgumentParser(description="Tune the control loop settings by replaying recorded days")
+    parser.add_argument("traces", nargs="*", help="CSV trace files (time, generation, usage), split into days")
+    parser.add_argument("--days", type=int, help="Replay the last DAYS days of DATA_DIR history")
+    parser.add_argument("--data-dir", default=config.get("DATA_DIR") or "data", help="Store directory")
+    parser.add_argument("--synthetic", type=int, metavar="DAYS", help="Replay synthetic days as well")
+    parser.add_argument("--sweep", action="append", default=[], metavar="KEY=V1,V2",
+                        help="Values to try for a config key, replacing the default range (repeatable)")
+    parser.add_argument("--search", choices=("grid", "random"), default="grid",
+                        help="Every combination, or a random sample of --samples of them")
+    parser.add_argument("--samples", type=int, default=1000, help="Combinations tried by the random search")
+    parser.add_argument("--seed", type=int, default=1, help="Random search seed")
+    parser.add_argument("--soc", type=float, default=50, help="Battery level at the start of each day (percent)")
+    parser.add_argument("--limit", type=int, default=80, help="Charge limit SOC (percent)")
+    parser.add_argument("--grid-weight", type=float, default=1.0, help="Score lost per kWh imported (default 1)")
+    parser.add_argument("--command-weight", type=float, default=0.01, help="Score lost per car command (default 0.01)")
+    parser.add_argument("--workers", type=int, help="Worker processes (default all cores)")
+    parser.add_argument("--top", type=int, default=10, help="Combinations shown")
+    parser.add_argument("--output", default="tuned_config.toml", help="Copy of config.toml with the best settings")
+    args = parser.parse_args()
+
+    days = []
+    if args.days:
+        days += load_days(args.data_dir, args.days)
+    for filename in args.traces:
+        days += split_days(simulator.Trace.from_csv(filename))
+    if args.synthetic:
+        days += [simulator.Trace.synthetic(days=1, seed=seed) for seed in range(1, args.synthetic + 1)]
+    if not days:
+        parser.error("no days to replay, use --days, a trace file or --synthetic")
+    try:
+        ranges = sweep_ranges(config, args.sweep)
+    except ValueError as e:
+        parser.error(str(e))
+    combinations = grid(ranges, args.search, args.samples, args.seed)
+    current = {key: config[key] for key in ranges if key in config}
+    if current not in combinations:
+        combinations.append(current)
+    base = {key: value for key, value in config.items() if key != "VEHICLES"}
+    options = {"soc": args.soc, "charge_limit_soc": args.limit,
+               "prevent_non_solar_charge": bool(config["PREVENT_NON_SOLAR_CHARGE"])}
+
+    print(f"Replaying {len(days)} day(s) for {len(combinations)} combination(s)")
+    started = time.monotonic()
+    results = sweep(days, base, combinations, options, args.grid_weight, args.command_weight, args.workers)
+    elapsed = time.monotonic() - started
+    print(f"{len(days) * len(combinations)} day replays in {elapsed:.1f} seconds")
+    print_results(results, current, len(days), args.top)
+
+    with open(config.filename) as fp:
+        text = tuned_config(fp.read(), results[0].params)
+    with open(args.output, "w") as fp:
+        fp.write(text)
+    print(f"Best settings written to {args.output}, copy it over {config.filename} and reload PVCharge (SIGHUP)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())